@@ -1,18 +1,13 @@
 import streamlit as st
 import pandas as pd
 import time
-from utils import initialize_state, get_all_transactions, update_prices_in_state, generate_financial_analysis, TRANSACTION_TYPE_LABELS
+from utils import initialize_state, get_ledger_symbols, update_prices_in_state, get_financial_analysis, get_portfolio_value_series, get_price_history, backfill_price_history, import_price_history_csv, TRANSACTION_TYPE_LABELS
 
 st.set_page_config(page_title="Crypto Dashboard", layout="wide")
 initialize_state()
-transactions = get_all_transactions()
 st.title("Crypto Financial Dashboard")
 
-# --- FIX: Handle empty transactions DataFrame ---
-unique_symbols = []
-if not transactions.empty:
-    all_symbols = pd.concat([transactions['input_currency'], transactions['output_currency']]).dropna().unique()
-    unique_symbols = [s for s in all_symbols if s != 'IRR']
+unique_symbols = get_ledger_symbols()
 
 update_prices_in_state(unique_symbols)
 if st.button("Refresh Live Prices"): update_prices_in_state(unique_symbols, force_refresh=True)
@@ -24,9 +19,9 @@ st.caption("Price data provided by CoinGecko.")
 st.markdown("---")
 
 prices = st.session_state.get('prices', {})
-portfolio_df, toman_stats_df, realized_pnl_df, fee_summary_df = generate_financial_analysis(transactions, prices)
+portfolio_df, toman_stats_df, realized_pnl_df, fee_summary_df = get_financial_analysis(prices)
 
-tab1, tab2, tab3, tab4 = st.tabs(["Floating P/L", "Realized P/L", "Toman Exchange", "Fee Analysis"])
+tab1, tab2, tab3, tab4, tab5 = st.tabs(["Floating P/L", "Realized P/L", "Toman Exchange", "Fee Analysis", "Value Over Time"])
 
 with tab1:
     st.subheader("Current Portfolio & Floating Profit/Loss")
@@ -62,3 +57,23 @@ with tab4:
             display_fees = fee_summary_df.copy()
             display_fees['transaction_type'] = display_fees['transaction_type'].map(TRANSACTION_TYPE_LABELS).fillna(display_fees['transaction_type'])
             st.dataframe(display_fees, column_config={"person_name": "Person", "transaction_type": "Transaction Type", "fee": st.column_config.NumberColumn("Fee (USD)", format="$%.2f")}, hide_index=True, use_container_width=True)
+
+with tab5:
+    st.subheader("Portfolio Value Over Time (USD)")
+    value_series = get_portfolio_value_series(prices)
+    if value_series.empty: st.info("No holdings to chart yet.")
+    else:
+        value_series.columns = [str(c).capitalize() for c in value_series.columns]
+        st.line_chart(value_series)
+    if get_price_history()[1].empty: st.caption("No price history yet: past days are valued at today's prices.")
+    if st.button("Back-fill Price History"):
+        with st.spinner("Downloading daily prices..."): saved = backfill_price_history(unique_symbols)
+        if saved: st.toast(f"Saved daily prices for {', '.join(saved)}.", icon="✅"); st.rerun()
+        else: st.toast("Failed to download price history.", icon="❌")
+    price_file = st.file_uploader("Or load daily prices from a CSV: a date column plus one column per currency, or date, currency and price columns", type=["csv"])
+    if price_file is not None and st.button("Load Price File"):
+        try: saved = import_price_history_csv(price_file)
+        except ValueError as e: st.error(str(e))
+        else:
+            if saved: st.toast(f"Saved {saved:,} daily prices.", icon="✅"); st.rerun()
+            else: st.toast("The file has no prices to save.", icon="❌")
@@ -0,0 +1,3 @@
+# Streamlit-free accounting core: db (SQLite), store (the ledger), prices, analysis, summary (SQL-side aggregates),
+# export (streaming CSV/XLSX), bench (synthetic ledgers and timings), perf (opt-in instrumentation) and the command
+# line. Submodules are imported on demand, so `python -m crypto_ledger balances` never loads pandas.
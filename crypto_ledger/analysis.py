@@ -0,0 +1,492 @@
+# Portfolio analysis on a ledger frame: average-cost positions and P/L, historical valuation, value over
+# time and tax lots. Pure pandas/numpy. The app reads its summaries from SQLite (summary), which finalizes them
+# here; the whole-ledger analysis serves the CLI report and the benchmarks, and the lot cache the portfolio page.
+import heapq
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from .db import unit_scale
+from .perf import timed
+from .store import CATEGORICAL_COLUMNS, _ensure_data_types, _from_units
+
+# --- THE BRAIN OF THE APP - FULLY RESTORED ---
+# The analysis is built from additive per-group sums ("parts"): shards, closed periods and SQL summaries each
+# give parts that add up, and each part keeps a row count so groups with no transactions left are dropped.
+def _codes(series, categories=None):
+    if not isinstance(series.dtype, pd.CategoricalDtype): series = series.astype('category')
+    if categories is not None and not series.cat.categories.equals(categories): series = series.cat.set_categories(categories)
+    # int64 so person x currency group keys can't overflow the narrow dtype pandas picks for codes
+    return series.cat.codes.to_numpy().astype('int64'), series.cat.categories
+
+def _amounts(series):
+    if series.dtype != 'float64': series = pd.to_numeric(series, errors='coerce').astype('float64').fillna(0)
+    return series.to_numpy()
+
+def _unit_scales(currencies):
+    # 10 ** decimals per currency code, with the trailing slot (code -1) for rows without a currency
+    return np.array([unit_scale(c) for c in currencies] + [unit_scale(None)], dtype='float64')
+
+def _group_sums(keys, mask, levels, **weights):
+    # Sum each weight per group key with bincount and keep only the groups that actually have rows
+    size = int(np.prod([len(level) for level in levels]))
+    keys = keys[mask]
+    counts = np.bincount(keys, minlength=size)
+    columns = {name: np.bincount(keys, weights=values[mask], minlength=size) for name, values in weights.items()}
+    present = np.flatnonzero(counts)
+    if len(levels) == 1: index = pd.Index(np.asarray(levels[0], dtype=object)[present])
+    else: index = pd.MultiIndex.from_arrays([np.asarray(level, dtype=object)[code] for level, code in zip(levels, np.unravel_index(present, [len(level) for level in levels]))])
+    frame = pd.DataFrame({name: values[present] for name, values in columns.items()}, index=index)
+    frame['rows'] = counts[present].astype('float64')
+    return frame.sort_index()
+
+def _row_prices(days, currencies, in_cur, out_cur, prices, history=None):
+    # Missing currencies (code -1) resolve to the trailing slot of the price vector; with price history,
+    # each row is valued at its own date and today's quote only fills the gaps
+    price_vector = np.array([prices.get(c, 1.0) for c in currencies] + [1.0], dtype='float64')
+    in_price = price_vector[np.where(in_cur < 0, len(currencies), in_cur)]
+    out_price = price_vector[np.where(out_cur < 0, len(currencies), out_cur)]
+    if history is not None and not history.empty:
+        in_price = _prices_asof(history, currencies, in_cur, days, in_price)
+        out_price = _prices_asof(history, currencies, out_cur, days, out_price)
+    return in_price, out_price
+
+def _ledger_columns(transactions):
+    # Columnar view of the ledger: categorical codes, days and float arrays, no per-row Python
+    if not set(CATEGORICAL_COLUMNS + ['input_amount', 'output_amount', 'rate', 'fee']).issubset(transactions.columns):
+        transactions = _ensure_data_types(transactions.copy())
+    person, people = _codes(transactions['person_name'])
+    tx_type, types = _codes(transactions['transaction_type'])
+    currencies = pd.Index(_codes(transactions['input_currency'])[1]).union(_codes(transactions['output_currency'])[1])
+    columns = {'person': person, 'tx_type': tx_type,
+               'in_cur': _codes(transactions['input_currency'], currencies)[0], 'out_cur': _codes(transactions['output_currency'], currencies)[0],
+               'day': pd.to_datetime(transactions['transaction_date'], errors='coerce').to_numpy().astype('datetime64[D]')}
+    columns.update({name: _amounts(transactions[name]) for name in ('input_amount', 'output_amount')})
+    # Ledger frames carry the fee columns SQLite derived at write time; anything else derives them here
+    if {'fee_usd', 'fee_amount'}.issubset(transactions.columns): columns.update({name: _amounts(transactions[name]) for name in ('fee_usd', 'fee_amount')})
+    else: columns.update(_derived_fees(tx_type, types, columns['input_amount'], columns['output_amount'], _amounts(transactions['rate']), _amounts(transactions['fee'])))
+    return columns, (people, types, currencies)
+
+def _derived_fees(tx_type, types, input_amount, output_amount, rate, fee):
+    # Same rules as the generated columns in db.DERIVED_COLUMN_SQL
+    def is_type(name): return tx_type == (types.get_loc(name) if name in types else -2)
+    toman, transfer = is_type('buy_usdt_with_toman'), is_type('transfer')
+    hidden_fee = np.divide(input_amount, rate, out=np.zeros(len(rate)), where=rate != 0) - output_amount
+    fee_usd = np.where(toman, np.where(rate != 0, hidden_fee, 0.0), np.where(transfer, 0.0, fee))
+    return {'fee_usd': fee_usd, 'fee_amount': np.where(transfer, input_amount - output_amount, 0.0)}
+
+def _analysis_parts(transactions, prices, history=None):
+    columns, levels = _ledger_columns(transactions)
+    return _parts_from_columns(columns, levels, prices, history)
+
+def _parts_from_columns(columns, levels, prices, history=None):
+    people, types, currencies = levels
+    person, tx_type, in_cur, out_cur = columns['person'], columns['tx_type'], columns['in_cur'], columns['out_cur']
+    input_amount, output_amount = columns['input_amount'], columns['output_amount']
+
+    in_price, out_price = _row_prices(columns['day'], currencies, in_cur, out_cur, prices, history)
+
+    def is_type(name): return tx_type == (types.get_loc(name) if name in types else -2)
+    toman_mask = is_type('buy_usdt_with_toman')
+    acquisition_mask = is_type('buy_crypto_with_usdt') | is_type('swap')
+    disposal_mask = is_type('sell') | is_type('swap')
+
+    # Only a transfer's fee needs pricing; the rest was settled in USD when the row was written
+    calculated_fee = columns['fee_usd'] + columns['fee_amount'] * in_price
+
+    has_person = person >= 0
+    by_in_currency = np.where(in_cur >= 0, person * len(currencies) + in_cur, 0)
+    by_out_currency = np.where(out_cur >= 0, person * len(currencies) + out_cur, 0)
+    has_in, has_out = has_person & (in_cur >= 0), has_person & (out_cur >= 0)
+    levels = [people, currencies]
+
+    toman = _group_sums(person, toman_mask & has_person, [people], total_toman_paid=input_amount, total_usdt_received=output_amount)
+    cost_basis = _group_sums(by_out_currency, acquisition_mask & has_out, levels, total_cost_usd=input_amount * in_price + calculated_fee, total_amount_crypto=output_amount)
+    # Holdings are summed in integer units of each currency (exact in float64 below 2**53), so a position that
+    # was fully spent comes out at exactly zero
+    scales = _unit_scales(currencies)
+    received = _group_sums(by_out_currency, has_out, levels, units=np.rint(output_amount * scales[out_cur]))
+    spent = _group_sums(by_in_currency, has_in, levels, units=np.rint(input_amount * scales[in_cur]))
+    holdings = received.sub(spent.assign(rows=-spent['rows']), fill_value=0)
+    disposed = _group_sums(by_in_currency, disposal_mask & has_in, levels, net_proceeds_usd=output_amount * out_price - calculated_fee, amount_disposed=input_amount)
+    fees = _group_sums(np.where(tx_type >= 0, person * len(types) + tx_type, 0), (calculated_fee > 0) & has_person & (tx_type >= 0), [people, types], fee=calculated_fee)
+
+    toman.index.name = 'person_name'
+    for part in (cost_basis, holdings, disposed): part.index.names = ['person_name', 'currency']
+    fees.index.names = ['person_name', 'transaction_type']
+    return {'toman': toman, 'cost_basis': cost_basis, 'holdings': holdings, 'disposals': disposed, 'fees': fees}
+
+def _combine_parts(parts, delta, sign):
+    combined = {}
+    for name, part in parts.items():
+        merged = part.add(delta[name] * sign, fill_value=0)
+        combined[name] = merged[merged['rows'] > 0]
+    return combined
+
+def _finalize_analysis(parts, prices):
+    if parts['holdings'].empty:
+        empty_df = pd.DataFrame()
+        return empty_df, empty_df, empty_df, empty_df
+
+    toman_stats = parts['toman'].drop(columns='rows').reset_index()
+    if not toman_stats.empty: toman_stats['avg_usdt_cost'] = toman_stats['total_toman_paid'] / toman_stats['total_usdt_received']
+
+    if not parts['cost_basis'].empty:
+        cost_basis = parts['cost_basis'].drop(columns='rows').reset_index()
+        cost_basis['avg_buy_price'] = cost_basis['total_cost_usd'] / cost_basis['total_amount_crypto']
+    else: cost_basis = pd.DataFrame(columns=['person_name', 'currency', 'avg_buy_price'])
+
+    portfolio = parts['holdings'].drop(columns='rows').reset_index()
+    portfolio = portfolio[portfolio['units'] > 0]
+    portfolio = portfolio.assign(amount=portfolio['units'] / portfolio['currency'].map(unit_scale).astype('float64')).drop(columns='units')
+    portfolio_analysis = pd.merge(portfolio, cost_basis, on=['person_name', 'currency'], how='left')
+
+    if prices and not portfolio_analysis.empty:
+        portfolio_analysis['current_price'] = portfolio_analysis['currency'].map(prices)
+        portfolio_analysis['current_value_usd'] = portfolio_analysis['amount'] * portfolio_analysis['current_price']
+        portfolio_analysis['total_cost_of_holdings'] = portfolio_analysis['amount'] * portfolio_analysis['avg_buy_price']
+        portfolio_analysis['floating_pnl_usd'] = portfolio_analysis['current_value_usd'] - portfolio_analysis['total_cost_of_holdings']
+
+    disposals = parts['disposals']
+    if not disposals.empty and not cost_basis.empty:
+        disposals = pd.merge(disposals.reset_index(), cost_basis[['person_name', 'currency', 'avg_buy_price']], on=['person_name', 'currency'], how='left')
+        disposals['realized_pnl'] = disposals['net_proceeds_usd'] - disposals['amount_disposed'] * disposals['avg_buy_price']
+        realized_pnl_summary = disposals.groupby('person_name')['realized_pnl'].sum().reset_index()
+    else: realized_pnl_summary = pd.DataFrame(columns=['person_name', 'realized_pnl'])
+
+    fee_summary = parts['fees'].drop(columns='rows').reset_index()
+
+    return portfolio_analysis.fillna(0), toman_stats, realized_pnl_summary, fee_summary
+
+# Closed periods (and the SQL-side summaries) come as per (person, type, currency pair, day) sums rather than rows;
+# every part is linear in those sums once each is priced at its day, so the same parts follow from them.
+def _summary_group(frame, mask, keys, **sums):
+    # Same shape as analysis parts: the summed columns plus a row count, indexed by the group keys
+    frame = frame[mask]
+    grouped = pd.DataFrame({name: values[mask] for name, values in sums.items()} | {'rows': frame['row_count'].to_numpy()}, index=frame.index)
+    grouped[keys] = frame[keys]
+    part = grouped.groupby(keys).sum().sort_index()
+    if len(keys) == 1: part.index = pd.Index(part.index.astype(object), name=keys[0])
+    else: part.index = pd.MultiIndex.from_arrays([part.index.get_level_values(i).astype(object) for i in range(len(keys))], names=keys)
+    return part
+
+def _summary_parts(summary, prices, history=None):
+    currencies = pd.Index(_codes(summary['input_currency'])[1]).union(_codes(summary['output_currency'])[1])
+    in_cur, out_cur = _codes(summary['input_currency'], currencies)[0], _codes(summary['output_currency'], currencies)[0]
+    days = pd.to_datetime(summary['day'], errors='coerce').to_numpy().astype('datetime64[D]') if 'day' in summary else np.full(len(summary), np.datetime64('NaT'), 'datetime64[D]')
+    in_price, out_price = _row_prices(days, currencies, in_cur, out_cur, prices, history)
+    scales = _unit_scales(currencies)
+    input_units, output_units = summary['input_units'].to_numpy(), summary['output_units'].to_numpy()
+    input_amount, output_amount = input_units / scales[in_cur], output_units / scales[out_cur]
+    fee_usd, fee_amount = summary['fee_usd'].to_numpy(), summary['fee_amount'].to_numpy()
+    tx_type = summary['transaction_type']
+    has_in, has_out = summary['input_currency'].notna().to_numpy(), summary['output_currency'].notna().to_numpy()
+    by_in, by_out = ['person_name', 'input_currency'], ['person_name', 'output_currency']
+
+    parts = {
+        'toman': _summary_group(summary, (tx_type == 'buy_usdt_with_toman').to_numpy(), ['person_name'], total_toman_paid=input_amount, total_usdt_received=output_amount),
+        'cost_basis': _summary_group(summary, tx_type.isin(['buy_crypto_with_usdt', 'swap']).to_numpy() & has_out, by_out,
+                             total_cost_usd=(input_amount + fee_amount) * in_price + fee_usd, total_amount_crypto=output_amount),
+        'disposals': _summary_group(summary, tx_type.isin(['sell', 'swap']).to_numpy() & has_in, by_in,
+                            net_proceeds_usd=output_amount * out_price - fee_usd - fee_amount * in_price, amount_disposed=input_amount),
+    }
+    received = _summary_group(summary, has_out, by_out, units=output_units)
+    spent = _summary_group(summary, has_in, by_in, units=input_units)
+    received.index.names = spent.index.names = ['person_name', 'currency']
+    parts['holdings'] = received.sub(spent.assign(rows=-spent['rows']), fill_value=0)
+    for name in ('cost_basis', 'disposals'): parts[name].index.names = ['person_name', 'currency']
+    # Only rows that paid a fee reach the fee table, so it sums the paid columns and counts the paid rows
+    paid = summary.assign(row_count=summary['paid_count'])
+    parts['fees'] = _summary_group(paid, (summary['paid_count'] > 0).to_numpy() & tx_type.notna().to_numpy(), ['person_name', 'transaction_type'],
+                           fee=summary['paid_fee_usd'].to_numpy() + summary['paid_fee_amount'].to_numpy() * in_price)
+    return parts
+
+def _with_opening(parts, opening, prices, history=None):
+    # Starts `parts` from a closed-period checkpoint (LedgerSnapshot.closed.summary), when there is one
+    if opening is None or opening.empty: return parts
+    return _combine_parts(parts, _summary_parts(opening, prices, history), 1)
+
+@timed('generate_financial_analysis')
+def generate_financial_analysis(transactions, prices, history=None, workers=None, opening=None):
+    # `opening` is the summary of the closed periods the open ledger continues from
+    if transactions.empty and (opening is None or opening.empty):
+        empty_df = pd.DataFrame()
+        return empty_df, empty_df, empty_df, empty_df
+    parts = _summary_parts(opening, prices, history) if transactions.empty else _with_opening(_ledger_parts(transactions, prices, history, workers), opening, prices, history)
+    return _finalize_analysis(parts, prices)
+
+def _ledger_parts(transactions, prices, history=None, workers=None):
+    # Whole-ledger parts, sharded by person across the process pool when the ledger is big enough
+    workers = ANALYSIS_WORKERS if workers is None else workers
+    if workers > 1 and len(transactions) >= SHARD_MIN_ROWS: return sharded_analysis_parts(transactions, prices, history, workers)
+    return _analysis_parts(transactions, prices, history)
+
+def _price_key(prices):
+    return hash(tuple(sorted((prices or {}).items())))
+
+# --- SHARDED ANALYSIS ---
+# No group spans two people, so the ledger can be split by person and the shards' parts concatenated.
+# Workers read the columns from one shared-memory block; only shard bounds, level names, prices and
+# history are pickled.
+ANALYSIS_WORKERS = int(os.environ.get('CRYPTO_ANALYSIS_WORKERS', '1'))  # above 1, big ledgers are sharded across processes
+SHARD_MIN_ROWS = 200_000  # smaller ledgers finish before a pool round trip would
+_SHARD_LAYOUT = [('person', 'int64'), ('tx_type', 'int64'), ('in_cur', 'int64'), ('out_cur', 'int64'), ('day', 'datetime64[D]'),
+                 ('input_amount', 'float64'), ('output_amount', 'float64'), ('fee_usd', 'float64'), ('fee_amount', 'float64'), ('order', 'int64')]
+
+def _shared_columns(buffer, length):
+    # Every layout dtype is 8 bytes wide, so array i starts at i * length * 8
+    return {name: np.ndarray(length, dtype=dtype, buffer=buffer, offset=i * length * 8) for i, (name, dtype) in enumerate(_SHARD_LAYOUT)}
+
+def _shard_parts(block_name, length, start, stop, levels, prices, history):
+    # Runs in a worker: gathers its own rows out of the block, so no view outlives the close
+    block = shared_memory.SharedMemory(name=block_name)
+    try:
+        shared = _shared_columns(block.buf, length)
+        rows = shared.pop('order')[start:stop]
+        columns = {name: values[rows] for name, values in shared.items()}
+        del shared, rows
+    finally: block.close()
+    return _parts_from_columns(columns, levels, prices, history)
+
+_shard_pools = {}
+_shard_pools_lock = threading.Lock()
+
+def _get_shard_pool(workers):
+    # Long-lived and spawned (forking a threaded Streamlit server isn't safe), so worker start-up is paid once
+    with _shard_pools_lock:
+        if workers not in _shard_pools: _shard_pools[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        return _shard_pools[workers]
+
+def sharded_analysis_parts(transactions, prices, history=None, workers=None):
+    workers = workers or os.cpu_count() or 1
+    columns, levels = _ledger_columns(transactions)
+    # Rows are ordered by person (a radix sort on narrow codes) and cut into runs of people holding about the
+    # same number of rows; rows without a person sort first and belong to no group. Workers do the gathering.
+    person = columns['person'].astype('int16' if len(levels[0]) < 2**15 else 'int64')
+    order = np.argsort(person, kind='stable')
+    person_starts = np.searchsorted(person[order], np.arange(len(levels[0]) + 1))
+    bounds = np.unique(person_starts[np.searchsorted(person_starts, np.linspace(person_starts[0], len(order), workers + 1))])
+    if len(bounds) <= 2: return _parts_from_columns(columns, levels, prices, history)
+
+    block = shared_memory.SharedMemory(create=True, size=len(order) * 8 * len(_SHARD_LAYOUT))
+    try:
+        for name, target in _shared_columns(block.buf, len(order)).items(): target[:] = order if name == 'order' else columns[name]
+        del target
+        pool = _get_shard_pool(workers)
+        futures = [pool.submit(_shard_parts, block.name, len(order), int(start), int(stop), levels, prices, history) for start, stop in zip(bounds[:-1], bounds[1:])]
+        shards = [future.result() for future in futures]
+    finally:
+        block.close(); block.unlink()
+    return {name: pd.concat([shard[name] for shard in shards]).sort_index() for name in shards[0]}
+
+# --- HISTORICAL VALUATION ---
+PRICE_HISTORY_TOLERANCE_DAYS = 7  # an as-of price older than this falls back to the current quote
+
+def _prices_asof(history, currencies, codes, dates, fallback):
+    # Vectorized as-of join: for each row, the last history price of its currency on or before its day,
+    # found by binary search over (currency, day) keys; rows without one keep the fallback price
+    if history is None or history.empty or not len(codes): return fallback
+    history_codes = currencies.get_indexer(history['currency'].astype(object))
+    known = history_codes >= 0
+    if not known.any(): return fallback
+    history_days = history['price_date'].to_numpy().astype('datetime64[D]').astype('int64')[known]
+    history_codes, history_prices = history_codes[known].astype('int64'), history['price'].to_numpy()[known]
+    order = np.lexsort((history_days, history_codes))
+    history_codes, history_days, history_prices = history_codes[order], history_days[order], history_prices[order]
+
+    days = dates.astype('datetime64[D]')
+    valid = (codes >= 0) & ~np.isnat(days)
+    days = np.where(valid, days.astype('int64'), 0)
+    position = np.searchsorted(history_codes * 2**32 + history_days, codes.astype('int64') * 2**32 + days, side='right') - 1
+    valid &= position >= 0
+    position = np.maximum(position, 0)
+    valid &= (history_codes[position] == codes) & (days - history_days[position] <= PRICE_HISTORY_TOLERANCE_DAYS)
+    return np.where(valid, history_prices[position], fallback)
+
+def portfolio_value_series(transactions, prices, history=None, opening=None):
+    # Daily USD value of each person's holdings in one pass over the ledger: signed legs summed into a
+    # (day, person, currency) grid, one cumsum down the days, then valued at each day's as-of price
+    # (today's quote where no history exists). Currencies with no price at all (toman) are left out.
+    # A closed-period summary (`opening`) goes in as one row per summed day.
+    if opening is not None and not opening.empty:
+        opening = opening[opening['day'].notna()]
+        days = opening[['person_name', 'input_currency', 'output_currency']].assign(
+            input_amount=_from_units(opening['input_units'], opening['input_currency']), output_amount=_from_units(opening['output_units'], opening['output_currency']),
+            transaction_date=pd.to_datetime(opening['day'], format='%Y-%m-%d'))
+        transactions = pd.concat([days, transactions.astype({col: object for col in CATEGORICAL_COLUMNS if col in transactions.columns})], ignore_index=True)
+    transactions = transactions[transactions['transaction_date'].notna()]
+    if transactions.empty: return pd.DataFrame()
+    person, people = _codes(transactions['person_name'])
+    currencies = pd.Index(_codes(transactions['input_currency'])[1]).union(_codes(transactions['output_currency'])[1])
+    in_cur, _ = _codes(transactions['input_currency'], currencies)
+    out_cur, _ = _codes(transactions['output_currency'], currencies)
+    day = transactions['transaction_date'].to_numpy().astype('datetime64[D]')
+    start, end = day.min(), max(day.max(), np.datetime64(pd.Timestamp.now().date(), 'D'))
+    dates = np.arange(start, end + 1)
+
+    history_currencies = set(history['currency'].astype(str)) if history is not None and not history.empty else set()
+    priced = np.array([c == 'USDT' or c in prices or c in history_currencies for c in currencies], dtype=bool)
+    legs_person, legs_currency = np.concatenate([person, person]), np.concatenate([in_cur, out_cur])
+    legs_amount = np.concatenate([-_amounts(transactions['input_amount']), _amounts(transactions['output_amount'])])
+    legs_day = np.tile((day - start).astype('int64'), 2)
+    keep = (legs_person >= 0) & (legs_currency >= 0)
+    keep[keep] = priced[legs_currency[keep]]
+    shape = (len(dates), len(people), len(currencies))
+    cells = np.ravel_multi_index((legs_day[keep], legs_person[keep], legs_currency[keep]), shape)
+    holdings = np.bincount(cells, weights=legs_amount[keep], minlength=int(np.prod(shape))).reshape(shape).cumsum(axis=0)
+
+    current = np.array([1.0 if c == 'USDT' else prices.get(c, np.nan) for c in currencies])
+    grid_codes = np.tile(np.arange(len(currencies)), len(dates))
+    price_grid = _prices_asof(history, currencies, grid_codes, np.repeat(dates, len(currencies)), current[grid_codes]).reshape(len(dates), len(currencies))
+    price_grid = np.where(priced, np.nan_to_num(price_grid), 0.0)
+    values = (holdings * price_grid[:, None, :]).sum(axis=2)
+    series = pd.DataFrame(values, index=pd.DatetimeIndex(dates.astype('datetime64[ns]'), name='date'), columns=pd.Index(np.asarray(people, dtype=object), name='person_name'))
+    return series.loc[:, (series != 0).any()]
+
+# --- TAX LOTS ---
+# Cost basis lot by lot: one queue of open lots per (person, currency), consumed in date order by the chosen
+# method. Toman and USDT are cash here and carry no lots.
+COST_BASIS_METHODS = {'fifo': 'First in, first out', 'lifo': 'Last in, first out', 'hifo': 'Highest cost first', 'average': 'Moving average'}
+LOT_CASH_CURRENCIES = {'IRR', 'USDT'}
+LOT_DUST = 1e-12
+OPEN_LOT_COLUMNS = ['person_name', 'currency', 'acquired', 'transaction_id', 'amount', 'unit_cost_usd']
+DISPOSAL_COLUMNS = ['person_name', 'currency', 'disposed', 'transaction_id', 'kind', 'acquired', 'lot_transaction_id', 'amount', 'proceeds_usd', 'cost_basis_usd']
+
+class LotState:
+    # Open lots and lot-level disposals after a chronological pass up to `position`, a (date, id) key.
+    # Queues are shared between copies until a later pass consumes from them; a lot is [amount, unit cost, acquired, id].
+    def __init__(self, method='fifo'):
+        if method not in COST_BASIS_METHODS: raise ValueError(f"unknown cost basis method: {method}")
+        self.method, self.position, self.lots, self.disposals = method, None, {}, []
+        self._owned, self._seq = set(), 0
+
+    def copy(self):
+        other = LotState(self.method)
+        other.position, other.lots, other.disposals, other._seq = self.position, dict(self.lots), list(self.disposals), self._seq
+        self._owned = set()  # neither side may now change a shared queue in place
+        return other
+
+    def open_lots(self, key):
+        queue = self.lots.get(key, ())
+        return [entry[2] for entry in queue] if self.method == 'hifo' else list(queue)
+
+    def _queue(self, key):
+        if key not in self._owned:
+            queue = self.lots.get(key, ())
+            if self.method == 'hifo': queue = [(cost, seq, lot[:]) for cost, seq, lot in queue]
+            else: queue = deque(lot[:] for lot in queue)
+            self.lots[key] = queue; self._owned.add(key)
+        return self.lots[key]
+
+    def acquire(self, key, amount, unit_cost, acquired, transaction_id):
+        queue = self._queue(key)
+        if self.method == 'hifo':
+            self._seq += 1
+            heapq.heappush(queue, (-unit_cost, self._seq, [amount, unit_cost, acquired, transaction_id]))
+        elif self.method == 'average' and queue:
+            lot = queue[0]  # one pooled lot at the running average cost
+            total = lot[0] + amount
+            if total > LOT_DUST: lot[1] = (lot[0] * lot[1] + amount * unit_cost) / total
+            lot[0] = total
+        else:
+            queue.append([amount, unit_cost, acquired, transaction_id])
+
+    def consume(self, key, amount):
+        # Takes `amount` from the open lots in method order; returns [(lot, amount taken)] plus what no lot covered
+        queue, taken = self._queue(key), []
+        while amount > LOT_DUST and queue:
+            lot = queue[0][2] if self.method == 'hifo' else queue[-1] if self.method == 'lifo' else queue[0]
+            take = min(lot[0], amount)
+            taken.append((lot, take))
+            lot[0] -= take; amount -= take
+            if lot[0] <= LOT_DUST:
+                if self.method == 'hifo': heapq.heappop(queue)
+                elif self.method == 'lifo': queue.pop()
+                else: queue.popleft()
+        return taken, max(amount, 0.0)
+
+def consume_lots(transactions, method='fifo', prices=None, history=None, state=None):
+    # One chronological streaming pass over buy, swap, sell and transfer rows. Given a saved state it carries on
+    # from there instead: the rows must then all sort after state.position, and only the lots they touch are copied.
+    state = LotState(method) if state is None else state.copy()
+    transactions = transactions[transactions['transaction_date'].notna()]
+    if transactions.empty: return state
+    transactions = transactions.sort_values(['transaction_date', 'id'], kind='stable')
+    first = (transactions['transaction_date'].iloc[0], transactions['id'].iloc[0])
+    if state.position is not None and first <= state.position: raise ValueError("rows must come after the saved lot state")
+
+    currencies = pd.Index(_codes(transactions['input_currency'])[1]).union(_codes(transactions['output_currency'])[1])
+    in_cur, _ = _codes(transactions['input_currency'], currencies)
+    out_cur, _ = _codes(transactions['output_currency'], currencies)
+    in_price, out_price = _row_prices(transactions['transaction_date'].to_numpy().astype('datetime64[D]'), currencies, in_cur, out_cur, prices or {}, history)
+    tracked = np.append(~currencies.isin(list(LOT_CASH_CURRENCIES)), False)  # code -1 lands on the trailing False
+    tx_type = transactions['transaction_type'].astype(object).to_numpy()
+    input_amount, output_amount, fee = _amounts(transactions['input_amount']), _amounts(transactions['output_amount']), _amounts(transactions['fee'])
+    disposes = np.isin(tx_type, ['sell', 'swap']) & tracked[in_cur]
+    pays_transfer_fee = (tx_type == 'transfer') & tracked[in_cur] & (input_amount - output_amount > LOT_DUST)
+    acquires = np.isin(tx_type, ['buy_crypto_with_usdt', 'swap']) & tracked[out_cur] & (output_amount > LOT_DUST)
+    proceeds = output_amount * out_price - fee
+    unit_cost = np.divide(input_amount * in_price + fee, output_amount, out=np.zeros(len(output_amount)), where=output_amount > LOT_DUST)
+
+    # Only the rows that touch lots reach the Python loop, as plain lists
+    rows = np.flatnonzero(disposes | pays_transfer_fee | acquires)
+    columns = [transactions['person_name'].astype(object).to_numpy(), transactions['input_currency'].astype(object).to_numpy(),
+               transactions['output_currency'].astype(object).to_numpy(), transactions['transaction_date'].to_numpy(),
+               transactions['id'].astype(object).to_numpy(), tx_type, disposes, pays_transfer_fee, acquires,
+               input_amount, output_amount, proceeds, unit_cost]
+    disposals = []
+    for person, in_label, out_label, date, tx_id, kind, disposal, transfer_fee, acquisition, spent, received, total, cost in zip(*(column[rows].tolist() for column in columns)):
+        if disposal or transfer_fee:
+            # A transfer only loses its network fee; that cost is reported under fees, not as a realized loss
+            amount = spent if disposal else spent - received
+            if transfer_fee: kind, total = 'transfer_fee', 0.0
+            taken, uncovered = state.consume((person, in_label), amount)
+            for lot, take in taken: disposals.append((person, in_label, date, tx_id, kind, lot[2], lot[3], take, total * take / amount, take * lot[1]))
+            if uncovered > LOT_DUST: disposals.append((person, in_label, date, tx_id, kind, None, None, uncovered, total * uncovered / amount, 0.0))
+        if acquisition: state.acquire((person, out_label), received, cost, date, tx_id)
+    if disposals: state.disposals.append(disposals)
+    state.position = (transactions['transaction_date'].iloc[-1], transactions['id'].iloc[-1])
+    return state
+
+def open_lots_frame(state):
+    rows = [(person, currency, *lot[2:], lot[0], lot[1]) for (person, currency) in state.lots for lot in state.open_lots((person, currency)) if lot[0] > LOT_DUST]
+    frame = pd.DataFrame(rows, columns=OPEN_LOT_COLUMNS)
+    frame['acquired'] = pd.to_datetime(frame['acquired'])
+    frame['cost_usd'] = frame['amount'] * frame['unit_cost_usd']
+    return frame.sort_values(['person_name', 'currency', 'acquired'], ignore_index=True)
+
+def disposals_frame(state):
+    frame = pd.DataFrame([row for chunk in state.disposals for row in chunk], columns=DISPOSAL_COLUMNS)
+    for col in ('disposed', 'acquired'): frame[col] = pd.to_datetime(frame[col])
+    frame['realized_pnl'] = np.where(frame['kind'] == 'transfer_fee', 0.0, frame['proceeds_usd'] - frame['cost_basis_usd'])
+    return frame
+
+def update_lot_cache(cache, snapshot, prices, method='fifo', history=None, history_version=0):
+    # (open lots, disposals) under cache['result']; writes that only append rows dated after the last one
+    # processed resume from the saved lot state, anything else replays the ledger
+    key = (method, _price_key(prices), history_version)
+    state = None
+    if cache is not None and cache['key'] == key:
+        if cache['version'] == snapshot.version: return cache
+        pending = [change for change in snapshot.changes if change[0] > cache['version']]
+        if len(pending) == snapshot.version - cache['version'] and all(old_row is None for _, old_row, _ in pending):
+            appended = _ensure_data_types(pd.DataFrame([new_row for _, _, new_row in pending]))
+            first = appended.sort_values(['transaction_date', 'id']).iloc[0]
+            saved = cache['state']
+            if saved.position is None or (first['transaction_date'], first['id']) > saved.position:
+                state = consume_lots(appended, method, prices, history, saved)
+    closed = _closed_lot_state(cache, snapshot.closed, key, method, prices, history)
+    if state is None: state = consume_lots(snapshot.transactions, method, prices, history, closed[1])
+    return {'key': key, 'version': snapshot.version, 'closed': closed, 'state': state, 'result': (open_lots_frame(state), disposals_frame(state))}
+
+def _closed_lot_state(cache, closed, key, method, prices, history=None):
+    # (key, lot state) at the end of the closed periods: replayed from the archive once, then every rebuild resumes
+    # from it until the next close, price change or back-fill
+    if closed is None: return None, None
+    closed_key = (closed.open_from, key)
+    if cache is not None and cache.get('closed', (None,))[0] == closed_key: return cache['closed']
+    return closed_key, consume_lots(closed.archived_transactions(), method, prices, history)
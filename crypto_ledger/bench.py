@@ -0,0 +1,189 @@
+# Synthetic ledgers and the benchmark suite: a deterministic generator of valid ledgers of any size, and timings
+# of the hot paths (store load, sorted view, balances, writes, analysis) saved as JSON to compare between commits.
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+from itertools import cycle
+import numpy as np
+import pandas as pd
+from . import db
+from .db import unit_scale
+from .store import TRANSACTION_TYPE_LABELS, PEOPLE, CURRENCIES, LedgerSnapshot, get_ledger_store, get_current_balance, import_transactions_csv, _ledger_stores, _snapshot_files
+from .analysis import generate_financial_analysis
+
+# --- SYNTHETIC LEDGER ---
+# Reference quotes the rows are priced around (each row jitters them) and the share of each transaction type
+SYNTHETIC_PRICES = {'USDT': 1.0, 'BTC': 60_000.0, 'ETH': 3_000.0, 'BNB': 550.0, 'SOL': 150.0, 'XRP': 0.5, 'USDC': 1.0, 'ADA': 0.45, 'DOGE': 0.12, 'DOT': 6.5, 'PAXG': 2_400.0}
+SYNTHETIC_TOMAN_RATE = 600_000  # rials per USDT
+SYNTHETIC_TYPE_SHARES = {'buy_usdt_with_toman': 0.15, 'buy_crypto_with_usdt': 0.3, 'sell': 0.2, 'transfer': 0.1, 'swap': 0.25}
+SYNTHETIC_SPAN = ('2020-01-01', '2025-01-01')  # the rows spread evenly over these five years, whatever their number
+MAX_SYNTHETIC_BLOCK = 10_000
+FEE_SHARE, SPREAD_SHARE, TRANSFER_FEE_SHARE = 0.001, 0.005, 0.001
+
+def synthetic_people(count):
+    return PEOPLE[:count] + [f"person{n}" for n in range(len(PEOPLE) + 1, count + 1)]
+
+def synthetic_ledger(rows, people=len(PEOPLE), seed=0):
+    # Yields the ledger as frames in import format, oldest first: every type, every currency, `people` people.
+    # The same (rows, people, seed) always gives the same ledger. Rows are drawn in blocks against the balances
+    # at the block's start: each (person, currency) spends at most its opening balance across the block, and a
+    # spend with nothing to spend becomes a toman buy, so no balance goes negative in any order within it.
+    # Toman is funded externally, as in the app, so IRR is the only currency allowed below zero.
+    rng = np.random.default_rng(seed)
+    names, types = np.array(synthetic_people(people)), np.array(list(TRANSACTION_TYPE_LABELS))
+    shares = np.array([SYNTHETIC_TYPE_SHARES[t] for t in types])
+    # Currency codes index CURRENCIES (0 is USDT), and -1 is the last slot, IRR
+    currencies = np.array(CURRENCIES + ['IRR'])
+    scales = np.array([unit_scale(c) for c in currencies], dtype='int64')
+    quotes = np.array([SYNTHETIC_PRICES[c] for c in CURRENCIES] + [1 / SYNTHETIC_TOMAN_RATE])
+    balances = np.zeros((people, len(currencies)), dtype='int64')
+    start, end = (pd.Timestamp(day) for day in SYNTHETIC_SPAN)
+    step, done, size = (end - start) / max(rows, 1), 0, 16
+    while done < rows:
+        n = min(size, rows - done); size = min(size * 2, MAX_SYNTHETIC_BLOCK)
+        person = rng.integers(people, size=n)
+        kind = types[rng.choice(len(types), size=n, p=shares / shares.sum())]
+        crypto, any_currency = rng.integers(1, len(CURRENCIES), size=n), rng.integers(len(CURRENCIES), size=n)
+        other = (any_currency + rng.integers(1, len(CURRENCIES), size=n)) % len(CURRENCIES)
+        share, jitter_in, jitter_out = rng.random(n), np.exp(rng.normal(0, 0.05, n)), np.exp(rng.normal(0, 0.05, n))
+        rials = rng.integers(10_000_000, 2_000_000_000, size=n)
+        seconds = ((done + np.arange(n) + rng.random(n)) * step.total_seconds()).astype('int64')
+
+        in_cur = np.select([kind == 'buy_usdt_with_toman', kind == 'buy_crypto_with_usdt', kind == 'sell'], [-1, 0, crypto], any_currency)
+        out_cur = np.select([np.isin(kind, ['buy_usdt_with_toman', 'sell']), kind == 'buy_crypto_with_usdt', kind == 'transfer'], [0, crypto, any_currency], other)
+        available = balances[person, in_cur]
+        broke = (in_cur >= 0) & (available <= 0)
+        kind[broke], in_cur[broke], out_cur[broke] = 'buy_usdt_with_toman', -1, 0
+        spends = in_cur >= 0
+        key = person * len(currencies) + in_cur
+        spenders = np.bincount(key[spends], minlength=balances.size)[key]
+        in_units = np.where(spends, np.minimum(np.floor(share * available / np.maximum(spenders, 1)).astype('int64'), available // np.maximum(spenders, 1)), rials)
+
+        in_price = quotes[in_cur] * jitter_in
+        out_price = np.where(kind == 'transfer', in_price, quotes[out_cur] * jitter_out)
+        value_usd = in_units / scales[in_cur] * in_price
+        fee = np.where(np.isin(kind, ['buy_crypto_with_usdt', 'sell', 'swap']), np.round(value_usd * FEE_SHARE, 2), 0.0)
+        kept = np.select([kind == 'buy_usdt_with_toman', kind == 'transfer'], [1 - SPREAD_SHARE, 1 - TRANSFER_FEE_SHARE], 1 - 2 * FEE_SHARE)
+        out_units = np.floor(value_usd * kept / out_price * scales[out_cur]).astype('int64')
+        np.subtract.at(balances, (person[spends], in_cur[spends]), in_units[spends])
+        np.add.at(balances, (person, out_cur), out_units)
+
+        yield pd.DataFrame({
+            'transaction_type': kind, 'person_name': names[person], 'transaction_date': start + pd.to_timedelta(seconds, unit='s'),
+            'input_currency': currencies[in_cur], 'output_currency': currencies[out_cur],
+            'input_amount': in_units / scales[in_cur], 'output_amount': out_units / scales[out_cur],
+            'rate': np.where(kind == 'buy_usdt_with_toman', np.round(SYNTHETIC_TOMAN_RATE * jitter_in), 0.0), 'fee': fee, 'notes': '',
+        })
+        done += n
+
+def write_synthetic_csv(destination, rows, people=len(PEOPLE), seed=0):
+    # `destination` is a text file opened with newline=''; the file imports as it is
+    for number, chunk in enumerate(synthetic_ledger(rows, people, seed)):
+        chunk.to_csv(destination, header=number == 0, index=False, date_format='%Y-%m-%d %H:%M:%S')
+    return rows
+
+def build_synthetic_database(rows, people=len(PEOPLE), seed=0, chunk_size=50_000):
+    # Loads the ledger into the current database through the regular CSV import, so its running-balance
+    # check vouches for the generator too
+    with tempfile.TemporaryFile('w+', newline='', encoding='utf-8') as f:
+        write_synthetic_csv(f, rows, people, seed); f.seek(0)
+        result = import_transactions_csv(f, chunk_size=chunk_size)
+    if result['error_count']: raise ValueError(f"synthetic ledger was rejected: {result['errors'][:3]}")
+    return result['imported']
+
+# --- BENCHMARKS ---
+def _timed(run, repeat, number=1, setup=None):
+    # Seconds per call over `repeat` rounds of `number` calls; `setup` runs untimed before each round
+    times = []
+    for _ in range(repeat):
+        if setup is not None: setup()
+        started = time.perf_counter()
+        for _ in range(number): run()
+        times.append((time.perf_counter() - started) / number)
+    return {'repeat': repeat, 'number': number, 'min': min(times), 'median': statistics.median(times), 'mean': statistics.fmean(times)}
+
+def _cold_store(snapshot_file):
+    # The next get_ledger_store() loads from scratch: from the Arrow snapshot file, or from SQLite without one
+    def setup():
+        store = _ledger_stores.pop(db.DB_FILE, None)
+        if store is not None: store.wait_for_snapshot_file()  # its background write would race the removal
+        if snapshot_file: return
+        for path in _snapshot_files().values(): os.remove(path)
+    return setup
+
+def benchmark_ledger(repeat=5, write_repeat=20):
+    # Times the current database's hot paths, named after the app functions that run them (utils.py only adds
+    # session state on top). Writes are dated in the open period and removed again, leaving the ledger as it was.
+    results = {'initialize_state_sqlite': _timed(get_ledger_store, repeat, setup=_cold_store(False))}
+    get_ledger_store().wait_for_snapshot_file()  # a load from SQLite writes the snapshot file the next ones map
+    results['initialize_state'] = _timed(get_ledger_store, repeat, setup=_cold_store(True))
+    store = get_ledger_store()
+
+    snapshot = store.snapshot
+    fresh = lambda: LedgerSnapshot(snapshot.version, snapshot.transactions, snapshot.balances)  # nothing sorted yet
+    results['get_all_transactions'] = _timed(lambda: fresh().sorted_transactions(), repeat)
+    pairs = sorted(snapshot.balances) or [(PEOPLE[0], 'USDT')]
+    balances = cycle(pairs)
+    results['get_current_balance'] = _timed(lambda: get_current_balance(*next(balances)), repeat, number=1_000)
+
+    last = snapshot.transactions['transaction_date'].max()
+    day = (last if pd.notna(last) else pd.Timestamp.now()).floor('s')
+    row = {'transaction_type': 'buy_usdt_with_toman', 'person_name': pairs[0][0], 'transaction_date': str(day), 'input_currency': 'IRR', 'output_currency': 'USDT',
+           'input_amount': 60_000_000, 'output_amount': 99.5, 'rate': SYNTHETIC_TOMAN_RATE, 'fee': 0.0, 'notes': 'benchmark'}
+    added = []
+    results['add_transaction'] = _timed(lambda: added.append(int(store.add(row).transactions['id'].iloc[-1])), write_repeat)
+    edits = iter(added)
+    results['update_transaction'] = _timed(lambda: store.update(next(edits), {'output_amount': 99.25, 'notes': 'benchmark edit'}), write_repeat)
+    deletes = iter(added)
+    results['delete_transaction'] = _timed(lambda: store.delete(next(deletes)), write_repeat)
+
+    transactions = store.snapshot.transactions
+    results['generate_financial_analysis'] = _timed(lambda: generate_financial_analysis(transactions, SYNTHETIC_PRICES), repeat)
+    store.wait_for_snapshot_file()
+    return results
+
+def run_benchmarks(sizes, people=len(PEOPLE), seed=0, repeat=5, write_repeat=20, folder=None):
+    # A fresh synthetic database per size, in `folder` (kept) or a temporary directory; the app's database is untouched
+    report = {'created': datetime.now().isoformat(timespec='seconds'), 'environment': benchmark_environment(), 'people': people, 'seed': seed, 'runs': []}
+    previous = db.DB_FILE
+    if folder: os.makedirs(folder, exist_ok=True)
+    with tempfile.TemporaryDirectory() as scratch:
+        try:
+            for rows in sizes:
+                db.set_database_file(os.path.join(folder or scratch, f"synthetic_{rows}_{people}_{seed}.db"))
+                if os.path.exists(db.DB_FILE): raise ValueError(f"{db.DB_FILE} already exists")
+                started = time.perf_counter()
+                build_synthetic_database(rows, people, seed)
+                run = {'rows': rows, 'build_seconds': time.perf_counter() - started, 'timings': benchmark_ledger(repeat, write_repeat)}
+                report['runs'].append(run)
+                _ledger_stores.pop(db.DB_FILE, None)
+        finally:
+            db.set_database_file(previous)
+    return report
+
+# --- RESULTS ---
+def benchmark_environment():
+    def git(*args):
+        try: return subprocess.run(['git', *args], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, timeout=10).stdout.strip() or None
+        except (OSError, subprocess.SubprocessError): return None
+    return {'commit': git('rev-parse', 'HEAD'), 'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+            'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'pandas': pd.__version__, 'numpy': np.__version__, 'sqlite': sqlite3.sqlite_version}
+
+def save_benchmarks(report, path):
+    with open(path, 'w', encoding='utf-8') as f: json.dump(report, f, indent=2)
+
+def load_benchmarks(path):
+    with open(path, encoding='utf-8') as f: return json.load(f)
+
+def compare_benchmarks(baseline, current):
+    # (rows, benchmark, baseline median, current median, current / baseline) for every timing both reports have
+    before = {(run['rows'], name): timing['median'] for run in baseline['runs'] for name, timing in run['timings'].items()}
+    return [(run['rows'], name, before[run['rows'], name], timing['median'], timing['median'] / before[run['rows'], name] if before[run['rows'], name] else float('inf'))
+            for run in current['runs'] for name, timing in run['timings'].items() if (run['rows'], name) in before]
@@ -0,0 +1,240 @@
+# Headless entry point: python -m crypto_ledger {report,balances,import,export,close,prices,generate,bench}. Each command imports only
+# what it needs, so `balances` answers from SQLite without loading pandas.
+import argparse
+import json
+import sys
+import time
+from . import db, perf
+
+def _print_table(title, frame, as_json, out):
+    if as_json: out[title] = json.loads(frame.to_json(orient='records', date_format='iso'))
+    else: print(f"\n{title}\n" + (frame.to_string(index=False) if not frame.empty else "(none)"))
+
+def _cached_prices(symbols, refresh):
+    # The app's last good quotes; --refresh-prices fetches the symbols first and updates that cache
+    from .prices import price_cache_file, read_price_cache, write_price_cache, fetch_prices
+    path = price_cache_file()
+    quotes = read_price_cache(path)
+    if refresh:
+        try: fetched = fetch_prices(symbols)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not refresh prices ({e}); using cached quotes.", file=sys.stderr); fetched = {}
+        now = time.time()
+        quotes.update({symbol: (price, now) for symbol, price in fetched.items()})
+        if fetched: write_price_cache(path, quotes)
+    prices = {symbol: price for symbol, (price, _) in quotes.items()}
+    prices['USDT'] = 1.0
+    return prices
+
+def cmd_report(args):
+    from .store import get_ledger_store
+    from .prices import get_price_history
+    from .analysis import generate_financial_analysis, consume_lots, disposals_frame
+    store = get_ledger_store()
+    snapshot = store.snapshot
+    transactions, closed = snapshot.transactions, snapshot.closed
+    opening = closed.summary if closed is not None else None
+    if args.person:
+        transactions = transactions[transactions['person_name'].isin(args.person)]
+        if opening is not None: opening = opening[opening['person_name'].isin(args.person)]
+    prices = _cached_prices(snapshot.symbols(), args.refresh_prices)
+    _, history = get_price_history()
+    portfolio, toman, realized, fees = generate_financial_analysis(transactions, prices, history, workers=args.workers, opening=opening)
+    out = {}
+    _print_table('portfolio', portfolio, args.json, out)
+    _print_table('realized_pnl', realized, args.json, out)
+    _print_table('toman_exchange', toman, args.json, out)
+    _print_table('fees', fees, args.json, out)
+    if args.method:
+        state = None
+        if closed is not None:  # lots carried out of the closed periods
+            archived = closed.archived_transactions()
+            if args.person: archived = archived[archived['person_name'].isin(args.person)]
+            state = consume_lots(archived, args.method, prices, history)
+        disposals = disposals_frame(consume_lots(transactions, args.method, prices, history, state))
+        lots = disposals.groupby(['person_name', 'currency'], as_index=False)[['proceeds_usd', 'cost_basis_usd', 'realized_pnl']].sum() if not disposals.empty else disposals
+        _print_table(f'realized_by_lot_{args.method}', lots, args.json, out)
+    if args.json: print(json.dumps(out, indent=2))
+    store.wait_for_snapshot_file()
+    return 0
+
+def cmd_balances(args):
+    where, params = " WHERE amount != 0", []
+    if args.person:
+        where += f" AND person_name IN ({', '.join('?' * len(args.person))})"; params += args.person
+    with db.db_connection() as conn:
+        rows = [(p, c, db.from_units(a, c)) for p, c, a in conn.execute(f"SELECT person_name, currency, amount FROM balances{where} ORDER BY person_name, currency", params)]
+    if args.json: print(json.dumps([{'person_name': p, 'currency': c, 'amount': a} for p, c, a in rows], indent=2)); return 0
+    if not rows: print("(no balances)"); return 0
+    width = max(len(p) for p, _, _ in rows)
+    for person, currency, amount in rows: print(f"{person:<{width}}  {currency:<6} {amount:>24,.8f}")
+    return 0
+
+def cmd_import(args):
+    from .store import import_transactions_csv
+    started = time.perf_counter()
+    try:
+        result = import_transactions_csv(args.csv_file, person_name=args.person, chunk_size=args.chunk_size)
+    except (OSError, ValueError) as e:
+        print(f"Import failed: {e}", file=sys.stderr); return 2
+    if result['imported']:
+        print(f"Imported {result['imported']:,} transactions in {time.perf_counter() - started:.1f}s.")
+        return 0
+    if result['error_count'] == 0:
+        print("The file has no transactions to import."); return 0
+    print(f"Nothing was imported: {result['error_count']:,} problem(s) found.", file=sys.stderr)
+    for line, problem in result['errors']: print(f"  line {line}: {problem}", file=sys.stderr)
+    return 1
+
+def cmd_export(args):
+    from .export import transaction_rows, frame_rows, write_csv, write_xlsx
+    fmt = args.format or ('xlsx' if (args.output or '').lower().endswith('.xlsx') else 'csv')
+    if args.report == 'transactions':
+        filters = dict(person=args.person, currencies=args.currency, transaction_types=args.type, start_date=args.start, end_date=args.end)
+        rows = transaction_rows(archived=not args.open_only, **filters)
+    else:
+        from .prices import get_price_history
+        from .summary import YEARLY_REPORTS, ledger_symbols
+        _, history = get_price_history()
+        rows = frame_rows(YEARLY_REPORTS[args.report](_cached_prices(ledger_symbols(), args.refresh_prices), history, args.person))
+    to_stdout = args.output in (None, '-')
+    if fmt == 'xlsx':
+        written = write_xlsx(rows, sys.stdout.buffer if to_stdout else args.output, args.report)
+    elif to_stdout: written = write_csv(rows, sys.stdout)
+    else:
+        with open(args.output, 'w', newline='', encoding='utf-8') as f: written = write_csv(rows, f)
+    print(f"Exported {written:,} {'transactions' if args.report == 'transactions' else 'rows'}.", file=sys.stderr)
+    return 0
+
+def cmd_close(args):
+    from .store import close_period
+    try:
+        result = close_period(args.through)
+    except ValueError as e:
+        print(f"Close failed: {e}", file=sys.stderr); return 2
+    print(f"Archived {result['archived']:,} transactions; the ledger is open from {result['open_from']}.")
+    return 0
+
+def cmd_prices_import(args):
+    from .prices import import_price_history_csv
+    try:
+        saved = import_price_history_csv(args.price_file)
+    except (OSError, ValueError) as e:
+        print(f"Price import failed: {e}", file=sys.stderr); return 2
+    print(f"Saved {saved:,} daily prices." if saved else "The file has no prices to save.")
+    return 0
+
+def cmd_prices_backfill(args):
+    from .prices import backfill_price_history
+    from .summary import ledger_symbols
+    symbols = args.symbol or ledger_symbols()
+    saved = backfill_price_history(symbols, args.days)
+    for symbol, days in saved.items(): print(f"{symbol:<6} {days:>6,} days")
+    missed = [s for s in symbols if s not in saved and s != 'USDT']
+    if missed: print(f"No prices downloaded for {', '.join(missed)}.", file=sys.stderr)
+    return 1 if missed else 0
+
+def _row_count(value):
+    return int(float(value))  # so 1e6 works as well as 1000000
+
+def cmd_generate(args):
+    from .bench import write_synthetic_csv
+    if args.output in (None, '-'): write_synthetic_csv(sys.stdout, args.rows, args.people, args.seed)
+    else:
+        with open(args.output, 'w', newline='', encoding='utf-8') as f: write_synthetic_csv(f, args.rows, args.people, args.seed)
+    print(f"Generated {args.rows:,} transactions.", file=sys.stderr)
+    return 0
+
+def cmd_bench(args):
+    from .bench import run_benchmarks, save_benchmarks, load_benchmarks, compare_benchmarks
+    baseline = load_benchmarks(args.compare) if args.compare else None  # read first: a bad path fails before the run
+    report = run_benchmarks(args.rows or [1_000, 100_000], args.people, args.seed, args.repeat, args.write_repeat, args.keep)
+    if args.output: save_benchmarks(report, args.output)
+    for run in report['runs']:
+        print(f"\n{run['rows']:,} rows (built in {run['build_seconds']:.1f}s)")
+        for name, timing in run['timings'].items(): print(f"  {name:<28} {timing['median'] * 1e3:>12.3f} ms  (min {timing['min'] * 1e3:.3f})")
+    if baseline is None: return 0
+    slower = 0
+    print(f"\nAgainst {args.compare} ({(baseline['environment'].get('commit') or '?')[:10]}):")
+    for rows, name, before, after, ratio in compare_benchmarks(baseline, report):
+        flag = " <- slower" if ratio > 1 + args.threshold else ""
+        slower += bool(flag)
+        print(f"  {rows:>10,} {name:<28} {before * 1e3:>12.3f} -> {after * 1e3:>12.3f} ms  x{ratio:.2f}{flag}")
+    return 1 if slower else 0
+
+def main(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--db", help="Database file (defaults to the app's crypto_transactions.db)")
+    parser = argparse.ArgumentParser(prog="crypto_ledger", description="Reports and maintenance for the crypto transactions ledger, without the app.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    report = commands.add_parser("report", parents=[common], help="Portfolio, realized P/L, toman and fee summaries")
+    report.add_argument("--person", action="append", help="Only this person (repeatable)")
+    report.add_argument("--method", choices=['fifo', 'lifo', 'hifo', 'average'], help="Also report realized P/L by tax lot")
+    report.add_argument("--refresh-prices", action="store_true", help="Fetch current prices instead of using the cached quotes")
+    report.add_argument("--workers", type=int, help="Processes to shard a large ledger's analysis across, by person (default: $CRYPTO_ANALYSIS_WORKERS or 1)")
+    report.add_argument("--json", action="store_true", help="Print JSON instead of tables")
+    report.set_defaults(run=cmd_report)
+
+    balances = commands.add_parser("balances", parents=[common], help="Current balance per person and currency")
+    balances.add_argument("--person", action="append", help="Only this person (repeatable)")
+    balances.add_argument("--json", action="store_true", help="Print JSON instead of a table")
+    balances.set_defaults(run=cmd_balances)
+
+    importer = commands.add_parser("import", parents=[common], help="Import a CSV export into the ledger")
+    importer.add_argument("csv_file", help="Path to the CSV export")
+    importer.add_argument("--person", help="Person to record the rows under when the file has no person column")
+    importer.add_argument("--chunk-size", type=int, default=50_000, help="Rows read and written per batch")
+    importer.set_defaults(run=cmd_import)
+
+    export = commands.add_parser("export", parents=[common], help="Write transactions (oldest first) or a yearly report to CSV or XLSX, streamed in bounded memory")
+    export.add_argument("-o", "--output", help="Output file (default: standard output)")
+    export.add_argument("--report", choices=['transactions', 'realized_pnl', 'fees'], default='transactions', help="What to export: every transaction, or realized P/L or fees per person and year")
+    export.add_argument("--format", choices=['csv', 'xlsx'], help="File format (default: xlsx for a .xlsx output file, otherwise csv)")
+    export.add_argument("--person", action="append", help="Only this person (repeatable)")
+    export.add_argument("--currency", action="append", help="Only rows in or out of this currency (repeatable)")
+    export.add_argument("--type", action="append", help="Only this transaction type (repeatable)")
+    export.add_argument("--start", help="First date to include (YYYY-MM-DD)")
+    export.add_argument("--end", help="Last date to include (YYYY-MM-DD)")
+    export.add_argument("--open-only", action="store_true", help="Leave out transactions archived by period closes")
+    export.add_argument("--refresh-prices", action="store_true", help="Fetch current prices for the reports instead of using the cached quotes")
+    export.set_defaults(run=cmd_export)
+
+    close = commands.add_parser("close", parents=[common], help="Close a period: archive its transactions and checkpoint balances and summaries")
+    close.add_argument("through", help="Last day of the period to close (YYYY-MM-DD); later writes can't be dated on or before it")
+    close.set_defaults(run=cmd_close)
+
+    prices = commands.add_parser("prices", help="Load the daily price history past days are valued at")
+    price_commands = prices.add_subparsers(dest="price_command", required=True)
+    price_import = price_commands.add_parser("import", parents=[common], help="Save daily prices from a CSV: date plus one column per currency, or date, currency, price")
+    price_import.add_argument("price_file", help="Path to the CSV file")
+    price_import.set_defaults(run=cmd_prices_import)
+    price_backfill = price_commands.add_parser("backfill", parents=[common], help="Download daily closes from the price provider")
+    price_backfill.add_argument("--symbol", action="append", help="Only this currency (repeatable; default: every currency in the ledger)")
+    price_backfill.add_argument("--days", type=int, default=365, help="Days back from today (default: 365)")
+    price_backfill.set_defaults(run=cmd_prices_backfill)
+
+    generate = commands.add_parser("generate", help="Write a synthetic ledger as an importable CSV: every type and currency, no negative balances")
+    generate.add_argument("rows", type=_row_count, help="Number of transactions, e.g. 1e6")
+    generate.add_argument("-o", "--output", help="Output file (default: standard output)")
+    generate.add_argument("--people", type=int, default=4, help="Number of people (default: 4)")
+    generate.add_argument("--seed", type=int, default=0, help="Random seed; the same rows, people and seed give the same ledger")
+    generate.set_defaults(run=cmd_generate)
+
+    bench = commands.add_parser("bench", help="Time loading, balances, writes and analysis on synthetic ledgers; the app's database is not touched")
+    bench.add_argument("--rows", type=_row_count, action="append", help="Ledger size to benchmark (repeatable; default: 1e3 and 1e5)")
+    bench.add_argument("--people", type=int, default=4, help="Number of people (default: 4)")
+    bench.add_argument("--seed", type=int, default=0, help="Random seed of the synthetic ledgers")
+    bench.add_argument("--repeat", type=int, default=5, help="Timed rounds per benchmark (default: 5)")
+    bench.add_argument("--write-repeat", type=int, default=20, help="Transactions added, updated and deleted (default: 20)")
+    bench.add_argument("-o", "--output", help="Save the results as JSON")
+    bench.add_argument("--compare", help="Results JSON of an earlier run to compare medians against; exits 1 when anything got slower")
+    bench.add_argument("--threshold", type=float, default=0.25, help="Slowdown tolerated by --compare, as a fraction (default: 0.25)")
+    bench.add_argument("--keep", metavar="DIR", help="Build the synthetic databases in DIR and keep them")
+    bench.set_defaults(run=cmd_bench)
+
+    args = parser.parse_args(argv)
+    if getattr(args, 'db', None): db.set_database_file(args.db)
+    perf.start_run(f"cli {args.command}")  # only with $CRYPTO_LEDGER_PERF set
+    try: return args.run(args)
+    finally: perf.finish_run(); perf.flush_log()
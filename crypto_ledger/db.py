@@ -0,0 +1,435 @@
+# SQLite plumbing shared by the app, the CLI and scripts: database location, schema migrations and the
+# connection pool. Standard library only, so commands that just read the database start instantly.
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from . import perf
+
+# --- DATABASE SETUP ---
+if getattr(sys, 'frozen', False):
+    base_path = os.path.dirname(sys.executable)
+else:
+    # This part is tricky when running from a .bat file, let's make it more robust
+    # We assume the .bat file is inside the main app folder, where utils.py and this package also are.
+    base_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_FILE = os.path.join(base_path, "crypto_transactions.db")
+
+TRANSACTION_COLUMNS = ['id', 'transaction_type', 'person_name', 'transaction_date', 'input_currency', 'output_currency', 'input_amount', 'output_amount', 'rate', 'fee', 'notes']
+TRANSACTION_SELECT = ', '.join(TRANSACTION_COLUMNS)
+# Derived at write time by SQLite (generated columns): fee_usd is the part of the fee already in USD (the explicit
+# fee, or the spread hidden in a toman buy's rate), fee_amount a transfer's fee in the transferred currency
+DERIVED_COLUMN_SQL = {
+    'fee_usd': "CASE transaction_type WHEN 'buy_usdt_with_toman' THEN CASE WHEN rate != 0 THEN COALESCE(input_amount, 0) * 1.0 / rate - COALESCE(output_amount, 0) ELSE 0.0 END "
+               "WHEN 'transfer' THEN 0.0 ELSE COALESCE(fee, 0.0) END",
+    'fee_amount': "CASE WHEN transaction_type = 'transfer' THEN COALESCE(input_amount, 0) - COALESCE(output_amount, 0) ELSE 0.0 END",
+}
+LEDGER_COLUMNS = TRANSACTION_COLUMNS + list(DERIVED_COLUMN_SQL)
+LEDGER_SELECT = ', '.join(LEDGER_COLUMNS)
+# Amounts are stored as integers in the smallest unit of their currency: toman has none, every other currency
+# is kept to 8 decimals (a satoshi). input_amount and output_amount read them back as REAL virtual columns;
+# writes go to the units columns, so the tables are written through STORED_COLUMNS.
+AMOUNT_DECIMALS = {'IRR': 0}
+DEFAULT_AMOUNT_DECIMALS = 8
+AMOUNT_UNITS = {'input_amount': ('input_units', 'input_currency'), 'output_amount': ('output_units', 'output_currency')}
+STORED_COLUMNS = [AMOUNT_UNITS[c][0] if c in AMOUNT_UNITS else c for c in TRANSACTION_COLUMNS]
+STORED_SELECT = ', '.join(STORED_COLUMNS)
+SQLITE_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",      # readers never block the writer and vice versa
+    "PRAGMA synchronous = NORMAL",    # durable at checkpoints, safe with WAL
+    "PRAGMA cache_size = -32000",     # ~32 MB page cache per connection
+    "PRAGMA mmap_size = 268435456",   # read pages straight from the OS cache
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+]
+
+# --- FIXED-POINT AMOUNTS ---
+def unit_scale(currency):
+    return 10 ** AMOUNT_DECIMALS.get(currency, DEFAULT_AMOUNT_DECIMALS)
+
+def to_units(amount, currency):
+    # Rounds to the currency's precision; a missing amount counts as none
+    if amount is None or amount != amount: return 0
+    return int(round(float(amount) * unit_scale(currency)))
+
+def from_units(units, currency):
+    return units / unit_scale(currency)
+
+def _scale_sql(currency):
+    return f"CASE {currency} {' '.join(f'WHEN {code!r} THEN {10 ** d}' for code, d in AMOUNT_DECIMALS.items())} ELSE {10 ** DEFAULT_AMOUNT_DECIMALS} END"
+
+def _units_sql(amount, currency):
+    # Integer units of an amount; exact for amounts read back from units, so sums over it are integer sums
+    return f"CAST(ROUND({amount} * {_scale_sql(currency)}) AS INTEGER)"
+
+def _amount_sql(units, currency):
+    return f"CAST({units} AS REAL) / {_scale_sql(currency)}"
+
+# --- SCHEMA MIGRATIONS ---
+# Applied in order, once, tracked through PRAGMA user_version
+def _create_transactions_table(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS transactions (
+        id TEXT PRIMARY KEY, transaction_type TEXT, person_name TEXT, transaction_date TEXT,
+        input_currency TEXT, output_currency TEXT, input_amount REAL, output_amount REAL,
+        rate REAL, fee REAL, notes TEXT
+    )''')
+
+def _create_balances_table(conn):
+    # Materialized running balance per (person, currency) in integer units, kept in step with every write
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS balances (
+        person_name TEXT NOT NULL, currency TEXT NOT NULL, amount INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (person_name, currency)
+    )''')
+    _rebuild_balances(conn)
+
+def _create_filter_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_person_date ON transactions (person_name, transaction_date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_person_input ON transactions (person_name, input_currency)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_person_output ON transactions (person_name, output_currency)")
+
+def _create_history_index(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_date_id ON transactions (transaction_date, id)")
+
+def _create_ledger_versioning(conn):
+    # A persistent ledger version, stamped on every row it writes, plus tombstones for deleted ids,
+    # so a snapshot taken at version N can be brought up to date from just the rows changed after N
+    conn.execute("CREATE TABLE IF NOT EXISTS ledger_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    conn.execute("INSERT OR IGNORE INTO ledger_meta (key, value) VALUES ('version', 0), ('ledger_id', abs(random()))")
+    conn.execute("ALTER TABLE transactions ADD COLUMN row_version INTEGER NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_row_version ON transactions (row_version)")
+    conn.execute("CREATE TABLE IF NOT EXISTS deleted_transactions (id TEXT PRIMARY KEY, row_version INTEGER NOT NULL)")
+
+def _create_price_history_table(conn):
+    # One USD close per (currency, day); its version lets every process notice a back-fill
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS price_history (
+        currency TEXT NOT NULL, price_date TEXT NOT NULL, price REAL NOT NULL,
+        PRIMARY KEY (currency, price_date)
+    ) WITHOUT ROWID''')
+    conn.execute("INSERT OR IGNORE INTO ledger_meta (key, value) VALUES ('price_history_version', 0)")
+
+def _integer_transaction_ids(conn):
+    # Text timestamp ids could collide on quick inserts and made for a fat index. Rows are renumbered 1..n in
+    # insertion order; AUTOINCREMENT keeps new ids monotonic and never reuses one, which the tombstones rely on.
+    columns = ', '.join(TRANSACTION_COLUMNS[1:])
+    conn.execute('''
+    CREATE TABLE transactions_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, transaction_type TEXT, person_name TEXT, transaction_date TEXT,
+        input_currency TEXT, output_currency TEXT, input_amount REAL, output_amount REAL,
+        rate REAL, fee REAL, notes TEXT, row_version INTEGER NOT NULL DEFAULT 0
+    )''')
+    conn.execute(f"INSERT INTO transactions_new ({columns}, row_version) SELECT {columns}, row_version FROM transactions ORDER BY rowid")
+    conn.execute("DROP TABLE transactions")
+    conn.execute("ALTER TABLE transactions_new RENAME TO transactions")
+    _create_filter_indexes(conn); _create_history_index(conn)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_row_version ON transactions (row_version)")
+    # Tombstones and snapshot files still carry the old ids: drop the one, and a new ledger_id retires the other
+    conn.execute("DROP TABLE deleted_transactions")
+    conn.execute("CREATE TABLE deleted_transactions (id INTEGER PRIMARY KEY, row_version INTEGER NOT NULL)")
+    conn.execute("UPDATE ledger_meta SET value = abs(random()) WHERE key = 'ledger_id'")
+
+def _create_change_log(conn):
+    # Before and after image of every write, keyed by the ledger version it produced, for other processes to poll
+    conn.execute("CREATE TABLE IF NOT EXISTS change_log (seq INTEGER PRIMARY KEY, old_row TEXT, new_row TEXT)")
+
+def _derived_fee_columns(conn):
+    # SQLite can only add STORED generated columns by rebuilding the table, which also computes them for every
+    # existing row. Ids are copied as they are and the AUTOINCREMENT high-water mark carried over.
+    columns = ', '.join(TRANSACTION_COLUMNS)
+    generated = ', '.join(f"{name} REAL GENERATED ALWAYS AS ({sql}) STORED" for name, sql in DERIVED_COLUMN_SQL.items())
+    high_water = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'transactions'").fetchone()[0]
+    conn.execute(f'''
+    CREATE TABLE transactions_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, transaction_type TEXT, person_name TEXT, transaction_date TEXT,
+        input_currency TEXT, output_currency TEXT, input_amount REAL, output_amount REAL,
+        rate REAL, fee REAL, notes TEXT, row_version INTEGER NOT NULL DEFAULT 0, {generated}
+    )''')
+    conn.execute(f"INSERT INTO transactions_new ({columns}, row_version) SELECT {columns}, row_version FROM transactions ORDER BY id")
+    _swap_transactions_table(conn, high_water)
+    conn.execute("UPDATE ledger_meta SET value = abs(random()) WHERE key = 'ledger_id'")  # snapshot files lack the new columns
+
+def _swap_transactions_table(conn, high_water):
+    # transactions_new replaces transactions, keeping the AUTOINCREMENT high-water mark and the indexes
+    conn.execute("DROP TABLE transactions")
+    conn.execute("ALTER TABLE transactions_new RENAME TO transactions")
+    conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'transactions'", (high_water,))
+    if high_water and not conn.execute("SELECT 1 FROM sqlite_sequence WHERE name = 'transactions'").fetchone():
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('transactions', ?)", (high_water,))
+    _create_filter_indexes(conn); _create_history_index(conn)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_row_version ON transactions (row_version)")
+
+# Per (person, type, currency pair, day) sums of everything the portfolio analysis adds up, kept current by
+# triggers, so summaries are a GROUP BY over a table that grows with days traded rather than rows. Rows without
+# a person count towards nothing and are left out; other missing keys are stored as ''.
+SUMMARY_KEY = ['person_name', 'transaction_type', 'input_currency', 'output_currency', 'day']
+SUMMARY_SUMS = ['row_count', 'input_units', 'output_units', 'fee_usd', 'fee_amount', 'paid_count', 'paid_fee_usd', 'paid_fee_amount']
+
+def _summary_terms(row):
+    # One transaction's key and contribution; `row` is NEW, OLD or the table name. Only one of the fee
+    # columns is ever non-zero, so a fee is "paid" when that one is positive.
+    return {'person_name': f"{row}.person_name", 'transaction_type': f"COALESCE({row}.transaction_type, '')",
+            'input_currency': f"COALESCE({row}.input_currency, '')", 'output_currency': f"COALESCE({row}.output_currency, '')",
+            'day': f"COALESCE(date({row}.transaction_date), '')", 'row_count': "1",
+            'input_units': f"COALESCE({_units_sql(f'{row}.input_amount', f'{row}.input_currency')}, 0)",
+            'output_units': f"COALESCE({_units_sql(f'{row}.output_amount', f'{row}.output_currency')}, 0)",
+            'fee_usd': f"{row}.fee_usd", 'fee_amount': f"{row}.fee_amount", 'paid_count': f"({row}.fee_usd > 0 OR {row}.fee_amount > 0)",
+            'paid_fee_usd': f"MAX({row}.fee_usd, 0)", 'paid_fee_amount': f"MAX({row}.fee_amount, 0)"}
+
+def _summary_add_sql(row):
+    terms = _summary_terms(row)
+    return (f"INSERT INTO ledger_summary ({', '.join(terms)}) SELECT {', '.join(terms.values())} WHERE {row}.person_name IS NOT NULL "
+            f"ON CONFLICT ({', '.join(SUMMARY_KEY)}) DO UPDATE SET {', '.join(f'{c} = {c} + excluded.{c}' for c in SUMMARY_SUMS)};")
+
+def _summary_remove_sql(row):
+    terms = _summary_terms(row)
+    where = ' AND '.join(f"{c} = {terms[c]}" for c in SUMMARY_KEY)
+    return (f"UPDATE ledger_summary SET {', '.join(f'{c} = {c} - {terms[c]}' for c in SUMMARY_SUMS)} WHERE {where};"
+            f" DELETE FROM ledger_summary WHERE {where} AND row_count <= 0;")
+
+def _add_to_ledger_summary(conn, where="", params=(), source='transactions', target='ledger_summary'):
+    # Folds the matching transactions in with one GROUP BY, for when the triggers were off or the table is new
+    terms = _summary_terms(source)
+    conn.execute(f"INSERT INTO {target} ({', '.join(terms)}) SELECT {', '.join(terms[c] for c in SUMMARY_KEY)}, "
+                 f"{', '.join(f'SUM({terms[c]})' for c in SUMMARY_SUMS)} FROM {source} WHERE person_name IS NOT NULL{where} "
+                 f"GROUP BY {', '.join(str(i + 1) for i in range(len(SUMMARY_KEY)))} "
+                 f"ON CONFLICT ({', '.join(SUMMARY_KEY)}) DO UPDATE SET {', '.join(f'{c} = {c} + excluded.{c}' for c in SUMMARY_SUMS)}", params)
+
+def _rebuild_ledger_summary(conn):
+    conn.execute("DELETE FROM ledger_summary")
+    _add_to_ledger_summary(conn)
+
+def _create_summary_triggers(conn):
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS ledger_summary_insert AFTER INSERT ON transactions BEGIN {_summary_add_sql('NEW')} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS ledger_summary_delete AFTER DELETE ON transactions BEGIN {_summary_remove_sql('OLD')} END")
+    # Edits that only touch notes (or the row_version stamp) leave the summary alone
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS ledger_summary_update AFTER UPDATE OF {', '.join(STORED_COLUMNS[1:-1])} ON transactions "
+                 f"BEGIN {_summary_remove_sql('OLD')} {_summary_add_sql('NEW')} END")
+
+def _drop_summary_triggers(conn):
+    # For bulk inserts, which then fold their rows in with _add_to_ledger_summary inside the same transaction
+    for name in ('insert', 'delete', 'update'): conn.execute(f"DROP TRIGGER IF EXISTS ledger_summary_{name}")
+
+def _create_summary_table(conn, name):
+    conn.execute(f'''
+    CREATE TABLE IF NOT EXISTS {name} (
+        person_name TEXT NOT NULL, transaction_type TEXT NOT NULL, input_currency TEXT NOT NULL, output_currency TEXT NOT NULL, day TEXT NOT NULL,
+        row_count INTEGER NOT NULL, input_units INTEGER NOT NULL, output_units INTEGER NOT NULL, fee_usd REAL NOT NULL, fee_amount REAL NOT NULL,
+        paid_count INTEGER NOT NULL, paid_fee_usd REAL NOT NULL, paid_fee_amount REAL NOT NULL,
+        PRIMARY KEY ({', '.join(SUMMARY_KEY)})
+    ) WITHOUT ROWID''')
+
+def _create_ledger_summary(conn):
+    _create_summary_table(conn, 'ledger_summary')
+    _create_summary_triggers(conn)
+    _rebuild_ledger_summary(conn)
+
+def _create_period_closes(conn):
+    # A period close moves every row dated before `closed_before` into archived_transactions (derived columns frozen
+    # as plain values) and its ledger_summary sums into closed_summary, the checkpoint analyses start from.
+    # closing_balances records each close's per (person, currency) balance at that date.
+    conn.execute("CREATE TABLE IF NOT EXISTS period_closes (id INTEGER PRIMARY KEY, closed_before TEXT NOT NULL, closed_at TEXT NOT NULL, archived_rows INTEGER NOT NULL)")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS closing_balances (
+        close_id INTEGER NOT NULL, person_name TEXT NOT NULL, currency TEXT NOT NULL, amount REAL NOT NULL,
+        PRIMARY KEY (close_id, person_name, currency)
+    ) WITHOUT ROWID''')
+    _create_summary_table(conn, 'closed_summary')
+    conn.execute(f'''
+    CREATE TABLE IF NOT EXISTS archived_transactions (
+        id INTEGER PRIMARY KEY, transaction_type TEXT, person_name TEXT, transaction_date TEXT,
+        input_currency TEXT, output_currency TEXT, input_amount REAL, output_amount REAL,
+        rate REAL, fee REAL, notes TEXT, {', '.join(f'{name} REAL' for name in DERIVED_COLUMN_SQL)},
+        row_version INTEGER NOT NULL DEFAULT 0, close_id INTEGER NOT NULL
+    )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_archived_person_date ON archived_transactions (person_name, transaction_date)")
+
+def _create_archive_history_index(conn):
+    # Archived rows are paged and exported in (transaction_date, id) order too; without this every page sorts the archive
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_archived_date_id ON archived_transactions (transaction_date, id)")
+
+def _fixed_point_amounts(conn):
+    # Amounts move to integer units (AMOUNT_DECIMALS) in the ledger and the archive, with input_amount and
+    # output_amount kept as virtual columns over them. Balances and summaries are rebuilt as exact integer sums of
+    # the rounded amounts, and a new ledger_id retires snapshot files holding the unrounded ones.
+    units = ', '.join(_units_sql(c, AMOUNT_UNITS[c][1]) if c in AMOUNT_UNITS else c for c in TRANSACTION_COLUMNS)
+    amounts = ', '.join(f"{amount} REAL GENERATED ALWAYS AS ({_amount_sql(*stored)}) VIRTUAL" for amount, stored in AMOUNT_UNITS.items())
+    generated = ', '.join(f"{name} REAL GENERATED ALWAYS AS ({sql}) STORED" for name, sql in DERIVED_COLUMN_SQL.items())
+    high_water = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'transactions'").fetchone()[0]
+    conn.execute(f'''
+    CREATE TABLE transactions_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, transaction_type TEXT, person_name TEXT, transaction_date TEXT,
+        input_currency TEXT, output_currency TEXT, input_units INTEGER, output_units INTEGER,
+        rate REAL, fee REAL, notes TEXT, row_version INTEGER NOT NULL DEFAULT 0, {amounts}, {generated}
+    )''')
+    conn.execute(f"INSERT INTO transactions_new ({STORED_SELECT}, row_version) SELECT {units}, row_version FROM transactions ORDER BY id")
+    _swap_transactions_table(conn, high_water)
+
+    archived = f"{', '.join(DERIVED_COLUMN_SQL)}, row_version, close_id"
+    conn.execute(f'''
+    CREATE TABLE archived_new (
+        id INTEGER PRIMARY KEY, transaction_type TEXT, person_name TEXT, transaction_date TEXT,
+        input_currency TEXT, output_currency TEXT, input_units INTEGER, output_units INTEGER,
+        rate REAL, fee REAL, notes TEXT, {', '.join(f'{name} REAL' for name in DERIVED_COLUMN_SQL)},
+        row_version INTEGER NOT NULL DEFAULT 0, close_id INTEGER NOT NULL, {amounts}
+    )''')
+    conn.execute(f"INSERT INTO archived_new ({STORED_SELECT}, {archived}) SELECT {units}, {archived} FROM archived_transactions ORDER BY id")
+    conn.execute("DROP TABLE archived_transactions")
+    conn.execute("ALTER TABLE archived_new RENAME TO archived_transactions")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_archived_person_date ON archived_transactions (person_name, transaction_date)")
+    _create_archive_history_index(conn)
+
+    for table in ('ledger_summary', 'closed_summary'):
+        conn.execute(f"DROP TABLE {table}"); _create_summary_table(conn, table)
+    _create_summary_triggers(conn)
+    _add_to_ledger_summary(conn)
+    _add_to_ledger_summary(conn, source='archived_transactions', target='closed_summary')
+    # Balances are summed again in units, the closed periods' from the archive; so is each close's balance rather
+    # than rounding its float total
+    conn.execute("DROP TABLE balances"); _create_balances_table(conn)
+    conn.execute(f'''INSERT INTO balances (person_name, currency, amount) SELECT * FROM ({_balance_sums_sql(table='archived_transactions')}) WHERE true
+                    ON CONFLICT (person_name, currency) DO UPDATE SET amount = amount + excluded.amount''')
+    conn.execute('''
+    CREATE TABLE closing_balances_new (
+        close_id INTEGER NOT NULL, person_name TEXT NOT NULL, currency TEXT NOT NULL, amount INTEGER NOT NULL,
+        PRIMARY KEY (close_id, person_name, currency)
+    ) WITHOUT ROWID''')
+    for (close_id,) in conn.execute("SELECT id FROM period_closes ORDER BY id").fetchall():
+        conn.execute(f"INSERT INTO closing_balances_new SELECT ?, * FROM ({_balance_sums_sql(' WHERE close_id <= ?', 'archived_transactions')})", (close_id, close_id, close_id))
+    conn.execute("DROP TABLE closing_balances")
+    conn.execute("ALTER TABLE closing_balances_new RENAME TO closing_balances")
+    conn.execute("UPDATE ledger_meta SET value = abs(random()) WHERE key = 'ledger_id'")
+
+MIGRATIONS = [_create_transactions_table, _create_balances_table, _create_filter_indexes, _create_history_index, _create_ledger_versioning, _create_price_history_table,
+              _integer_transaction_ids, _create_change_log, _derived_fee_columns, _create_ledger_summary,
+              _create_period_closes, _create_archive_history_index, _fixed_point_amounts]
+
+def migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN")
+        try:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback(); raise
+
+# --- CONNECTION MANAGER ---
+class ConnectionManager:
+    # Keeps a small pool of tuned connections per database file. Streamlit runs every rerun on a
+    # fresh thread, so connections are pooled and handed out per operation rather than per thread.
+    def __init__(self, path, pool_size=8):
+        self.path, self.pool_size = path, pool_size
+        self._idle, self._lock, self._migrated = [], threading.Lock(), False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, cached_statements=256)
+        for pragma in SQLITE_PRAGMAS: conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            if self._idle: return self._idle.pop()
+            if not self._migrated:
+                conn = self._connect()
+                migrate(conn)
+                self._migrated = True
+                return conn
+        return self._connect()
+
+    def release(self, conn):
+        if conn.in_transaction: conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(conn); return
+        conn.close()
+
+_connection_managers = {}
+_connection_managers_lock = threading.Lock()
+
+def set_database_file(path):
+    # Everything resolves DB_FILE at call time, so this switches the app, the store and the CLI alike
+    global DB_FILE
+    DB_FILE = path
+
+def get_connection_manager():
+    with _connection_managers_lock:
+        if DB_FILE not in _connection_managers: _connection_managers[DB_FILE] = ConnectionManager(DB_FILE)
+        return _connection_managers[DB_FILE]
+
+@contextmanager
+def db_connection():
+    manager = get_connection_manager()
+    conn = manager.acquire()
+    if not perf.ENABLED:
+        try: yield conn
+        finally: manager.release(conn)
+        return
+    # Instrumented: statements are counted as SQLite runs them, and the time the connection is held is recorded as connection time
+    conn.set_trace_callback(perf.count_statement)
+    started = time.perf_counter()
+    try: yield conn
+    finally:
+        conn.set_trace_callback(None); perf.record_connection(time.perf_counter() - started)
+        manager.release(conn)
+
+def _balance_sums_sql(where="", table="transactions"):
+    return f'''
+    SELECT person_name, currency, SUM(amount) FROM (
+        SELECT person_name, output_currency AS currency, {_units_sql('output_amount', 'output_currency')} AS amount FROM {table}{where}
+        UNION ALL SELECT person_name, input_currency, -{_units_sql('input_amount', 'input_currency')} FROM {table}{where}
+    ) WHERE person_name IS NOT NULL AND currency IS NOT NULL GROUP BY person_name, currency'''
+
+def _rebuild_balances(conn):
+    conn.execute("DELETE FROM balances")
+    conn.execute("INSERT INTO balances (person_name, currency, amount)" + _balance_sums_sql())
+
+def _ledger_meta(conn, key):
+    return conn.execute("SELECT value FROM ledger_meta WHERE key = ?", (key,)).fetchone()[0]
+
+def _ledger_version(conn):
+    return _ledger_meta(conn, 'version')
+
+def _open_period_start(conn):
+    # First day still open for writes ('YYYY-MM-DD'), or None before the first period close
+    return conn.execute("SELECT MAX(closed_before) FROM period_closes").fetchone()[0]
+
+def _bump_ledger_version(conn):
+    conn.execute("UPDATE ledger_meta SET value = value + 1 WHERE key = 'version'")
+    return _ledger_version(conn)
+
+# --- TRANSACTION FILTERS ---
+def _as_list(value):
+    return None if value is None else [value] if isinstance(value, str) else list(value)
+
+def _as_datetime(value):
+    # Dates, datetimes (pandas Timestamps included) or ISO strings, without needing pandas
+    if isinstance(value, datetime): return value
+    if isinstance(value, date): return datetime(value.year, value.month, value.day)
+    return datetime.fromisoformat(str(value))
+
+def _transaction_filters(transaction_id=None, person=None, currencies=None, transaction_types=None, start_date=None, end_date=None):
+    clauses, params = [], []
+    if transaction_id is not None:
+        clauses.append("id = ?"); params.append(int(transaction_id))
+    people = _as_list(person)
+    if people:
+        clauses.append(f"person_name IN ({', '.join('?' * len(people))})"); params += people
+    currencies = _as_list(currencies)
+    if currencies:
+        marks = ', '.join('?' * len(currencies))
+        clauses.append(f"(input_currency IN ({marks}) OR output_currency IN ({marks}))"); params += currencies + currencies
+    types = _as_list(transaction_types)
+    if types:
+        clauses.append(f"transaction_type IN ({', '.join('?' * len(types))})"); params += types
+    # Dates are stored as 'YYYY-MM-DD HH:MM:SS' text, so string comparison orders them correctly
+    if start_date is not None:
+        clauses.append("transaction_date >= ?"); params.append(str(_as_datetime(start_date)))
+    if end_date is not None:
+        clauses.append("transaction_date < ?"); params.append(str(_as_datetime(end_date) + timedelta(days=1)))
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
@@ -0,0 +1,116 @@
+# Streaming exports. Every export is a generator of rows (a header, then tuples) fed to a writer: transactions come
+# from a SQLite cursor in batches, reports from small summary frames, and the writers consume rows as they arrive,
+# so memory stays flat however large the ledger is. pandas is never imported here.
+import csv
+import io
+import math
+import re
+import tempfile
+import zipfile
+from itertools import islice
+from numbers import Real
+from xml.sax.saxutils import escape
+from .db import TRANSACTION_COLUMNS, TRANSACTION_SELECT, db_connection, _transaction_filters
+
+# --- ROW SOURCES ---
+def transaction_rows(chunk_size=50_000, archived=True, **filters):
+    # The matching rows, oldest first: the closed periods' archive (all older than the open period) then the open
+    # rows, both read in one snapshot so a period close in between can't drop or repeat any
+    where, params = _transaction_filters(**filters)
+    yield tuple(TRANSACTION_COLUMNS)
+    with db_connection() as conn:
+        conn.execute("BEGIN")
+        for table in (['archived_transactions'] if archived else []) + ['transactions']:
+            cursor = conn.execute(f"SELECT {TRANSACTION_SELECT} FROM {table}{where} ORDER BY transaction_date, id", params)
+            while batch := cursor.fetchmany(chunk_size): yield from batch
+
+def frame_rows(frame):
+    # A (small) report frame as rows; missing values become empty cells
+    yield tuple(frame.columns)
+    for row in frame.itertuples(index=False, name=None):
+        yield tuple(None if isinstance(value, float) and math.isnan(value) else value for value in row)
+
+# --- WRITERS ---
+# Each takes any rows iterable and an open destination, and returns how many rows it wrote after the header
+def write_csv(rows, destination, batch_size=10_000):
+    # `destination` is a text file opened with newline=''
+    rows, writer, written = iter(rows), csv.writer(destination), 0
+    writer.writerow(next(rows))
+    while batch := list(islice(rows, batch_size)):
+        writer.writerows(batch); written += len(batch)
+    return written
+
+XLSX_MAX_ROWS = 1_048_576  # Excel's limit per sheet, header included; longer exports continue on another sheet
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+_XML_HEAD = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+_XLSX_MAIN = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_XLSX_RELS = "http://schemas.openxmlformats.org/package/2006/relationships"
+_XLSX_DOC_RELS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_XML_INVALID = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def _xlsx_cell(value):
+    # SQLite hands back str, int, float or None; the exact-type checks come first as this runs for every cell
+    kind = type(value)
+    if kind is str: return f'<c t="inlineStr"><is><t xml:space="preserve">{escape(_XML_INVALID.sub("", value))}</t></is></c>'
+    if kind is float: return f'<c><v>{value!r}</v></c>' if math.isfinite(value) else '<c/>'
+    if kind is int: return f'<c><v>{value}</v></c>'
+    if value is None: return '<c/>'
+    if isinstance(value, Real) and not isinstance(value, bool): return _xlsx_cell(float(value) if isinstance(value, float) else int(value))
+    return _xlsx_cell(str(value))
+
+def _xlsx_rows(rows):
+    return ''.join(['<row>' + ''.join(map(_xlsx_cell, row)) + '</row>' for row in rows]).encode('utf-8')
+
+def write_xlsx(rows, destination, sheet_title='Sheet'):
+    # A minimal Office Open XML workbook written without a spreadsheet library: each sheet's XML streams into the
+    # zip as rows arrive, with inline strings and no shared-string table, so nothing accumulates in memory.
+    # `destination` is a path or a seekable binary file.
+    rows = iter(rows)
+    header, written, titles = next(rows), 0, []
+    with zipfile.ZipFile(destination, 'w', zipfile.ZIP_DEFLATED) as book:
+        chunk = min(1_000, XLSX_MAX_ROWS - 1)
+        batch = list(islice(rows, chunk))
+        while batch or not titles:
+            titles.append(sheet_title if not titles else f"{sheet_title} ({len(titles) + 1})")
+            with book.open(f'xl/worksheets/sheet{len(titles)}.xml', 'w', force_zip64=True) as sheet:
+                sheet.write(f'{_XML_HEAD}<worksheet xmlns="{_XLSX_MAIN}"><sheetData>'.encode('utf-8') + _xlsx_rows([header]))
+                room = XLSX_MAX_ROWS - 1
+                while batch:
+                    sheet.write(_xlsx_rows(batch)); written += len(batch); room -= len(batch)
+                    if not room: break
+                    batch = list(islice(rows, min(room, chunk)))
+                sheet.write(b'</sheetData></worksheet>')
+            if not room: batch = list(islice(rows, chunk))
+        numbers = range(1, len(titles) + 1)
+        book.writestr('[Content_Types].xml', f'{_XML_HEAD}<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                      '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                      '<Default Extension="xml" ContentType="application/xml"/>'
+                      '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+                      + ''.join(f'<Override PartName="/xl/worksheets/sheet{n}.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>' for n in numbers)
+                      + '</Types>')
+        book.writestr('_rels/.rels', f'{_XML_HEAD}<Relationships xmlns="{_XLSX_RELS}"><Relationship Id="rId1" Type="{_XLSX_DOC_RELS}/officeDocument" Target="xl/workbook.xml"/></Relationships>')
+        book.writestr('xl/workbook.xml', f'{_XML_HEAD}<workbook xmlns="{_XLSX_MAIN}" xmlns:r="{_XLSX_DOC_RELS}"><sheets>'
+                      + ''.join(f'<sheet name="{escape(title)}" sheetId="{n}" r:id="rId{n}"/>' for n, title in zip(numbers, titles)) + '</sheets></workbook>')
+        book.writestr('xl/_rels/workbook.xml.rels', f'{_XML_HEAD}<Relationships xmlns="{_XLSX_RELS}">'
+                      + ''.join(f'<Relationship Id="rId{n}" Type="{_XLSX_DOC_RELS}/worksheet" Target="worksheets/sheet{n}.xml"/>' for n in numbers) + '</Relationships>')
+    return written
+
+EXPORT_MIME = {'csv': 'text/csv', 'csv.zip': 'application/zip', 'xlsx': XLSX_MIME}
+
+def export_file(rows, fmt='csv', name='export'):
+    # Writes the rows as `fmt` (a key of EXPORT_MIME) to an anonymous temporary file, deleted once closed, and
+    # returns it rewound for a download. A zipped CSV holds `name`.csv.
+    out = tempfile.TemporaryFile()
+    if fmt == 'xlsx': write_xlsx(rows, out, name)
+    elif fmt == 'csv.zip':
+        with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as archive, archive.open(f'{name}.csv', 'w', force_zip64=True) as entry:
+            with io.TextIOWrapper(entry, encoding='utf-8', newline='') as text: write_csv(rows, text)
+    else:
+        text = io.TextIOWrapper(out, encoding='utf-8', newline='')
+        write_csv(rows, text); text.flush(); text.detach()
+    out.seek(0)
+    return out
+
+def export_transactions_csv(destination, chunk_size=50_000, archived=True, **filters):
+    # Streams the matching rows, oldest first, into an open text file; returns how many were written
+    return write_csv(transaction_rows(chunk_size, archived, **filters), destination)
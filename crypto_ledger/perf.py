@@ -0,0 +1,141 @@
+# Opt-in timing of the hot paths. @timed functions and `with timed(...)` blocks record spans, db_connection counts
+# SQL statements and the time connections are held (the queries plus whatever the holder does meanwhile), and spans
+# on a thread between start_run() and the run's end add up to one run (a Streamlit rerun, a CLI command). Recent
+# durations stay in memory for percentiles; every finished run is appended to a rotating JSON-lines log. Off unless
+# $CRYPTO_LEDGER_PERF is set, and while off an instrumented call costs one flag check. Standard library only, like db.
+import atexit
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import defaultdict, deque
+from logging.handlers import RotatingFileHandler
+
+ENABLED = os.environ.get('CRYPTO_LEDGER_PERF', '').lower() not in ('', '0', 'false', 'no')
+RECENT_TIMINGS = 500  # durations kept per name for the percentiles
+RECENT_RUNS = 100
+LOG_MAX_BYTES, LOG_BACKUPS = 5_000_000, 3
+CONNECTION = 'connection held'  # the name connection hold times are recorded under
+
+_lock = threading.Lock()
+_local = threading.local()
+_timings = defaultdict(lambda: deque(maxlen=RECENT_TIMINGS))
+_runs = deque(maxlen=RECENT_RUNS)
+_unlogged = []
+_log = None
+
+def set_enabled(on=True):
+    global ENABLED
+    ENABLED = bool(on)
+
+def log_file():
+    from . import db
+    return os.environ.get('CRYPTO_LEDGER_PERF_LOG') or f"{os.path.splitext(db.DB_FILE)[0]}.perf.jsonl"
+
+@atexit.register
+def flush_log():
+    # Writes the finished runs' lines; runs can finish during a thread's teardown, where logging is best avoided
+    global _log
+    with _lock:
+        records = _unlogged[:]; _unlogged.clear()
+        if records and _log is None:
+            _log = logging.getLogger(__name__)
+            _log.propagate, _log.level = False, logging.INFO
+            try: _log.addHandler(RotatingFileHandler(log_file(), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8'))
+            except OSError: pass  # timings still show in the panel
+    for record in records: _log.info(json.dumps(record))
+
+# --- RUNS ---
+class _Run:
+    __slots__ = ('name', 'at', 'started', 'spans', 'outer', 'sql_count', 'connection_seconds', 'done')
+    def __init__(self, name):
+        self.name, self.at, self.started = name, time.time(), time.perf_counter()
+        self.spans, self.outer, self.sql_count, self.connection_seconds, self.done = {}, 0.0, 0, 0.0, False
+
+class _RunToken:
+    # Held in the thread's locals only, so it is released, and finalized, when the thread exits
+    __slots__ = ('__weakref__',)
+
+def start_run(name):
+    # Ends the thread's previous run, if any, and starts timing a new one. A run also ends when its thread does:
+    # Streamlit runs reruns back to back on one script thread and lets it exit when idle, so the end of a run
+    # is the next start_run() or the thread's exit, whichever comes first, even after st.stop() or st.rerun()
+    if not ENABLED: return
+    finish_run(); flush_log()
+    _local.run, _local.token = (run := _Run(name)), _RunToken()
+    weakref.finalize(_local.token, _finish, run)
+
+def finish_run():
+    run = getattr(_local, 'run', None)
+    if run is not None: _local.run = None; _finish(run)
+
+def _finish(run):
+    if run.done: return
+    run.done, seconds = True, time.perf_counter() - run.started
+    record = {'run': run.name, 'at': run.at, 'seconds': seconds, 'untimed_seconds': max(seconds - run.outer, 0.0),
+              'sql_count': run.sql_count, 'connection_seconds': run.connection_seconds, 'spans': run.spans}
+    with _lock:
+        _timings[f"run: {run.name}"].append(seconds)
+        _runs.append(record); _unlogged.append(record)
+
+# --- SPANS ---
+def record(name, seconds, outer=True):
+    with _lock: _timings[name].append(seconds)
+    run = getattr(_local, 'run', None)
+    if run is None: return
+    span = run.spans.setdefault(name, {'calls': 0, 'seconds': 0.0})
+    span['calls'] += 1; span['seconds'] += seconds
+    if outer: run.outer += seconds
+
+class timed:
+    # A decorator (@timed('name')) or a context manager (with timed('name'): ...). Nested spans count once
+    # towards the run's timed share, so untimed_seconds is what the instrumented calls don't cover: rendering.
+    __slots__ = ('name', 'started')
+    def __init__(self, name): self.name, self.started = name, None
+
+    def __enter__(self):
+        if ENABLED: self.started = time.perf_counter(); _local.depth = getattr(_local, 'depth', 0) + 1
+        return self
+
+    def __exit__(self, *exc):
+        if self.started is not None:
+            _local.depth -= 1
+            record(self.name, time.perf_counter() - self.started, _local.depth == 0)
+
+    def __call__(self, function):
+        name = self.name
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED: return function(*args, **kwargs)
+            with timed(name): return function(*args, **kwargs)
+        return wrapper
+
+def count_statement(statement):
+    # sqlite3 trace callback: one call per statement executed
+    run = getattr(_local, 'run', None)
+    if run is not None: run.sql_count += 1
+
+def record_connection(seconds):
+    # How long a connection was checked out: its queries, and also the pandas reads and streamed exports consuming them
+    with _lock: _timings[CONNECTION].append(seconds)
+    run = getattr(_local, 'run', None)
+    if run is not None: run.connection_seconds += seconds
+
+# --- READING ---
+def _percentile(ordered, share):
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+def timing_stats():
+    # [(name, calls, p50, p90, p99, max)] in seconds over each name's recent durations, slowest p90 first
+    with _lock: timings = {name: sorted(values) for name, values in _timings.items() if values}
+    stats = [(name, len(v), _percentile(v, 0.5), _percentile(v, 0.9), _percentile(v, 0.99), v[-1]) for name, v in timings.items()]
+    return sorted(stats, key=lambda row: row[3], reverse=True)
+
+def recent_runs(count=RECENT_RUNS):
+    with _lock: return list(_runs)[-count:][::-1]
+
+def reset():
+    with _lock: _timings.clear(); _runs.clear()
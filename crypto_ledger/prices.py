@@ -0,0 +1,188 @@
+# Current quotes from a background price service and daily closes in the price_history table.
+# requests and pandas are imported where they are used, so reading cached quotes stays cheap.
+import json
+import os
+import threading
+import time
+from . import db
+from .db import db_connection, _ledger_meta
+from .perf import timed
+
+# --- PRICE SERVICE ---
+PRICE_API_URL = os.environ.get('PRICE_API_URL', 'https://api.coingecko.com/api/v3')  # point at a local stub in tests
+PRICE_SYMBOL_IDS = {'BTC': 'bitcoin', 'ETH': 'ethereum', 'BNB': 'binancecoin', 'SOL': 'solana', 'XRP': 'ripple', 'USDC': 'usd-coin', 'ADA': 'cardano', 'DOGE': 'dogecoin', 'DOT': 'polkadot', 'PAXG': 'pax-gold', 'USDT': 'tether'}
+PRICE_TTL = 300
+PRICE_TTLS = {'USDC': 3600, 'PAXG': 900}  # per-symbol overrides; slow movers need fewer calls
+PRICE_RETRY_DELAY = 30      # after a failed call, before the same symbols are tried again
+PRICE_IDLE_TIMEOUT = 3600   # symbols no page has asked for this long stop being refreshed
+PRICE_REQUEST_TIMEOUT = 10
+
+def price_cache_file():
+    return f"{os.path.splitext(db.DB_FILE)[0]}.prices.json"
+
+def read_price_cache(path):
+    # {symbol: (price, fetched at)} from the last good quotes on disk; empty when there are none
+    try:
+        with open(path, encoding='utf-8') as f: return {s: (float(p), float(t)) for s, (p, t) in json.load(f).items()}
+    except (OSError, ValueError, TypeError): return {}
+
+def write_price_cache(path, quotes):
+    try:
+        with open(path + '.tmp', 'w', encoding='utf-8') as f: json.dump(quotes, f)
+        os.replace(path + '.tmp', path)
+    except OSError: pass  # the in-memory quotes are still good
+
+@timed('fetch_prices (CoinGecko)')
+def fetch_prices(symbols, base_url=None):
+    # One blocking provider call for {symbol: USD price}; symbols it does not know are left out
+    import requests
+    ids = {PRICE_SYMBOL_IDS[s]: s for s in symbols if s in PRICE_SYMBOL_IDS}
+    if not ids: return {}
+    response = requests.get(f"{(base_url or PRICE_API_URL).rstrip('/')}/simple/price", params={'ids': ','.join(ids), 'vs_currencies': 'usd'}, timeout=PRICE_REQUEST_TIMEOUT)
+    response.raise_for_status()
+    data = response.json()
+    return {ids[id]: float(data[id]['usd']) for id in ids if id in data and 'usd' in data[id]}
+
+class PriceService:
+    # One per process: pages only read the last good quotes and register the symbols they need; a daemon
+    # thread does every network call, so concurrent requests for a symbol share one in-flight call
+    def __init__(self, base_url=None, cache_path=None):
+        self.base_url = (base_url or PRICE_API_URL).rstrip('/')
+        self.cache_path = cache_path
+        self.last_error = None
+        self._quotes, self._wanted, self._inflight, self._failed_at = {}, {}, set(), {}
+        self._cond = threading.Condition()
+        self._wake = threading.Event()
+        self._load_cache()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _load_cache(self):
+        if self.cache_path: self._quotes = read_price_cache(self.cache_path)
+
+    def _is_stale(self, symbol, now, force=False):
+        if symbol in self._inflight or symbol not in PRICE_SYMBOL_IDS: return False
+        if now - self._failed_at.get(symbol, 0) < PRICE_RETRY_DELAY: return False
+        if force or symbol not in self._quotes: return True
+        return now - self._quotes[symbol][1] >= PRICE_TTLS.get(symbol, PRICE_TTL)
+
+    def request(self, symbols, force=False, wait=None):
+        # Never blocks unless `wait` seconds are given (an explicit refresh); returns False when a refresh had to be queued
+        # or, when waiting, did not bring back fresh quotes
+        now = time.time()
+        with self._cond:
+            for symbol in symbols: self._wanted[symbol] = now
+            if force:
+                for symbol in symbols: self._failed_at.pop(symbol, None)
+            stale = [s for s in symbols if self._is_stale(s, now, force)]
+            if stale:
+                self._inflight.update(stale); self._wake.set()
+            if wait:
+                pending = set(symbols) & set(PRICE_SYMBOL_IDS)
+                self._cond.wait_for(lambda: not pending & self._inflight, timeout=wait)
+                return all(self._quotes.get(s, (0, 0))[1] >= now for s in pending)
+        return not stale
+
+    def prices(self, symbols=None):
+        with self._cond: quotes = dict(self._quotes)
+        prices = {s: p for s, (p, _) in quotes.items() if symbols is None or s in symbols}
+        prices['USDT'] = 1.0
+        return prices
+
+    def fetched_at(self, symbols=None):
+        # When the oldest of these quotes was fetched (0 when none are known)
+        with self._cond: times = [t for s, (_, t) in self._quotes.items() if symbols is None or s in symbols]
+        return min(times) if times else 0
+
+    def _run(self):
+        import requests
+        while True:
+            self._wake.wait(timeout=PRICE_RETRY_DELAY); self._wake.clear()
+            now = time.time()
+            with self._cond:
+                # Keep what pages recently asked for warm, so their next run finds fresh quotes
+                for symbol, asked in list(self._wanted.items()):
+                    if now - asked > PRICE_IDLE_TIMEOUT: del self._wanted[symbol]
+                    elif self._is_stale(symbol, now): self._inflight.add(symbol)
+                batch = sorted(self._inflight)
+            if not batch: continue
+            try:
+                fetched, error = fetch_prices(batch, self.base_url), None
+            except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+                fetched, error = {}, e
+            with self._cond:
+                done = time.time()
+                for symbol, price in fetched.items(): self._quotes[symbol] = (price, done)
+                for symbol in batch:
+                    if symbol not in fetched: self._failed_at[symbol] = done
+                self._inflight.difference_update(batch)
+                self.last_error = error
+                quotes = dict(self._quotes)
+                self._cond.notify_all()
+            if fetched and self.cache_path: write_price_cache(self.cache_path, quotes)
+
+_price_services = {}
+_price_services_lock = threading.Lock()
+
+def get_price_service():
+    with _price_services_lock:
+        path = price_cache_file()
+        if path not in _price_services: _price_services[path] = PriceService(cache_path=path)
+        return _price_services[path]
+
+# --- PRICE HISTORY ---
+def save_price_history(frame):
+    # Upserts (currency, price_date, price) rows; returns how many were written
+    import pandas as pd
+    frame = frame.dropna(subset=['currency', 'price_date', 'price'])
+    if frame.empty: return 0
+    rows = zip(frame['currency'].astype(str).str.upper(), pd.to_datetime(frame['price_date']).dt.strftime('%Y-%m-%d'), frame['price'].astype('float64'))
+    with db_connection() as conn, conn:
+        conn.executemany("INSERT INTO price_history (currency, price_date, price) VALUES (?, ?, ?) "
+                         "ON CONFLICT(currency, price_date) DO UPDATE SET price = excluded.price", rows)
+        conn.execute("UPDATE ledger_meta SET value = value + 1 WHERE key = 'price_history_version'")
+    return len(frame)
+
+def import_price_history_csv(source):
+    # Long files (date, currency, price) or wide ones (date plus one column per currency)
+    import pandas as pd
+    frame = pd.read_csv(source)
+    frame.columns = [str(c).strip().lower() for c in frame.columns]
+    date_column = next((c for c in ('price_date', 'date', 'day') if c in frame.columns), None)
+    if date_column is None: raise ValueError("the file needs a date column")
+    if 'currency' not in frame.columns: frame = frame.melt(id_vars=date_column, var_name='currency', value_name='price')
+    elif 'price' not in frame.columns: raise ValueError("a file with a currency column needs a price column")
+    frame = frame.rename(columns={date_column: 'price_date'})
+    frame['price'] = pd.to_numeric(frame['price'], errors='coerce')
+    return save_price_history(frame)
+
+def backfill_price_history(symbols, days=365, base_url=None):
+    # One provider call per symbol for its daily closes; returns {symbol: days saved}, skipping failed symbols
+    import pandas as pd
+    import requests
+    base_url, saved = (base_url or PRICE_API_URL).rstrip('/'), {}
+    for symbol in symbols:
+        if symbol not in PRICE_SYMBOL_IDS or symbol == 'USDT': continue
+        try:
+            response = requests.get(f"{base_url}/coins/{PRICE_SYMBOL_IDS[symbol]}/market_chart", params={'vs_currency': 'usd', 'days': days, 'interval': 'daily'}, timeout=PRICE_REQUEST_TIMEOUT)
+            response.raise_for_status()
+            points = pd.DataFrame(response.json()['prices'], columns=['timestamp', 'price'])
+        except (requests.exceptions.RequestException, ValueError, KeyError): continue
+        points['price_date'] = pd.to_datetime(points['timestamp'], unit='ms').dt.normalize()
+        daily = points.groupby('price_date', as_index=False)['price'].last().assign(currency=symbol)
+        saved[symbol] = save_price_history(daily)
+    return saved
+
+_price_history_cache = {}
+
+def get_price_history():
+    # (version, frame) for the whole table, reloaded only after a back-fill bumps its version
+    import pandas as pd
+    with db_connection() as conn:
+        version = _ledger_meta(conn, 'price_history_version')
+        cached = _price_history_cache.get(db.DB_FILE)
+        if cached is not None and cached[0] == version: return cached
+        frame = pd.read_sql_query("SELECT currency, price_date, price FROM price_history ORDER BY currency, price_date", conn)
+    frame['currency'] = frame['currency'].astype('category')
+    frame['price_date'] = pd.to_datetime(frame['price_date'])
+    _price_history_cache[db.DB_FILE] = (version, frame)
+    return version, frame
@@ -0,0 +1,687 @@
+# The ledger itself: transaction rows, the shared in-memory store with its snapshot file, balances,
+# filtered queries and bulk import. No Streamlit here; the app reaches all of this through utils.py.
+import json
+import os
+import threading
+from datetime import date, timedelta
+from itertools import repeat
+import numpy as np
+import pandas as pd
+from . import db
+from .perf import timed
+from .db import (TRANSACTION_COLUMNS, TRANSACTION_SELECT, DERIVED_COLUMN_SQL, LEDGER_COLUMNS, LEDGER_SELECT, SUMMARY_KEY, SUMMARY_SUMS, db_connection,
+                 AMOUNT_UNITS, STORED_COLUMNS, STORED_SELECT, unit_scale, to_units, from_units,
+                 _ledger_meta, _ledger_version, _bump_ledger_version, _open_period_start, _transaction_filters, _as_datetime, _balance_sums_sql,
+                 _drop_summary_triggers, _create_summary_triggers, _add_to_ledger_summary)
+
+# --- DATA CONSISTENCY ---
+# Low-cardinality text columns are held as categoricals: int codes plus one copy of each label
+CATEGORICAL_COLUMNS = ['transaction_type', 'person_name', 'input_currency', 'output_currency']
+
+@timed('_ensure_data_types')
+def _ensure_data_types(df):
+    expected_cols = { "id": "int64", "transaction_type": "category", "person_name": "category", "transaction_date": "datetime64[ns]", "input_currency": "category", "output_currency": "category", "input_amount": "float64", "output_amount": "float64", "rate": "float64", "fee": "float64", "notes": "object" }
+    for col, dtype in expected_cols.items():
+        if col not in df.columns: df[col] = pd.Series(dtype=dtype)
+    if df['id'].dtype != 'int64' and df['id'].notna().all(): df['id'] = df['id'].astype('int64')  # e.g. an empty SQL result
+    for col in CATEGORICAL_COLUMNS:
+        if not isinstance(df[col].dtype, pd.CategoricalDtype): df[col] = df[col].astype('category')
+    df['transaction_date'] = pd.to_datetime(df['transaction_date'], errors='coerce')
+    numeric_cols = ['input_amount', 'output_amount', 'rate', 'fee'] + [col for col in DERIVED_COLUMN_SQL if col in df.columns]
+    for col in numeric_cols: df[col] = pd.to_numeric(df[col], errors='coerce').astype('float64').fillna(0)
+    return df
+
+# Amounts are held as float64 read back from integer units (db.AMOUNT_DECIMALS); wherever they are summed or
+# compared they go back to int64 units, which recovers the stored integers exactly
+def _unit_scales(currencies):
+    # 10 ** decimals for each row's currency, looked up once per category
+    currencies = pd.Series(currencies).astype('category')
+    codes = currencies.cat.codes.to_numpy()
+    scales = np.array([unit_scale(c) for c in currencies.cat.categories] + [unit_scale(None)], dtype='int64')
+    return scales[np.where(codes < 0, len(scales) - 1, codes)]
+
+def _to_units(amounts, currencies):
+    return np.rint(np.nan_to_num(np.asarray(amounts, dtype='float64')) * _unit_scales(currencies)).astype('int64')
+
+def _from_units(units, currencies):
+    return np.asarray(units, dtype='float64') / _unit_scales(currencies)
+
+@timed('load ledger (SQLite)')
+def _load_ledger(conn):
+    transactions = _ensure_data_types(pd.read_sql_query(f"SELECT {LEDGER_SELECT} FROM transactions ORDER BY id", conn))
+    balances = {(p, c): a for p, c, a in conn.execute("SELECT person_name, currency, amount FROM balances")}
+    return transactions, balances
+
+# --- BALANCE LEDGER ---
+def _balance_deltas(tx, sign=1):
+    # A transaction credits its output currency and debits its input currency, in integer units
+    deltas = {}
+    person = tx.get('person_name')
+    if person is None or pd.isna(person): return deltas
+    for currency_key, amount_key, direction in (('output_currency', 'output_amount', 1), ('input_currency', 'input_amount', -1)):
+        currency = tx.get(currency_key)
+        if currency is None or pd.isna(currency): continue
+        key = (person, currency)
+        deltas[key] = deltas.get(key, 0) + sign * direction * to_units(_to_db_value(tx.get(amount_key)), currency)
+    return deltas
+
+def _merge_deltas(*delta_maps):
+    merged = {}
+    for deltas in delta_maps:
+        for key, amount in deltas.items(): merged[key] = merged.get(key, 0) + amount
+    return merged
+
+def _apply_balance_deltas(conn, deltas):
+    conn.executemany(
+        "INSERT INTO balances (person_name, currency, amount) VALUES (?, ?, ?) "
+        "ON CONFLICT(person_name, currency) DO UPDATE SET amount = amount + excluded.amount",
+        [(p, c, a) for (p, c), a in deltas.items()])
+
+INSERT_TRANSACTION_SQL = f"INSERT INTO transactions ({STORED_SELECT}, row_version) VALUES ({', '.join('?' * (len(STORED_COLUMNS) + 1))})"
+UPDATE_TRANSACTION_SQL = f"UPDATE transactions SET {', '.join(f'{c} = ?' for c in STORED_COLUMNS[1:])}, row_version = ? WHERE id = ?"
+
+def _transaction_params(row):
+    # In STORED_COLUMNS order: amounts go in as units of their currency
+    value = lambda c: _to_db_value(row.get(c))
+    return tuple(to_units(value(c), value(AMOUNT_UNITS[c][1])) if c in AMOUNT_UNITS else value(c) for c in TRANSACTION_COLUMNS)
+
+def _fetch_transaction_row(conn, tx_id):
+    cursor = conn.execute(f"SELECT {LEDGER_SELECT} FROM transactions WHERE id = ?", (tx_id,))
+    row = cursor.fetchone()
+    return dict(zip([c[0] for c in cursor.description], row)) if row else None
+
+def _extend_categories(df, row):
+    for col in CATEGORICAL_COLUMNS:
+        value = row.get(col)
+        if col not in df.columns or not isinstance(df[col].dtype, pd.CategoricalDtype) or value is None or pd.isna(value): continue
+        if value not in df[col].cat.categories: df[col] = df[col].cat.add_categories([value])
+
+# Ledger frames are kept in id order, and ids only grow, so a row is found by binary search and a new one is
+# appended at the end. Edits build a new frame that shares every column the edit doesn't touch.
+def _row_position(df, tx_id):
+    ids = df['id'].to_numpy()
+    position = int(np.searchsorted(ids, tx_id))
+    return position if position < len(ids) and ids[position] == tx_id else None
+
+def _row_frame(row, like):
+    # One row typed exactly like `like` (categories included), so adding it never retypes the big frame
+    frame = _ensure_data_types(pd.DataFrame([{col: row.get(col) for col in LEDGER_COLUMNS}]))
+    return frame.astype({col: like[col].dtype for col in LEDGER_COLUMNS if col in like.columns})
+
+def _append_transaction(df, row):
+    df = df.copy(deep=False)
+    _extend_categories(df, row)
+    return pd.concat([df, _row_frame(row, df)], ignore_index=True)
+
+def _replace_row(df, position, row, columns):
+    # Only the edited columns are copied, and they replace the originals rather than being written into: a shallow
+    # copy shares its buffers with snapshots holding `df`, and before pandas 3 nothing copies them on write
+    df = df.copy(deep=False)
+    _extend_categories(df, row)
+    values = _row_frame(row, df).iloc[0]
+    for col in columns:
+        column = df[col].copy()
+        column.iat[position] = values[col]
+        df[col] = column
+    return df
+
+def _drop_row(df, position):
+    return pd.concat([df.iloc[:position], df.iloc[position + 1:]], ignore_index=True)
+
+def _apply_change(df, old_row, new_row):
+    # One write (None before = insert, None after = delete) applied to a frame; None if the frame doesn't match it
+    if old_row is None:
+        if len(df) and new_row['id'] <= df['id'].iat[-1]: return None
+        return _append_transaction(df, new_row)
+    position = _row_position(df, old_row['id'])
+    if position is None: return None
+    if new_row is None: return _drop_row(df, position)
+    return _replace_row(df, position, new_row, [col for col in LEDGER_COLUMNS[1:] if _to_db_value(new_row.get(col)) != old_row.get(col)])
+
+def _concat_transactions(df, other):
+    # Union the categories first; concat of categoricals with different categories silently falls back to object
+    df, other = df.copy(deep=False), other.copy(deep=False)
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns and col in other.columns:
+            categories = df[col].cat.categories.union(other[col].cat.categories, sort=False)
+            df[col], other[col] = df[col].cat.set_categories(categories), other[col].cat.set_categories(categories)
+    return pd.concat([df, other], ignore_index=True)
+
+def _replay_changes(conn, transactions, since):
+    # Brings a frame taken at ledger version `since` up to date from the rows and tombstones written after it
+    changed = _ensure_data_types(pd.read_sql_query(f"SELECT {LEDGER_SELECT} FROM transactions WHERE row_version > ?", conn, params=(since,)))
+    deleted = [row[0] for row in conn.execute("SELECT id FROM deleted_transactions WHERE row_version > ?", (since,))]
+    if changed.empty and not deleted: return transactions
+    stale = transactions['id'].isin(changed['id']) | transactions['id'].isin(deleted)
+    transactions = _concat_transactions(transactions[~stale], changed)
+    # Edited rows come back at the end; a stable sort of nearly ordered ids is close to linear
+    return transactions if transactions['id'].is_monotonic_increasing else transactions.sort_values('id', kind='stable', ignore_index=True)
+
+# --- CHANGE LOG ---
+# Every write appends (seq = the ledger version it produced, row before, row after), so another process can
+# catch up on just the rows that changed. A bulk write logs an entry with neither, which means "reload".
+CHANGE_LOG_RETENTION = 10_000  # entries kept; a process further behind than this reloads instead
+CHANGE_LOG_COMPACT_EVERY = 1_000
+
+def _log_change(conn, version, old_row=None, new_row=None):
+    encode = lambda row: None if row is None else json.dumps({col: _to_db_value(row.get(col)) for col in LEDGER_COLUMNS})
+    conn.execute("INSERT INTO change_log (seq, old_row, new_row) VALUES (?, ?, ?)", (version, encode(old_row), encode(new_row)))
+    if version % CHANGE_LOG_COMPACT_EVERY == 0: conn.execute("DELETE FROM change_log WHERE seq <= ?", (version - CHANGE_LOG_RETENTION,))
+
+def _to_db_value(value):
+    if isinstance(value, pd.Timestamp): return str(value)
+    if hasattr(value, 'item'): value = value.item()
+    return None if isinstance(value, float) and pd.isna(value) else value
+
+# --- SHARED LEDGER STORE ---
+MAX_TRACKED_CHANGES = 200
+
+class LedgerSnapshot:
+    # Immutable view of the ledger at one version; a write produces a new snapshot instead of mutating this one
+    def __init__(self, version, transactions, balances, changes=(), closed=None):
+        self.version, self.transactions, self.balances, self.changes = version, transactions, balances, changes
+        self.closed = closed  # ClosedPeriods once a period has been closed, else None
+        self._sorted = None
+
+    def sorted_transactions(self):
+        if self._sorted is None: self._sorted = self.transactions.sort_values(by="transaction_date", ascending=False)
+        return self._sorted
+
+    def symbols(self):
+        # Every currency anyone has a balance row for, toman aside
+        return sorted({currency for _, currency in self.balances if currency != 'IRR'})
+
+class ClosedPeriods:
+    # What period closes took out of the transactions table: the first open day, the closed rows' summary sums
+    # (the checkpoint analyses start from) and, read on first use, the archived rows themselves
+    def __init__(self, open_from, summary):
+        self.open_from, self.summary = open_from, summary
+        self._archived, self._lock = None, threading.Lock()
+
+    def archived_transactions(self):
+        with self._lock:
+            if self._archived is None: self._archived = query_transactions(order_by='id', descending=False, archived=True)
+            return self._archived
+
+def _load_closed_periods(conn):
+    open_from = _open_period_start(conn)
+    if open_from is None: return None
+    summary = pd.read_sql_query(f"SELECT {', '.join(SUMMARY_KEY + SUMMARY_SUMS)} FROM closed_summary", conn)
+    for col in SUMMARY_KEY: summary[col] = summary[col].astype(object).replace('', None)
+    return ClosedPeriods(open_from, summary.astype({col: 'float64' for col in SUMMARY_SUMS}))
+
+# --- COLUMNAR SNAPSHOT FILE ---
+SNAPSHOT_REWRITE_INTERVAL = 500  # writes since the last snapshot file before it is rewritten in the background
+
+def _snapshot_files():
+    # {version: path} for the Arrow snapshots sitting next to the database file
+    stem = os.path.splitext(db.DB_FILE)[0]
+    folder, prefix = os.path.dirname(stem) or '.', os.path.basename(stem) + '.v'
+    files = {}
+    for name in os.listdir(folder):
+        if name.startswith(prefix) and name.endswith('.arrow') and name[len(prefix):-6].isdigit():
+            files[int(name[len(prefix):-6])] = os.path.join(folder, name)
+    return files
+
+def _pyarrow():
+    # Imported on first use: only the snapshot file needs it, and it is slow to import
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc
+    except ImportError:  # snapshots are only an optimization; without pyarrow every start loads from SQLite
+        return None
+    return pa
+
+@timed('load ledger (snapshot file)')
+def _read_snapshot_file(path, ledger_id):
+    # Memory-mapped, so the cold start costs little more than the pages pandas actually touches
+    pa = _pyarrow()
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    if int((table.schema.metadata or {}).get(b'ledger_id', b'-1')) != ledger_id: return None
+    return _ensure_data_types(table.to_pandas(split_blocks=True))
+
+def write_snapshot_file(snapshot, ledger_id):
+    pa = _pyarrow()
+    if pa is None: return None
+    path = f"{os.path.splitext(db.DB_FILE)[0]}.v{snapshot.version}.arrow"
+    table = pa.Table.from_pandas(snapshot.transactions[LEDGER_COLUMNS], preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, b'ledger_id': str(ledger_id).encode()})
+    # Versioned names plus an atomic rename: a reader never sees a half-written file and nothing mapped is replaced
+    with pa.OSFile(path + '.tmp', 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer: writer.write_table(table)
+    os.replace(path + '.tmp', path)
+    for version, old_path in _snapshot_files().items():
+        if version < snapshot.version:
+            try: os.remove(old_path)
+            except OSError: pass  # still mapped by another process; the next rewrite gets it
+    return path
+
+def _load_ledger_snapshot(conn):
+    # Newest usable snapshot file plus the rows written since, else the full table; one read transaction throughout
+    version, ledger_id = _ledger_version(conn), _ledger_meta(conn, 'ledger_id')
+    transactions, since, pa = None, None, _pyarrow()
+    if pa is not None:
+        for file_version, path in sorted(_snapshot_files().items(), reverse=True):
+            if file_version > version: continue  # from a database that has since been replaced
+            try: transactions = _read_snapshot_file(path, ledger_id)
+            except (OSError, pa.ArrowException): transactions = None
+            if transactions is not None:
+                since = file_version; break
+    if transactions is None:
+        transactions, balances = _load_ledger(conn)
+    else:
+        transactions = _replay_changes(conn, transactions, since)
+        balances = {(p, c): a for p, c, a in conn.execute("SELECT person_name, currency, amount FROM balances")}
+    return version, ledger_id, since, transactions, balances
+
+class LedgerStore:
+    # One per process: every session reads the same snapshot and every write goes through here
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._snapshot_writer = None
+        with db_connection() as conn:
+            conn.execute("BEGIN")
+            version, self._ledger_id, self._file_version, transactions, balances = _load_ledger_snapshot(conn)
+            closed = _load_closed_periods(conn)
+            conn.rollback()
+        self.snapshot = LedgerSnapshot(version, transactions, balances, closed=closed)
+        self._maybe_write_snapshot()
+
+    def _maybe_write_snapshot(self, force=False):
+        # Rewrites the snapshot file off the request path; the snapshot object is immutable so no lock is needed
+        snapshot = self.snapshot
+        if snapshot.version == self._file_version or _pyarrow() is None: return
+        if not force and self._file_version is not None and snapshot.version - self._file_version < SNAPSHOT_REWRITE_INTERVAL: return
+        if self._snapshot_writer is not None and self._snapshot_writer.is_alive(): return
+        self._file_version = snapshot.version
+        self._snapshot_writer = threading.Thread(target=write_snapshot_file, args=(snapshot, self._ledger_id), daemon=True)
+        self._snapshot_writer.start()
+
+    def wait_for_snapshot_file(self, timeout=None):
+        # For short-lived processes: let a background rewrite finish before the interpreter exits
+        if self._snapshot_writer is not None: self._snapshot_writer.join(timeout)
+
+    def reload(self):
+        # For writes that bypass add/update/delete (bulk imports, other processes): replays the rows written
+        # since this snapshot, and the change trail restarts so caches rebuild in full. A new ledger_id means rows
+        # were removed or renumbered wholesale (a period close), which only a full load picks up.
+        with self._lock:
+            closed = self.snapshot.closed
+            with db_connection() as conn:
+                conn.execute("BEGIN")
+                version, ledger_id = _ledger_version(conn), _ledger_meta(conn, 'ledger_id')
+                if ledger_id != self._ledger_id:
+                    transactions, balances = _load_ledger(conn)
+                    closed, self._ledger_id, self._file_version = _load_closed_periods(conn), ledger_id, None
+                else:
+                    transactions = _replay_changes(conn, self.snapshot.transactions, self.snapshot.version)
+                    balances = {(p, c): a for p, c, a in conn.execute("SELECT person_name, currency, amount FROM balances")}
+                conn.rollback()
+            self.snapshot = LedgerSnapshot(version, transactions, balances, closed=closed)
+            self._maybe_write_snapshot(force=True)
+            return self.snapshot
+
+    def bulk_import(self, source, **options):
+        with self._lock:
+            result = import_transactions_csv(source, **options)
+            if result['imported']: self.reload()
+            return result
+
+    def sync(self):
+        # Catches up with other processes' writes. Costs one version lookup when nothing changed; otherwise the
+        # logged rows are applied as ordinary changes, so caches fold them in. Reloads when the log can't cover
+        # the gap: compacted away, a bulk write, or more changes than the trail keeps.
+        with self._lock:
+            current = self.snapshot
+            with db_connection() as conn:
+                conn.execute("BEGIN")
+                version = _ledger_version(conn)
+                if version == current.version:
+                    conn.rollback(); return current
+                entries = conn.execute("SELECT seq, old_row, new_row FROM change_log WHERE seq > ? AND seq <= ? ORDER BY seq LIMIT ?",
+                                       (current.version, version, MAX_TRACKED_CHANGES + 1)).fetchall()
+                balances = {(p, c): a for p, c, a in conn.execute("SELECT person_name, currency, amount FROM balances")}
+                conn.rollback()
+            if len(entries) != version - current.version: return self.reload()
+            transactions, changes = current.transactions, current.changes
+            for seq, old_json, new_json in entries:
+                old_row, new_row = (json.loads(row) if row else None for row in (old_json, new_json))
+                transactions = None if old_row is None and new_row is None else _apply_change(transactions, old_row, new_row)
+                if transactions is None: return self.reload()
+                changes += ((seq, old_row, new_row),)
+            self.snapshot = LedgerSnapshot(version, transactions, balances, changes[-MAX_TRACKED_CHANGES:], current.closed)
+            self._maybe_write_snapshot()
+            return self.snapshot
+
+    def _publish(self, version, deltas, old_row, new_row):
+        # Keep the before/after rows of recent writes so caches can catch up incrementally
+        current = self.snapshot
+        if version != current.version + 1: return self.sync()  # another process wrote in between; the log has both
+        transactions = _apply_change(current.transactions, old_row, new_row)
+        if transactions is None: return self.reload()
+        balances = dict(current.balances)
+        for key, amount in deltas.items(): balances[key] = balances.get(key, 0) + amount
+        changes = current.changes[-(MAX_TRACKED_CHANGES - 1):] + ((version, old_row, new_row),)
+        self.snapshot = LedgerSnapshot(version, transactions, balances, changes, current.closed)
+        self._maybe_write_snapshot()
+        return self.snapshot
+
+    def add(self, data):
+        # SQLite hands out the id: the next integer, never reused, so concurrent writers can't collide
+        data = {key: value for key, value in data.items() if key != 'id'}
+        deltas = _balance_deltas(data)
+        with self._lock, db_connection() as conn:
+            with conn:
+                version = _bump_ledger_version(conn)
+                _check_open_period(conn, data)
+                # Read back as stored, so the derived columns SQLite computed come along
+                new_row = _fetch_transaction_row(conn, conn.execute(INSERT_TRANSACTION_SQL, _transaction_params(data) + (version,)).lastrowid)
+                _apply_balance_deltas(conn, deltas)
+                _log_change(conn, version, new_row=new_row)
+            return self._publish(version, deltas, None, new_row)
+
+    def update(self, id, data):
+        id = int(id)
+        with self._lock:
+            with db_connection() as conn, conn:
+                old_row = _fetch_transaction_row(conn, id)
+                if old_row is None: return self.snapshot
+                version = _bump_ledger_version(conn)
+                _check_open_period(conn, old_row, data)
+                conn.execute(UPDATE_TRANSACTION_SQL, _transaction_params({**old_row, **data})[1:] + (version, id))
+                new_row = _fetch_transaction_row(conn, id)
+                deltas = _merge_deltas(_balance_deltas(old_row, sign=-1), _balance_deltas(new_row))
+                _apply_balance_deltas(conn, deltas)
+                _log_change(conn, version, old_row, new_row)
+            return self._publish(version, deltas, old_row, new_row)
+
+    def delete(self, transaction_id):
+        transaction_id = int(transaction_id)
+        with self._lock:
+            with db_connection() as conn, conn:
+                old_row = _fetch_transaction_row(conn, transaction_id)
+                if old_row is None: return self.snapshot
+                version = _bump_ledger_version(conn)
+                _check_open_period(conn, old_row)
+                conn.execute("DELETE FROM transactions WHERE id = ?", (transaction_id,))
+                conn.execute("INSERT OR REPLACE INTO deleted_transactions (id, row_version) VALUES (?, ?)", (transaction_id, version))
+                deltas = _balance_deltas(old_row, sign=-1)
+                _apply_balance_deltas(conn, deltas)
+                _log_change(conn, version, old_row=old_row)
+            return self._publish(version, deltas, old_row, None)
+
+def _check_open_period(conn, *rows):
+    # Closed periods are settled and their rows archived, so no write may add, move or remove a row dated in one
+    open_from = _open_period_start(conn)
+    if open_from is None: return
+    for row in rows:
+        day = pd.to_datetime(row.get('transaction_date'), errors='coerce')
+        if pd.notna(day) and str(day.date()) < open_from:
+            raise ValueError(f"{day.date()} falls in a closed period; the ledger is open from {open_from}")
+
+_ledger_stores = {}
+_ledger_stores_lock = threading.Lock()
+
+def get_ledger_store():
+    with _ledger_stores_lock:
+        if db.DB_FILE not in _ledger_stores: _ledger_stores[db.DB_FILE] = LedgerStore()
+        return _ledger_stores[db.DB_FILE]
+# --- FILTERED QUERIES ---
+# Filters and ordering are pushed down to SQLite so callers only materialize the rows they show. archived=True
+# reads the rows period closes moved out of the ledger instead.
+ORDERABLE_COLUMNS = {'transaction_date', 'person_name', 'transaction_type', 'input_amount', 'output_amount', 'id'}
+
+def _source_table(archived):
+    return 'archived_transactions' if archived else 'transactions'
+
+def query_transactions(order_by='transaction_date', descending=True, limit=None, offset=None, archived=False, **filters):
+    if order_by not in ORDERABLE_COLUMNS: raise ValueError(f"Cannot order transactions by {order_by!r}")
+    where, params = _transaction_filters(**filters)
+    direction = "DESC" if descending else "ASC"
+    sql = f"SELECT {TRANSACTION_SELECT} FROM {_source_table(archived)}{where} ORDER BY {order_by} {direction}, id {direction}"
+    if limit is not None:
+        sql += " LIMIT ? OFFSET ?"; params += [int(limit), int(offset or 0)]
+    with db_connection() as conn: return _ensure_data_types(pd.read_sql_query(sql, conn, params=params))
+
+def count_transactions(archived=False, **filters):
+    where, params = _transaction_filters(**filters)
+    with db_connection() as conn: return conn.execute(f"SELECT COUNT(*) FROM {_source_table(archived)}{where}", params).fetchone()[0]
+
+def get_transactions_page(after=None, page_size=25, archived=False, **filters):
+    # Keyset pagination on (transaction_date, id), newest first: each page costs O(page_size) however deep it is
+    where, params = _transaction_filters(**filters)
+    if after is not None:
+        where += (" AND " if where else " WHERE ") + "(transaction_date, id) < (?, ?)"; params += list(after)
+    sql = f"SELECT {TRANSACTION_SELECT}, transaction_date AS cursor_date FROM {_source_table(archived)}{where} ORDER BY transaction_date DESC, id DESC LIMIT ?"
+    params.append(int(page_size) + 1)
+    with db_connection() as conn: page = pd.read_sql_query(sql, conn, params=params)
+    next_cursor = None
+    if len(page) > page_size:
+        page = page.iloc[:page_size]
+        next_cursor = (page['cursor_date'].iloc[-1], int(page['id'].iloc[-1]))
+    return _ensure_data_types(page.drop(columns='cursor_date')), next_cursor
+
+def get_transaction(transaction_id):
+    found = query_transactions(transaction_id=transaction_id)
+    return None if found.empty else found.iloc[0].to_dict()
+
+# --- CONSTANTS AND HELPERS (UNCHANGED) ---
+TRANSACTION_TYPE_LABELS = {"buy_usdt_with_toman": "Buy USDT", "buy_crypto_with_usdt": "Buy Crypto", "sell": "Sell", "transfer": "Transfer", "swap": "Swap"}
+PEOPLE = ["hassan", "abbas", "shahla", "mohsen"]
+CRYPTOS = ["BTC", "ETH", "BNB", "SOL", "XRP", "USDC", "ADA", "DOGE", "DOT", "PAXG"]
+CURRENCIES = ["USDT"] + CRYPTOS
+
+def derive_fees(row):
+    # The derived fee columns a row would be stored with, from the same SQL, for forms to show before saving
+    inputs = ['transaction_type', 'input_amount', 'output_amount', 'rate', 'fee']
+    select = ', '.join(f"{sql} AS {name}" for name, sql in DERIVED_COLUMN_SQL.items())
+    with db_connection() as conn:
+        values = conn.execute(f"SELECT {select} FROM (SELECT {', '.join(f'? AS {col}' for col in inputs)})", [_to_db_value(row.get(col)) for col in inputs]).fetchone()
+    return dict(zip(DERIVED_COLUMN_SQL, values))
+
+def get_current_balance(person_name, currency_symbol, transactions_df=None, tx_id_to_exclude=None):
+    # Summed in integer units, so comparing to_units(amount) against to_units(balance) is exact
+    if transactions_df is not None:
+        # Ad-hoc frames (e.g. a hypothetical ledger) are still summed directly
+        if tx_id_to_exclude: transactions_df = transactions_df[transactions_df['id'] != tx_id_to_exclude]
+        if transactions_df.empty: return 0.0
+        person_tx = transactions_df[transactions_df['person_name'] == person_name]
+        gains = _to_units(person_tx[person_tx['output_currency'] == currency_symbol]['output_amount'], currency_symbol).sum()
+        losses = _to_units(person_tx[person_tx['input_currency'] == currency_symbol]['input_amount'], currency_symbol).sum()
+        return from_units(int(gains - losses), currency_symbol)
+
+    # Balance checks read the store's latest snapshot so writes from other sessions are accounted for
+    balance = get_ledger_store().snapshot.balances.get((person_name, currency_symbol), 0)
+    # If an ID is provided, back that transaction's contribution out of the balance
+    if tx_id_to_exclude:
+        with db_connection() as conn: excluded = _fetch_transaction_row(conn, int(tx_id_to_exclude))
+        if excluded is not None: balance -= _balance_deltas(excluded).get((person_name, currency_symbol), 0)
+    return from_units(balance, currency_symbol)
+
+# --- BULK IMPORT ---
+# Balance sufficiency is enforced for the same types the New Transaction form checks; toman purchases are funded externally
+BALANCE_CHECKED_TYPES = ['sell', 'transfer', 'swap']
+IMPORT_REQUIRED_COLUMNS = ['transaction_type', 'transaction_date', 'input_currency', 'output_currency', 'input_amount', 'output_amount']
+IMPORT_COLUMN_ALIASES = {
+    'type': 'transaction_type', 'side': 'transaction_type', 'operation': 'transaction_type',
+    'person': 'person_name', 'name': 'person_name', 'owner': 'person_name',
+    'date': 'transaction_date', 'time': 'transaction_date', 'timestamp': 'transaction_date', 'date_utc': 'transaction_date',
+    'from_currency': 'input_currency', 'sent_currency': 'input_currency', 'from_coin': 'input_currency',
+    'to_currency': 'output_currency', 'received_currency': 'output_currency', 'to_coin': 'output_currency',
+    'from_amount': 'input_amount', 'sent_amount': 'input_amount', 'amount_sent': 'input_amount',
+    'to_amount': 'output_amount', 'received_amount': 'output_amount', 'amount_received': 'output_amount',
+    'price': 'rate', 'commission': 'fee', 'fee_usd': 'fee', 'note': 'notes', 'memo': 'notes',
+}
+IMPORT_TYPE_ALIASES = {
+    **{key: key for key in TRANSACTION_TYPE_LABELS}, **{label.lower(): key for key, label in TRANSACTION_TYPE_LABELS.items()},
+    'withdraw': 'transfer', 'withdrawal': 'transfer', 'convert': 'swap', 'exchange': 'swap', 'trade': 'swap',
+}
+MAX_REPORTED_IMPORT_ERRORS = 50
+
+def _parse_import_dates(values):
+    # Fast path infers one format for the chunk; rows in another format get a slower per-value retry
+    dates = pd.to_datetime(values, errors='coerce', utc=True)
+    retry = dates.isna() & values.notna()
+    if retry.any(): dates[retry] = pd.to_datetime(values[retry], errors='coerce', utc=True, format='mixed')
+    return dates.dt.tz_localize(None)
+
+def _normalize_import_chunk(chunk, person_name=None, open_from=None):
+    # Map one chunk of an export onto the ledger columns; returns the valid rows and (line, reason) errors
+    chunk = chunk.rename(columns=lambda c: (lambda n: IMPORT_COLUMN_ALIASES.get(n, n))(str(c).strip().lower().replace(' ', '_')))
+    missing = [c for c in IMPORT_REQUIRED_COLUMNS + ([] if person_name else ['person_name']) if c not in chunk.columns]
+    if missing: raise ValueError(f"Import file is missing columns: {', '.join(missing)}")
+
+    text = lambda col: chunk[col].astype('string').str.strip()
+    rows = pd.DataFrame(index=chunk.index)
+    rows['person_name'] = text('person_name').str.lower() if 'person_name' in chunk.columns else person_name
+    if person_name and 'person_name' in chunk.columns: rows['person_name'] = rows['person_name'].fillna(person_name)
+    rows['input_currency'] = text('input_currency').str.upper()
+    rows['output_currency'] = text('output_currency').str.upper()
+    raw_type = text('transaction_type').str.lower()
+    mapped_type = raw_type.map(IMPORT_TYPE_ALIASES)
+    buy_type = pd.Series(np.where(rows['input_currency'] == 'IRR', 'buy_usdt_with_toman', 'buy_crypto_with_usdt'), index=chunk.index)
+    rows['transaction_type'] = mapped_type.where((raw_type != 'buy').fillna(True), buy_type)
+    dates = _parse_import_dates(chunk['transaction_date'])
+    rows['transaction_date'] = dates.dt.strftime('%Y-%m-%d %H:%M:%S')
+    for col in ['input_amount', 'output_amount', 'rate', 'fee']:
+        rows[col] = pd.to_numeric(chunk[col], errors='coerce') if col in chunk.columns else 0.0
+    rows[['rate', 'fee']] = rows[['rate', 'fee']].fillna(0.0)
+    rows['notes'] = text('notes').fillna('') if 'notes' in chunk.columns else ''
+
+    problems = [
+        (rows['transaction_type'].isna(), "unknown transaction type"),
+        (dates.isna(), "unreadable date"),
+        (dates < pd.Timestamp(open_from) if open_from else pd.Series(False, index=chunk.index), f"dated in a closed period (the ledger is open from {open_from})"),
+        (rows['person_name'].isna() | (rows['person_name'] == ''), "missing person"),
+        (rows['input_currency'].isna() | rows['output_currency'].isna(), "missing currency"),
+        (rows[['input_amount', 'output_amount']].isna().any(axis=1), "missing amount"),
+        ((rows[['input_amount', 'output_amount', 'fee']] < 0).any(axis=1), "negative amount"),
+        ((rows['transaction_type'] == 'transfer') & (rows['input_currency'] != rows['output_currency']), "transfer between different currencies"),
+    ]
+    invalid = pd.Series(False, index=chunk.index)
+    errors = []
+    for mask, reason in problems:
+        mask = mask.fillna(True) & ~invalid
+        errors += [(line + 2, reason) for line in chunk.index[mask]]  # +2: header line and 1-based numbering
+        invalid |= mask
+    return rows[~invalid], errors
+
+def _check_running_balances(chunk, balances):
+    # Replay one chronological chunk in integer units: each row debits its input leg, then credits its output
+    # leg. A checked row fails when its debit takes the running balance below zero.
+    count = len(chunk)
+    legs = pd.DataFrame({
+        'order': np.concatenate([np.arange(count) * 2, np.arange(count) * 2 + 1]),
+        'person_name': np.concatenate([chunk['person_name'].to_numpy(), chunk['person_name'].to_numpy()]),
+        'currency': np.concatenate([chunk['input_currency'].to_numpy(), chunk['output_currency'].to_numpy()]),
+        'amount': np.concatenate([-chunk['input_units'].to_numpy(dtype='int64'), chunk['output_units'].to_numpy(dtype='int64')]),
+    }).sort_values('order', kind='stable')
+    group = legs.groupby(['person_name', 'currency'], sort=False).ngroup().to_numpy()
+    keys = list(legs[['person_name', 'currency']].drop_duplicates().itertuples(index=False, name=None))
+    opening = np.array([balances.get(key, 0) for key in keys], dtype='int64')
+    legs['running'] = legs.groupby(group)['amount'].cumsum().to_numpy() + opening[group]
+    debits = legs[legs['order'] % 2 == 0]
+    failed = debits['running'].to_numpy() < 0
+    failed &= chunk['transaction_type'].isin(BALANCE_CHECKED_TYPES).to_numpy()[debits['order'].to_numpy() // 2]
+    for key, running in zip(keys, legs.groupby(group)['running'].last().to_numpy()): balances[key] = int(running)
+    return np.flatnonzero(failed)
+
+def _drop_secondary_indexes(conn):
+    # Returns the CREATE statements so the caller can rebuild the indexes once, sorted, after a bulk load
+    indexes = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'transactions' AND sql IS NOT NULL").fetchall()
+    for name, _ in indexes: conn.execute(f"DROP INDEX {name}")
+    return [sql for _, sql in indexes]
+
+def import_transactions_csv(source, person_name=None, chunk_size=50_000):
+    # Streams the file chunk by chunk: validate, executemany into one open transaction, then replay the new
+    # rows in date order against the opening balances. Any problem rolls the whole import back.
+    errors, source_lines, imported, dropped_indexes, deferred_summary = [], [], 0, [], False
+    with db_connection() as conn:
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # AUTOINCREMENT numbers the new rows on from the highest id ever used, one after another
+            first_rowid = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'transactions'").fetchone()[0]
+            version, open_from = _bump_ledger_version(conn), _open_period_start(conn)
+            _log_change(conn, version)  # too many rows to log one by one: readers reload
+            for chunk in pd.read_csv(source, chunksize=chunk_size, dtype=str, skipinitialspace=True):
+                rows, chunk_errors = _normalize_import_chunk(chunk, person_name, open_from)
+                errors += chunk_errors
+                if errors or rows.empty: continue
+                if imported == 0 and len(rows) >= chunk_size:
+                    # A large import: maintaining the random-order indexes and the summary row by row costs far more than rebuilding them
+                    dropped_indexes = _drop_secondary_indexes(conn); _drop_summary_triggers(conn); deferred_summary = True
+                rows.insert(0, 'id', None)  # SQLite assigns the ids
+                for amount, (_, currency) in AMOUNT_UNITS.items(): rows[amount] = _to_units(rows[amount], rows[currency])  # written as units
+                conn.executemany(INSERT_TRANSACTION_SQL, zip(*(rows[c].to_numpy(dtype=object) for c in TRANSACTION_COLUMNS), repeat(version)))
+                source_lines.append(rows.index.to_numpy() + 2)
+                imported += len(rows)
+
+            for index_sql in dropped_indexes: conn.execute(index_sql)
+            if not errors and imported:
+                source_lines = np.concatenate(source_lines)
+                balances = {(p, c): a for p, c, a in conn.execute("SELECT person_name, currency, amount FROM balances")}
+                short = set()
+                cursor = conn.execute('''SELECT rowid, person_name, transaction_type, input_currency, output_currency, input_units, output_units
+                    FROM transactions WHERE rowid > ? ORDER BY +transaction_date, rowid''', (first_rowid,))
+                while batch := cursor.fetchmany(chunk_size):
+                    chunk = pd.DataFrame(batch, columns=['rowid', 'person_name', 'transaction_type', 'input_currency', 'output_currency', 'input_units', 'output_units'])
+                    for position in _check_running_balances(chunk, balances):
+                        # Later rows on an already short (person, currency) would only repeat the same shortfall
+                        row = chunk.iloc[position]
+                        if (row['person_name'], row['input_currency']) in short: continue
+                        short.add((row['person_name'], row['input_currency']))
+                        errors.append((int(source_lines[row['rowid'] - first_rowid - 1]), f"insufficient {row['input_currency']} balance for {row['person_name']}"))
+                    if len(errors) >= MAX_REPORTED_IMPORT_ERRORS: break
+
+            if errors or not imported:
+                conn.rollback()
+                return {'imported': 0, 'errors': sorted(errors)[:MAX_REPORTED_IMPORT_ERRORS], 'error_count': len(errors)}
+            if deferred_summary:
+                _add_to_ledger_summary(conn, " AND id > ?", (first_rowid,)); _create_summary_triggers(conn)
+            # The replay ended on the closing balance of every (person, currency) the import touched
+            conn.executemany("INSERT INTO balances (person_name, currency, amount) VALUES (?, ?, ?) "
+                             "ON CONFLICT(person_name, currency) DO UPDATE SET amount = excluded.amount",
+                             [(p, c, int(a)) for (p, c), a in balances.items()])
+            conn.commit()
+        except Exception:
+            conn.rollback(); raise
+    return {'imported': imported, 'errors': [], 'error_count': 0}
+
+# --- PERIOD CLOSE ---
+def open_period_start():
+    # First day new transactions may be dated on, or None while no period has been closed
+    with db_connection() as conn: return _open_period_start(conn)
+
+def close_period(through):
+    # Settles everything dated on or before `through` (which must be in the past): the rows move to
+    # archived_transactions, their summary sums to closed_summary and the closing balances are recorded.
+    # Readers see a new ledger_id and reload without the archived rows.
+    open_from = str(_as_datetime(through).date() + timedelta(days=1))
+    if open_from > str(date.today()): raise ValueError("only periods that have already ended can be closed")
+    where = " WHERE date(transaction_date) < ?"  # rows with an unreadable date have no period and stay open
+    columns = f"{STORED_SELECT}, {', '.join(DERIVED_COLUMN_SQL)}, row_version"
+    with db_connection() as conn:
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            previous = _open_period_start(conn)
+            if previous is not None and open_from <= previous: raise ValueError(f"periods before {previous} are already closed")
+            close_id = conn.execute("INSERT INTO period_closes (closed_before, closed_at, archived_rows) VALUES (?, datetime('now'), 0)", (open_from,)).lastrowid
+            archived = conn.execute(f"INSERT INTO archived_transactions ({columns}, close_id) SELECT {columns}, ? FROM transactions{where}", (close_id, open_from)).rowcount
+            # Summary rows are per day, so the closed days' rows move over whole; the triggers would only subtract them again
+            summary = ', '.join(SUMMARY_KEY + SUMMARY_SUMS)
+            conn.execute(f"INSERT INTO closed_summary ({summary}) SELECT {summary} FROM ledger_summary WHERE day != '' AND day < ? "
+                         f"ON CONFLICT ({', '.join(SUMMARY_KEY)}) DO UPDATE SET {', '.join(f'{c} = {c} + excluded.{c}' for c in SUMMARY_SUMS)}", (open_from,))
+            conn.execute("DELETE FROM ledger_summary WHERE day != '' AND day < ?", (open_from,))
+            _drop_summary_triggers(conn)
+            conn.execute(f"DELETE FROM transactions{where}", (open_from,))
+            _create_summary_triggers(conn)
+            conn.execute(f"INSERT INTO closing_balances (close_id, person_name, currency, amount) SELECT ?, * FROM ({_balance_sums_sql(table='archived_transactions')})", (close_id,))
+            conn.execute("UPDATE period_closes SET archived_rows = ? WHERE id = ?", (archived, close_id))
+            version = _bump_ledger_version(conn)
+            _log_change(conn, version)  # readers reload...
+            conn.execute("UPDATE ledger_meta SET value = abs(random()) WHERE key = 'ledger_id'")  # ...in full, snapshot files included
+            conn.commit()
+        except Exception:
+            conn.rollback(); raise
+    store = _ledger_stores.get(db.DB_FILE)
+    if store is not None: store.reload()
+    return {'close_id': close_id, 'open_from': open_from, 'archived': archived}
@@ -0,0 +1,102 @@
+# Portfolio summaries answered by SQLite from the trigger-maintained ledger_summary table (plus closed_summary,
+# the closed periods' checkpoint): the holdings, toman, fee and P/L tables and the value series, without loading
+# the ledger rows into memory.
+import pandas as pd
+from .db import SUMMARY_SUMS, db_connection, _ledger_version, _amount_sql
+from .perf import timed
+from .analysis import _summary_parts, _finalize_analysis, _price_key, portfolio_value_series
+
+# Open and closed periods' sums; a day is only ever in one of the two tables
+SUMMARY_SOURCE = "(SELECT * FROM ledger_summary UNION ALL SELECT * FROM closed_summary)"
+
+def _summary_frame(conn, by_day, person=None, by_year=False):
+    # Summary rows collapsed to what the caller needs; the day only matters when prices vary by day, and by_year
+    # keeps the year apart when it doesn't
+    keys = ['person_name', 'transaction_type', 'input_currency', 'output_currency'] + (['day'] if by_day else ['year'] if by_year else [])
+    where, params = "", []
+    if person:
+        where, params = f" WHERE person_name IN ({', '.join('?' * len(person))})", list(person)
+    select = ', '.join("substr(day, 1, 4) AS year" if key == 'year' else key for key in keys)
+    cursor = conn.execute(f"SELECT {select}, {', '.join(f'SUM({c})' for c in SUMMARY_SUMS)} FROM {SUMMARY_SOURCE}{where} GROUP BY {', '.join(keys)}", params)
+    frame = pd.DataFrame(cursor.fetchall(), columns=keys + SUMMARY_SUMS)
+    for col in keys: frame[col] = frame[col].astype(object).replace('', None)
+    for col in SUMMARY_SUMS: frame[col] = frame[col].astype('float64')
+    return frame
+
+@timed('summary_financial_analysis')
+def summary_financial_analysis(prices, history=None, person=None):
+    # Same four tables as analysis.generate_financial_analysis over the whole ledger (or some people)
+    by_day = history is not None and not history.empty
+    with db_connection() as conn: summary = _summary_frame(conn, by_day, person)
+    if summary.empty:
+        empty_df = pd.DataFrame()
+        return empty_df, empty_df, empty_df, empty_df
+    return _finalize_analysis(_summary_parts(summary, prices, history), prices)
+
+@timed('summary_value_series')
+def summary_value_series(prices, history=None, person=None):
+    # The series only looks at each day's net change per currency, so that is all SQLite hands back;
+    # each change goes in as a one-legged transaction
+    where, params = "day != ''", []
+    if person:
+        where += f" AND person_name IN ({', '.join('?' * len(person))})"; params = list(person)
+    with db_connection() as conn:
+        rows = conn.execute(f'''
+        SELECT person_name, currency, day, {_amount_sql('SUM(units)', 'currency')} FROM (
+            SELECT person_name, output_currency AS currency, day, output_units AS units FROM {SUMMARY_SOURCE} WHERE {where} AND output_currency != ''
+            UNION ALL SELECT person_name, input_currency, day, -input_units FROM {SUMMARY_SOURCE} WHERE {where} AND input_currency != ''
+        ) GROUP BY person_name, currency, day''', params + params).fetchall()
+    legs = pd.DataFrame(rows, columns=['person_name', 'output_currency', 'transaction_date', 'output_amount'])
+    legs['transaction_date'] = pd.to_datetime(legs['transaction_date'], format='%Y-%m-%d')
+    legs['input_currency'], legs['input_amount'] = None, 0.0
+    return portfolio_value_series(legs, prices, history)
+
+def ledger_symbols():
+    # Currencies anyone has held, as LedgerSnapshot.symbols() reports them, from the balances table
+    with db_connection() as conn:
+        return [currency for (currency,) in conn.execute("SELECT DISTINCT currency FROM balances WHERE currency != 'IRR' ORDER BY currency")]
+
+def ledger_version():
+    with db_connection() as conn: return _ledger_version(conn)
+
+def update_summary_cache(cache, build, prices, history=None, history_version=0):
+    # `build` is summary_financial_analysis or summary_value_series; rerun only after a write, a new quote or a back-fill
+    key = (build.__name__, ledger_version(), _price_key(prices), history_version)
+    if cache is not None and cache['key'] == key: return cache
+    return {'key': key, 'result': build(prices, history)}
+
+# --- YEARLY REPORTS ---
+# Per person and calendar year, from the same day-level sums as the dashboard; a summary without a readable day
+# is reported under a blank year
+def _yearly_parts(prices, history=None, person=None):
+    by_day = history is not None and not history.empty
+    with db_connection() as conn: summary = _summary_frame(conn, by_day, person, by_year=True)
+    if summary.empty: return None, []
+    years = (summary['day'].str[:4] if by_day else summary['year']).fillna('')
+    return _summary_parts(summary, prices, history), [(year, _summary_parts(rows, prices, history)) for year, rows in summary.groupby(years, sort=True)]
+
+def yearly_realized_pnl(prices, history=None, person=None):
+    # Each year's disposals against the average buy price over the whole history, as the dashboard prices them,
+    # so the years add up to its realized P/L
+    columns = ['person_name', 'year', 'currency', 'amount_disposed', 'net_proceeds_usd', 'avg_buy_price', 'cost_basis_usd', 'realized_pnl']
+    full, years = _yearly_parts(prices, history, person)
+    frames = [parts['disposals'].drop(columns='rows').reset_index().assign(year=year) for year, parts in years if not parts['disposals'].empty]
+    if not frames or full['cost_basis'].empty: return pd.DataFrame(columns=columns)
+    report = pd.concat(frames, ignore_index=True)
+    cost_basis = full['cost_basis']
+    report = report.join((cost_basis['total_cost_usd'] / cost_basis['total_amount_crypto']).rename('avg_buy_price'), on=['person_name', 'currency'])
+    report['cost_basis_usd'] = report['amount_disposed'] * report['avg_buy_price']
+    report['realized_pnl'] = report['net_proceeds_usd'] - report['cost_basis_usd']
+    return report[columns].sort_values(['person_name', 'year', 'currency'], ignore_index=True)
+
+def yearly_fees(prices, history=None, person=None):
+    # Fees paid (in USD) per person, year and transaction type, with how many transactions paid one
+    columns = ['person_name', 'year', 'transaction_type', 'transactions', 'fee']
+    _, years = _yearly_parts(prices, history, person)
+    frames = [parts['fees'].reset_index().rename(columns={'rows': 'transactions'}).assign(year=year) for year, parts in years if not parts['fees'].empty]
+    if not frames: return pd.DataFrame(columns=columns)
+    report = pd.concat(frames, ignore_index=True)
+    report['transactions'] = report['transactions'].astype('int64')
+    return report[columns].sort_values(['person_name', 'year', 'transaction_type'], ignore_index=True)
+
+YEARLY_REPORTS = {'realized_pnl': yearly_realized_pnl, 'fees': yearly_fees}
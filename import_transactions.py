@@ -0,0 +1,6 @@
+# Kept for existing scripts: the same as `python -m crypto_ledger import ...`
+import sys
+from crypto_ledger.cli import main
+
+if __name__ == "__main__":
+    sys.exit(main(["import"] + sys.argv[1:]))
@@ -1,14 +1,15 @@
 import streamlit as st
 import pandas as pd
 import datetime
-from utils import add_transaction, get_current_balance, PEOPLE, CURRENCIES, CRYPTOS, update_prices_in_state
+from utils import initialize_state, add_transaction, get_current_balance, to_units, derive_fees, open_period_start, PEOPLE, CURRENCIES, CRYPTOS, update_prices_in_state
 
 st.set_page_config(page_title="New Transaction", layout="centered")
+initialize_state()
 st.title("Record a New Transaction")
-update_prices_in_state(CURRENCIES)
-
 person_name = st.selectbox("Person", options=PEOPLE, format_func=lambda x: x.capitalize())
-transaction_date = st.date_input("Transaction Date", datetime.date.today())
+# Closed periods are settled, so the earliest date offered is the first open day
+open_from = open_period_start()
+transaction_date = st.date_input("Transaction Date", datetime.date.today(), min_value=datetime.date.fromisoformat(open_from) if open_from else None)
 transaction_type = st.selectbox("Transaction Type", ["Buy", "Sell", "Transfer", "Swap"])
 st.markdown("---")
 
@@ -25,7 +26,7 @@ if transaction_type == "Buy":
             usdt_rate = c2.number_input("Stated USDT Rate", min_value=0, format="%d")
             notes = st.text_area("Notes (Optional)")
             if amount_toman > 0 and usdt_rate > 0 and amount_usdt > 0:
-                fee_usd = (amount_toman / usdt_rate) - amount_usdt
+                fee_usd = derive_fees({"transaction_type": "buy_usdt_with_toman", "input_amount": amount_toman, "output_amount": amount_usdt, "rate": usdt_rate})['fee_usd']
                 st.info(f"Calculated Hidden Fee: {fee_usd:,.4f} USDT")
             if st.form_submit_button("Save Transaction"):
                 form_data.update({"transaction_type": "buy_usdt_with_toman", "input_currency": "IRR", "output_currency": "USDT", "input_amount": amount_toman, "output_amount": amount_usdt, "rate": usdt_rate, "notes": notes, "fee": 0})
@@ -65,9 +66,11 @@ else:
         if transaction_type in ["Sell", "Swap"]:
              fee = st.number_input("Explicit Fee (in USD, if any)", min_value=0.0, format="%.8f")
         
+        if transaction_type in ["Sell", "Swap"]: update_prices_in_state([input_currency, output_currency])
         prices = st.session_state.get('prices', {})
         if transaction_type == "Transfer" and input_amount > output_amount:
-            st.info(f"Calculated Transfer Fee: {input_amount - output_amount:,.8f} {input_currency}")
+            fee_amount = derive_fees({"transaction_type": "transfer", "input_amount": input_amount, "output_amount": output_amount})['fee_amount']
+            st.info(f"Calculated Transfer Fee: {fee_amount:,.8f} {input_currency}")
         elif transaction_type in ["Sell", "Swap"] and input_amount > 0 and prices.get(input_currency, 0) > 0:
             value_given_usd = input_amount * prices[input_currency]
             value_received_usd = output_amount * prices.get(output_currency, 1.0)
@@ -79,7 +82,7 @@ else:
 
         if st.form_submit_button("Save Transaction"):
             current_balance = get_current_balance(person_name, input_currency)
-            if round(input_amount, 8) > round(current_balance, 8):
+            if to_units(input_amount, input_currency) > to_units(current_balance, input_currency):
                 st.error(f"Insufficient balance. You have {current_balance:,.8f} {input_currency} but are trying to use {input_amount:,.8f}.")
             else:
                 form_data.update({"transaction_type": transaction_type.lower(), "input_currency": input_currency, "output_currency": output_currency, "input_amount": input_amount, "output_amount": output_amount, "fee": fee, "notes": notes})
@@ -1,6 +1,6 @@
 import streamlit as st
 import pandas as pd
-from utils import initialize_state, get_all_transactions, delete_transaction, TRANSACTION_TYPE_LABELS, generate_financial_analysis
+from utils import initialize_state, get_transaction, get_transactions_page, count_transactions, delete_transaction, open_period_start, TRANSACTION_TYPE_LABELS, PEOPLE, CURRENCIES
 
 st.set_page_config(page_title="Transaction History", layout="wide")
 
@@ -34,15 +34,17 @@ TYPE_TO_BADGE_CLASS = {
     "sell": "sell-badge", "transfer": "transfer-badge", "swap": "swap-badge"
 }
 
+PAGE_SIZES = [10, 25, 50, 100]
+
 initialize_state()
 if 'confirming_delete_id' not in st.session_state: st.session_state.confirming_delete_id = None
-transactions = get_all_transactions()
 st.title("Transaction History")
 
 if st.session_state.confirming_delete_id:
     # ... (منطق تایید حذف بدون تغییر)
     try:
-        tx_to_delete = transactions[transactions['id'] == st.session_state.confirming_delete_id].iloc[0]
+        tx_to_delete = get_transaction(st.session_state.confirming_delete_id)
+        if tx_to_delete is None: raise LookupError(st.session_state.confirming_delete_id)
         st.warning("Are you sure you want to permanently delete this transaction?")
         col1, col2, _ = st.columns([1,1,5])
         if col1.button("✅ Yes, delete", type="primary"):
@@ -53,11 +55,38 @@ if st.session_state.confirming_delete_id:
         st.session_state.confirming_delete_id = None; st.rerun()
 else:
     st.markdown("View, filter, and manage all your transactions.")
-    if transactions.empty:
+
+    # --- Filters: pushed down to SQLite, only the visible page is fetched ---
+    f1, f2, f3 = st.columns(3)
+    people = f1.multiselect("Person", PEOPLE, format_func=lambda x: x.capitalize())
+    currencies = f2.multiselect("Currency", ["IRR"] + CURRENCIES)
+    types = f3.multiselect("Type", list(TRANSACTION_TYPE_LABELS), format_func=lambda x: TRANSACTION_TYPE_LABELS[x])
+    d1, d2, d3 = st.columns(3)
+    start_date = d1.date_input("From", value=None)
+    end_date = d2.date_input("To", value=None)
+    page_size = d3.selectbox("Rows per page", PAGE_SIZES, index=1)
+    # Rows of closed periods live in the archive: viewable, but no longer editable
+    open_from = open_period_start()
+    archived = bool(open_from) and st.toggle(f"Closed periods (before {open_from})")
+    filters = {"person": people or None, "currencies": currencies or None, "transaction_types": types or None, "start_date": start_date, "end_date": end_date, "archived": archived}
+
+    # Keyset cursors of the pages visited so far; any filter change starts again from the newest page
+    filter_key = (tuple(people), tuple(currencies), tuple(types), start_date, end_date, page_size, archived)
+    if st.session_state.get('history_filter_key') != filter_key:
+        st.session_state.history_filter_key = filter_key
+        st.session_state.history_cursors = [None]
+    cursors = st.session_state.history_cursors
+
+    total = count_transactions(**filters)
+    if total == 0:
         st.warning("No transactions found."); st.stop()
-    
-    portfolio_df, _, _, _ = generate_financial_analysis(transactions, st.session_state.get('prices', {}))
-    
+
+    transactions, next_cursor = get_transactions_page(after=cursors[-1], page_size=page_size, **filters)
+    if transactions.empty and len(cursors) > 1:
+        cursors.pop(); st.rerun()
+    first_row = (len(cursors) - 1) * page_size + 1
+    st.caption(f"Showing {first_row:,}–{first_row + len(transactions) - 1:,} of {total:,} transactions")
+
     for index, row in transactions.iterrows():
         # Each transaction is now in its own clean container
         with st.container(border=True):
@@ -84,9 +113,17 @@ else:
                 st.markdown(f"**Input:** {row.get('input_amount', 0):,.8f} {row['input_currency']}")
                 st.markdown(f"**Output:** {row.get('output_amount', 0):,.8f} {row['output_currency']}")
             with c3:
+                if archived: st.caption("Archived"); continue
                 if st.button("✍️ Edit", key=f"edit_{row['id']}"):
                     st.session_state.edit_transaction_id = row['id']
                     st.switch_page("pages/5_Edit_Transaction.py")
                 if st.button("🗑️ Delete", key=f"delete_{row['id']}"):
                     st.session_state.confirming_delete_id = row['id']
                     st.rerun()
+
+    prev_col, page_col, next_col = st.columns([1, 3, 1])
+    if prev_col.button("← Newer", disabled=len(cursors) == 1):
+        cursors.pop(); st.rerun()
+    page_col.caption(f"Page {len(cursors):,} of {max(1, -(-total // page_size)):,}")
+    if next_col.button("Older →", disabled=next_cursor is None):
+        cursors.append(next_cursor); st.rerun()
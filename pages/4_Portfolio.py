@@ -1,7 +1,7 @@
 import streamlit as st
 import pandas as pd
 import time
-from utils import initialize_state, get_all_transactions, update_prices_in_state, generate_financial_analysis
+from utils import initialize_state, get_all_transactions, get_ledger_symbols, update_prices_in_state, get_financial_analysis, get_lot_report, COST_BASIS_METHODS
 
 st.set_page_config(page_title="Detailed Portfolio", layout="wide")
 
@@ -19,11 +19,7 @@ if transactions.empty:
     st.warning("No transactions recorded yet. Add a new transaction to see data.")
     st.stop()
     
-# --- FIX: Handle empty transactions DataFrame ---
-unique_symbols = []
-if not transactions.empty:
-    all_symbols = pd.concat([transactions['input_currency'], transactions['output_currency']]).dropna().unique()
-    unique_symbols = [s for s in all_symbols if s != 'IRR']
+unique_symbols = get_ledger_symbols()
 
 update_prices_in_state(unique_symbols)
 if st.button("Refresh Live Prices"): update_prices_in_state(unique_symbols, force_refresh=True)
@@ -35,7 +31,7 @@ st.caption("Price data provided by CoinGecko.")
 st.markdown("---")
 
 prices = st.session_state.get('prices', {})
-portfolio_df, _, _, _ = generate_financial_analysis(transactions, prices)
+portfolio_df, _, _, _ = get_financial_analysis(prices)
 
 if portfolio_df.empty or 'floating_pnl_usd' not in portfolio_df.columns:
     st.info("No current holdings with cost basis to analyze.")
@@ -60,3 +56,25 @@ for person in people:
             },
             column_order=("currency", "amount", "current_value_usd", "floating_pnl_usd", "floating_pnl_percent", "avg_buy_price", "current_price")
         )
+
+st.markdown("---")
+st.subheader("Tax Lots")
+method = st.selectbox("Cost Basis Method", options=list(COST_BASIS_METHODS), format_func=lambda m: f"{m.upper()} - {COST_BASIS_METHODS[m]}")
+open_lots_df, disposals_df = get_lot_report(prices, method)
+lots_tab, disposals_tab = st.tabs(["Open Lots", "Realized by Lot"])
+with lots_tab:
+    if open_lots_df.empty: st.info("No open lots.")
+    else: st.dataframe(open_lots_df, hide_index=True, use_container_width=True,
+        column_config={"person_name": "Person", "currency": "Asset", "acquired": st.column_config.DatetimeColumn("Acquired", format="YYYY-MM-DD HH:mm"), "transaction_id": None,
+                       "amount": st.column_config.NumberColumn("Amount", format="%.8f"), "unit_cost_usd": st.column_config.NumberColumn("Unit Cost (USD)", format="$%.2f"), "cost_usd": st.column_config.NumberColumn("Cost (USD)", format="$%.2f")})
+with disposals_tab:
+    if disposals_df.empty: st.info("No disposals recorded yet.")
+    else:
+        st.dataframe(disposals_df.groupby(['person_name', 'currency'], as_index=False)['realized_pnl'].sum(), hide_index=True, use_container_width=True,
+            column_config={"person_name": "Person", "currency": "Asset", "realized_pnl": st.column_config.NumberColumn("Realized P/L (USD)", format="$%.2f")})
+        with st.expander("See every lot consumed"):
+            st.dataframe(disposals_df, hide_index=True, use_container_width=True,
+                column_config={"person_name": "Person", "currency": "Asset", "disposed": st.column_config.DatetimeColumn("Disposed", format="YYYY-MM-DD HH:mm"), "transaction_id": None, "kind": "Type",
+                               "acquired": st.column_config.DatetimeColumn("Acquired", format="YYYY-MM-DD HH:mm"), "lot_transaction_id": None, "amount": st.column_config.NumberColumn("Amount", format="%.8f"),
+                               "proceeds_usd": st.column_config.NumberColumn("Proceeds (USD)", format="$%.2f"), "cost_basis_usd": st.column_config.NumberColumn("Cost Basis (USD)", format="$%.2f"),
+                               "realized_pnl": st.column_config.NumberColumn("Realized P/L (USD)", format="$%.2f")})
@@ -1,8 +1,9 @@
 import streamlit as st
 import pandas as pd
-from utils import get_all_transactions, update_transaction, get_current_balance, PEOPLE, CURRENCIES, CRYPTOS
+from utils import initialize_state, get_transaction, update_transaction, get_current_balance, to_units, open_period_start, PEOPLE, CURRENCIES, CRYPTOS
 
 st.set_page_config(page_title="Edit Transaction", layout="centered")
+initialize_state()
 
 if 'edit_transaction_id' not in st.session_state or not st.session_state.edit_transaction_id:
     st.warning("Please select a transaction to edit from the 'Transaction History' page.")
@@ -10,9 +11,8 @@ if 'edit_transaction_id' not in st.session_state or not st.session_state.edit_tr
     st.stop()
 
 transaction_id = st.session_state.edit_transaction_id
-try:
-    tx_data = get_all_transactions().loc[lambda df: df['id'] == transaction_id].iloc[0].to_dict()
-except IndexError:
+tx_data = get_transaction(transaction_id)
+if tx_data is None:
     st.error("Transaction not found. It might have been deleted.")
     st.session_state.edit_transaction_id = None
     st.stop()
@@ -22,13 +22,15 @@ st.caption(f"ID: `{transaction_id}`")
 st.markdown("---")
 
 tx_type = tx_data['transaction_type']
+open_from = open_period_start()
+min_date = pd.Timestamp(open_from).date() if open_from else None  # a row can't be moved into a closed period
 
 # --- FORM 1: Buy USDT with Toman ---
 if tx_type == 'buy_usdt_with_toman':
     with st.form("edit_buy_usdt_form"):
         st.subheader("Edit: Buy USDT with Toman")
         person_name = st.selectbox("Person", options=PEOPLE, index=PEOPLE.index(tx_data['person_name']))
-        transaction_date = st.date_input("Date", value=pd.to_datetime(tx_data['transaction_date']))
+        transaction_date = st.date_input("Date", value=pd.to_datetime(tx_data['transaction_date']), min_value=min_date)
         amount_toman = st.number_input("Amount Toman (IRR)", value=int(tx_data.get('input_amount', 0)), format="%d")
         c1, c2 = st.columns(2)
         amount_usdt = c1.number_input("Amount USDT Received", value=float(tx_data.get('output_amount', 0.0)), format="%.8f")
@@ -46,7 +48,7 @@ elif tx_type == 'buy_crypto_with_usdt':
     with st.form("edit_buy_crypto_form"):
         st.subheader("Edit: Buy Crypto with USDT")
         person_name = st.selectbox("Person", options=PEOPLE, index=PEOPLE.index(tx_data['person_name']))
-        transaction_date = st.date_input("Date", value=pd.to_datetime(tx_data['transaction_date']))
+        transaction_date = st.date_input("Date", value=pd.to_datetime(tx_data['transaction_date']), min_value=min_date)
         
         output_currency = st.selectbox("Crypto to Buy", options=CRYPTOS, index=CRYPTOS.index(tx_data['output_currency']))
         c1, c2 = st.columns(2)
@@ -70,7 +72,7 @@ else:
     with st.form("edit_disposal_form"):
         st.subheader(f"Edit: {tx_type.replace('_', ' ').capitalize()}")
         person_name = st.selectbox("Person", options=PEOPLE, index=PEOPLE.index(tx_data['person_name']))
-        transaction_date = st.date_input("Date", value=pd.to_datetime(tx_data['transaction_date']))
+        transaction_date = st.date_input("Date", value=pd.to_datetime(tx_data['transaction_date']), min_value=min_date)
         
         input_currency = st.selectbox("Input/Source Currency", options=CURRENCIES, index=CURRENCIES.index(tx_data['input_currency']))
         input_amount = st.number_input("Input/Given Amount", value=float(tx_data.get('input_amount', 0.0)), format="%.8f")
@@ -89,7 +91,7 @@ else:
             balance_without_this_tx = get_current_balance(person_name, input_currency, tx_id_to_exclude=transaction_id)
             total_available_funds = balance_without_this_tx + float(tx_data['input_amount'])
             
-            if round(input_amount, 8) > round(total_available_funds, 8):
+            if to_units(input_amount, input_currency) > to_units(total_available_funds, input_currency):
                 st.error(f"Insufficient balance. You only have {total_available_funds:,.8f} {input_currency} available for this transaction.")
             else:
                 form_data = tx_data.copy()
@@ -0,0 +1,27 @@
+import streamlit as st
+import pandas as pd
+from utils import initialize_state, sync_session_ledger, get_ledger_store, PEOPLE
+
+st.set_page_config(page_title="Import Transactions", layout="centered")
+initialize_state()
+st.title("Import Transactions")
+st.markdown("Upload a CSV export. Columns are matched by name: `type`, `date`, `from_currency`, `to_currency`, `from_amount`, `to_amount`, and optionally `person`, `rate`, `fee`, `notes`.")
+st.caption("Types may be Buy, Buy USDT, Buy Crypto, Sell, Transfer or Swap. The file is imported as a whole or not at all.")
+
+uploaded_file = st.file_uploader("CSV file", type=["csv"])
+person_name = st.selectbox("Person", options=[None] + PEOPLE, format_func=lambda x: "Use the file's person column" if x is None else x.capitalize())
+
+if uploaded_file is not None and st.button("Import Transactions", type="primary"):
+    with st.spinner("Importing..."):
+        try:
+            result = get_ledger_store().bulk_import(uploaded_file, person_name=person_name)
+        except ValueError as e:
+            st.error(str(e)); st.stop()
+    sync_session_ledger()
+    if result['imported']:
+        st.success(f"Imported {result['imported']:,} transactions.")
+    elif result['error_count'] == 0:
+        st.warning("The file has no transactions to import.")
+    else:
+        st.error(f"Nothing was imported: {result['error_count']:,} problem(s) found.")
+        st.dataframe(pd.DataFrame(result['errors'], columns=["Line", "Problem"]), hide_index=True, use_container_width=True)
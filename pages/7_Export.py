@@ -0,0 +1,25 @@
+import streamlit as st
+from utils import initialize_state, get_ledger_symbols, update_prices_in_state, count_transactions, export_download, EXPORT_MIME, XLSX_MAX_ROWS, PEOPLE
+
+st.set_page_config(page_title="Export", layout="centered")
+initialize_state()
+st.title("Export")
+st.markdown("Download every transaction, or realized P/L and fees per person and year. Files are built when you click, straight from the database in batches.")
+
+REPORTS = {'transactions': "All transactions", 'realized_pnl': "Realized P/L per person and year", 'fees': "Fees per person and year"}
+FORMATS = {'csv.zip': "CSV (zipped)", 'csv': "CSV", 'xlsx': "Excel"}
+
+report = st.selectbox("Report", options=list(REPORTS), format_func=REPORTS.get)
+fmt = st.radio("Format", options=list(FORMATS), format_func=FORMATS.get, horizontal=True)
+people = st.multiselect("Person", PEOPLE, format_func=lambda x: x.capitalize(), placeholder="Everyone") or None
+
+if report == 'transactions':
+    total = count_transactions(person=people) + count_transactions(archived=True, person=people)
+    st.caption(f"{total:,} transactions, oldest first, closed periods included.")
+    if fmt == 'xlsx' and total >= XLSX_MAX_ROWS: st.caption("An Excel sheet holds about a million rows, so the workbook continues on further sheets.")
+else:
+    update_prices_in_state(get_ledger_symbols())
+    st.caption("Priced as on the Dashboard: each year's disposals against the average buy price over the whole history.")
+
+st.download_button("Download", data=export_download(report, fmt, st.session_state.prices, people), file_name=f"{report}.{fmt}",
+                   mime=EXPORT_MIME[fmt], on_click="ignore", type="primary")
@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+import pytest
+from crypto_ledger import db, store
+from crypto_ledger.bench import SYNTHETIC_PRICES, SYNTHETIC_SPAN
+
+@pytest.fixture(autouse=True)
+def ledger_db(tmp_path):
+    # Every test gets its own database file and a fresh store for it
+    previous = db.DB_FILE
+    db.set_database_file(str(tmp_path / 'ledger.db'))
+    yield db.DB_FILE
+    ledger = store._ledger_stores.pop(db.DB_FILE, None)
+    if ledger is not None: ledger.wait_for_snapshot_file()
+    db.set_database_file(previous)
+
+@pytest.fixture
+def prices():
+    return dict(SYNTHETIC_PRICES)
+
+@pytest.fixture
+def history(prices):
+    # A daily random walk around each synthetic quote across the synthetic ledger's span
+    rng = np.random.default_rng(1)
+    days = pd.date_range(*SYNTHETIC_SPAN)
+    crypto = [currency for currency in prices if currency != 'USDT']
+    walk = np.exp(np.cumsum(rng.normal(0, 0.02, (len(crypto), len(days))), axis=1))
+    return pd.DataFrame({'currency': np.repeat(crypto, len(days)), 'price_date': np.tile(days.values, len(crypto)),
+                         'price': (np.array([prices[c] for c in crypto])[:, None] * walk).ravel()})
@@ -0,0 +1,53 @@
+import csv
+import io
+import re
+import zipfile
+import pandas as pd
+from crypto_ledger import db, export
+from crypto_ledger.bench import build_synthetic_database
+from crypto_ledger.export import transaction_rows, write_csv, write_xlsx, export_file, export_transactions_csv, frame_rows
+from crypto_ledger.store import close_period, count_transactions
+
+def _sheets(book):
+    # {sheet path: rows of cell texts} from a workbook write_xlsx produced
+    with zipfile.ZipFile(book) as archive:
+        names = sorted((n for n in archive.namelist() if n.startswith('xl/worksheets/')), key=lambda n: int(re.search(r'\d+', n).group()))
+        return {name: [re.findall(r'<(?:t xml:space="preserve"|v)>([^<]*)<', row) for row in re.findall(r'<row>(.*?)</row>', archive.read(name).decode())]
+                for name in names}
+
+def test_csv_export_streams_archived_then_open_rows_in_date_order():
+    build_synthetic_database(1200)
+    close_period('2021-12-31')
+    archived, open_rows = count_transactions(archived=True), count_transactions()
+    assert archived and open_rows
+    out = io.StringIO(newline='')
+    assert export_transactions_csv(out, chunk_size=100) == archived + open_rows
+    rows = list(csv.reader(io.StringIO(out.getvalue())))
+    assert rows[0] == db.TRANSACTION_COLUMNS and len(rows) == archived + open_rows + 1
+    assert [row[3] for row in rows[1:]] == sorted(row[3] for row in rows[1:])
+    assert len({row[0] for row in rows[1:]}) == archived + open_rows
+    out = io.StringIO(newline='')
+    assert export_transactions_csv(out, archived=False, person='hassan') == count_transactions(person='hassan') == len(out.getvalue().splitlines()) - 1
+
+def test_xlsx_export_splits_at_the_sheet_row_limit(monkeypatch):
+    build_synthetic_database(250)
+    monkeypatch.setattr(export, 'XLSX_MAX_ROWS', 100)  # header plus 99 rows a sheet
+    book = io.BytesIO()
+    assert write_xlsx(transaction_rows(chunk_size=40), book, 'Transactions') == 250
+    sheets = _sheets(book)
+    assert [len(rows) for rows in sheets.values()] == [100, 100, 53]
+    assert all(rows[0] == db.TRANSACTION_COLUMNS for rows in sheets.values())
+    ids = [int(row[0]) for rows in sheets.values() for row in rows[1:]]
+    assert sorted(ids) == list(range(1, 251))
+    with zipfile.ZipFile(book) as archive:
+        assert re.findall(r'name="([^"]+)"', archive.read('xl/workbook.xml').decode()) == ['Transactions', 'Transactions (2)', 'Transactions (3)']
+
+def test_empty_and_report_exports_keep_their_header():
+    book = io.BytesIO()
+    assert write_xlsx(transaction_rows(), book) == 0
+    assert list(_sheets(book).values()) == [[db.TRANSACTION_COLUMNS]]
+    report = pd.DataFrame({'year': [2023, 2024], 'realized_pnl': [12.5, float('nan')]})
+    out = io.StringIO(newline='')
+    assert write_csv(frame_rows(report), out) == 2 and out.getvalue().splitlines() == ['year,realized_pnl', '2023,12.5', '2024,']
+    with export_file(frame_rows(report), 'csv.zip', 'pnl') as file, zipfile.ZipFile(file) as archive:
+        assert archive.read('pnl.csv').decode().splitlines() == ['year,realized_pnl', '2023,12.5', '2024,']
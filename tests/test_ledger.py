@@ -0,0 +1,116 @@
+import sqlite3
+import numpy as np
+import pandas as pd
+import pytest
+from crypto_ledger import db
+from crypto_ledger.analysis import generate_financial_analysis, portfolio_value_series, sharded_analysis_parts, update_lot_cache, _finalize_analysis
+from crypto_ledger.bench import synthetic_ledger, build_synthetic_database
+from crypto_ledger.store import get_ledger_store, close_period, count_transactions, _ensure_data_types
+from crypto_ledger.summary import summary_financial_analysis, summary_value_series, update_summary_cache
+
+# --- HELPERS ---
+def _comparable(frame):
+    frame = frame.copy()
+    for col in frame.columns:
+        if frame[col].dtype != 'float64': frame[col] = frame[col].astype(object)
+    return frame.reset_index(drop=True)
+
+def assert_same_analysis(expected, actual):
+    # (portfolio, toman, realized, fees) frames, equal up to float rounding
+    assert len(expected) == len(actual)
+    for left, right in zip(expected, actual):
+        pd.testing.assert_frame_equal(_comparable(left), _comparable(right), check_exact=False, rtol=1e-8, atol=1e-8)
+
+def assert_same_series(expected, actual):
+    pd.testing.assert_frame_equal(expected.sort_index(axis=1), actual.sort_index(axis=1), check_exact=False, rtol=1e-8,
+                                  check_index_type=False, check_column_type=False)
+
+def assert_same_lots(expected, actual):
+    for left, right in zip(expected, actual): pd.testing.assert_frame_equal(left, right, check_exact=False, rtol=1e-8)
+
+def full_lots(snapshot, prices, history, method='fifo'):
+    return update_lot_cache(None, snapshot, prices, method, history, 1)['result']
+
+# --- MIGRATIONS ---
+def test_legacy_database_migrates_to_same_balances_and_analysis(ledger_db, prices, history):
+    # A database as the first release left it: text ids, REAL amounts, user_version 0
+    legacy = pd.concat(list(synthetic_ledger(600, seed=7)), ignore_index=True)
+    legacy['transaction_date'] = legacy['transaction_date'].dt.strftime('%Y-%m-%d %H:%M:%S')
+    legacy.insert(0, 'id', [f"2024010112000{n:06d}" for n in range(len(legacy))])
+    with sqlite3.connect(ledger_db) as conn:
+        db._create_transactions_table(conn)
+        conn.executemany(f"INSERT INTO transactions ({db.TRANSACTION_SELECT}) VALUES ({', '.join('?' * len(db.TRANSACTION_COLUMNS))})",
+                         legacy[db.TRANSACTION_COLUMNS].itertuples(index=False, name=None))
+    conn.close()
+    before = _ensure_data_types(legacy.assign(id=np.arange(1, len(legacy) + 1)))
+    expected = {}
+    for person, currency, amount in zip(before['person_name'], before['output_currency'], before['output_amount']): expected[person, currency] = expected.get((person, currency), 0) + amount
+    for person, currency, amount in zip(before['person_name'], before['input_currency'], before['input_amount']): expected[person, currency] = expected.get((person, currency), 0) - amount
+
+    snapshot = get_ledger_store().snapshot
+    with db.db_connection() as conn: assert conn.execute("PRAGMA user_version").fetchone()[0] == len(db.MIGRATIONS)
+    assert len(snapshot.transactions) == len(legacy)
+    for (person, currency), amount in expected.items():
+        assert db.from_units(snapshot.balances.get((person, currency), 0), currency) == pytest.approx(amount, abs=1e-6)
+    for h in (None, history):
+        assert_same_analysis(generate_financial_analysis(before, prices, h), generate_financial_analysis(snapshot.transactions, prices, h))
+        assert_same_analysis(generate_financial_analysis(before, prices, h), summary_financial_analysis(prices, h))
+
+# --- ANALYSIS PATHS ---
+def test_in_memory_sql_summary_and_sharded_analyses_agree(prices, history):
+    build_synthetic_database(2000)
+    transactions = get_ledger_store().snapshot.transactions
+    for h in (None, history):
+        expected = generate_financial_analysis(transactions, prices, h)
+        assert_same_analysis(expected, summary_financial_analysis(prices, h))
+        assert_same_analysis(expected, _finalize_analysis(sharded_analysis_parts(transactions, prices, h, workers=2), prices))
+        assert_same_series(portfolio_value_series(transactions, prices, h), summary_value_series(prices, h))
+
+# --- CACHES ---
+def test_app_caches_follow_writes(prices, history):
+    # The dashboard's summaries are kept current by the ledger_summary triggers and the lot cache resumes from
+    # its saved state; after each write both must match a full recompute over the rows
+    build_synthetic_database(2000)
+    ledger = get_ledger_store()
+    snapshot = ledger.snapshot
+    analysis, series = update_summary_cache(None, summary_financial_analysis, prices, history, 1), update_summary_cache(None, summary_value_series, prices, history, 1)
+    lots = update_lot_cache(None, snapshot, prices, 'fifo', history, 1)
+    middle, first = snapshot.transactions.iloc[len(snapshot.transactions) // 2], int(snapshot.transactions['id'].iloc[10])
+    writes = [lambda: ledger.add({'transaction_type': 'buy_crypto_with_usdt', 'person_name': 'hassan', 'transaction_date': '2025-02-01 10:00:00',
+                                  'input_currency': 'USDT', 'output_currency': 'BTC', 'input_amount': 600.0, 'output_amount': 0.01, 'rate': 0.0, 'fee': 0.6}),
+              lambda: ledger.update(middle['id'], {'input_amount': middle['input_amount'] / 2}),
+              lambda: ledger.delete(first)]
+    for write in writes:
+        snapshot = write()
+        previous = analysis
+        analysis, series = update_summary_cache(analysis, summary_financial_analysis, prices, history, 1), update_summary_cache(series, summary_value_series, prices, history, 1)
+        lots = update_lot_cache(lots, snapshot, prices, 'fifo', history, 1)
+        assert analysis is not previous and analysis['key'][1] == series['key'][1] == lots['version'] == snapshot.version
+        assert_same_analysis(generate_financial_analysis(snapshot.transactions, prices, history), analysis['result'])
+        assert_same_series(portfolio_value_series(snapshot.transactions, prices, history), series['result'])
+        assert_same_lots(full_lots(snapshot, prices, history), lots['result'])
+    assert update_summary_cache(analysis, summary_financial_analysis, prices, history, 1) is analysis
+
+# --- PERIOD CLOSE ---
+def test_close_period_leaves_analysis_balances_and_lots_unchanged(prices, history):
+    build_synthetic_database(2000)
+    ledger = get_ledger_store()
+    snapshot = ledger.snapshot
+    rows, balances = len(snapshot.transactions), dict(snapshot.balances)
+    before = {h is None: (generate_financial_analysis(snapshot.transactions, prices, h), portfolio_value_series(snapshot.transactions, prices, h),
+                          full_lots(snapshot, prices, h), full_lots(snapshot, prices, h, 'hifo')) for h in (None, history)}
+
+    result = close_period('2022-12-31')
+    snapshot = ledger.snapshot
+    assert result['open_from'] == snapshot.closed.open_from == '2023-01-01'
+    assert result['archived'] == count_transactions(archived=True) == rows - len(snapshot.transactions) > 0
+    assert snapshot.transactions['transaction_date'].min() >= pd.Timestamp('2023-01-01')
+    assert snapshot.balances == balances
+    for h in (None, history):
+        analysis, series, fifo, hifo = before[h is None]
+        assert_same_analysis(analysis, generate_financial_analysis(snapshot.transactions, prices, h, opening=snapshot.closed.summary))
+        assert_same_analysis(analysis, summary_financial_analysis(prices, h))
+        assert_same_series(series, portfolio_value_series(snapshot.transactions, prices, h, opening=snapshot.closed.summary))
+        assert_same_series(series, summary_value_series(prices, h))
+        assert_same_lots(fifo, full_lots(snapshot, prices, h))
+        assert_same_lots(hifo, full_lots(snapshot, prices, h, 'hifo'))
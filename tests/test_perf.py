@@ -0,0 +1,11 @@
+import json
+from crypto_ledger import perf
+from crypto_ledger.cli import main
+
+def test_cli_run_is_logged_with_statements_and_connection_time(ledger_db, monkeypatch, capsys):
+    monkeypatch.setattr(perf, 'ENABLED', True)
+    assert main(['balances', '--db', ledger_db]) == 0
+    with open(perf.log_file(), encoding='utf-8') as f: record = json.loads(f.readlines()[-1])
+    assert perf.log_file() == ledger_db[:-len('.db')] + '.perf.jsonl'
+    assert record['run'] == 'cli balances' and record['sql_count'] > 0 and 0 < record['connection_seconds'] <= record['seconds']
+    assert any(name == perf.CONNECTION for name, *_ in perf.timing_stats())
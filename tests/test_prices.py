@@ -0,0 +1,37 @@
+import io
+import pandas as pd
+import pytest
+from crypto_ledger.analysis import portfolio_value_series, PRICE_HISTORY_TOLERANCE_DAYS
+from crypto_ledger.prices import import_price_history_csv, get_price_history
+from crypto_ledger.store import get_ledger_store
+from crypto_ledger.cli import main
+
+def test_imported_price_history_values_holdings_as_of_each_day():
+    # A wide file (one column per currency, blanks skipped) and then a long one that corrects a day
+    assert import_price_history_csv(io.StringIO("Date,BTC,ETH\n2024-01-01,40000,2000\n2024-01-05,45000,\n")) == 3
+    version, history = get_price_history()
+    assert import_price_history_csv(io.StringIO("day,currency,price\n2024-01-05,btc,46000\n")) == 1
+    assert get_price_history()[0] > version
+    version, history = get_price_history()
+    assert history.astype({'currency': object}).values.tolist() == [['BTC', pd.Timestamp('2024-01-01'), 40000.0], ['BTC', pd.Timestamp('2024-01-05'), 46000.0],
+                                                                    ['ETH', pd.Timestamp('2024-01-01'), 2000.0]]
+    snapshot = get_ledger_store().add({'transaction_type': 'buy_crypto_with_usdt', 'person_name': 'hassan', 'transaction_date': '2024-01-01 12:00:00',
+                                       'input_currency': 'USDT', 'output_currency': 'BTC', 'input_amount': 100.0, 'output_amount': 1.0, 'rate': 0.0, 'fee': 0.0})
+    series = portfolio_value_series(snapshot.transactions, {'BTC': 50000.0}, history)['hassan']
+    stale = pd.Timestamp('2024-01-05') + pd.Timedelta(days=PRICE_HISTORY_TOLERANCE_DAYS)
+    assert series['2024-01-01':'2024-01-04'].eq(40000.0 - 100).all()
+    assert series['2024-01-05':stale].eq(46000.0 - 100).all()
+    assert series[stale + pd.Timedelta(days=1):].eq(50000.0 - 100).all()  # past the tolerance the current quote takes over
+
+def test_price_file_without_a_date_column_is_refused():
+    with pytest.raises(ValueError, match="date column"): import_price_history_csv(io.StringIO("currency,price\nBTC,1\n"))
+    assert get_price_history()[1].empty
+
+def test_cli_loads_a_price_file(ledger_db, tmp_path, capsys):
+    (tmp_path / 'prices.csv').write_text("date,currency,price\n2024-01-01,ETH,2000\n2024-01-02,ETH,2100\n")
+    assert main(['prices', 'import', str(tmp_path / 'prices.csv'), '--db', ledger_db]) == 0
+    assert capsys.readouterr().out == "Saved 2 daily prices.\n"
+    assert get_price_history()[1]['price'].tolist() == [2000.0, 2100.0]
+    (tmp_path / 'bad.csv').write_text("date,currency\n2024-01-01,ETH\n")
+    assert main(['prices', 'import', str(tmp_path / 'bad.csv'), '--db', ledger_db]) == 2
+    assert "needs a price column" in capsys.readouterr().err
@@ -0,0 +1,133 @@
+import io
+import pandas as pd
+import pytest
+from crypto_ledger import db
+from crypto_ledger.bench import build_synthetic_database
+from crypto_ledger.store import LedgerStore, get_ledger_store, get_transactions_page, query_transactions, import_transactions_csv
+
+def _row(**changes):
+    return {'transaction_type': 'buy_crypto_with_usdt', 'person_name': 'hassan', 'transaction_date': '2024-01-01 10:00:00', 'input_currency': 'USDT',
+            'output_currency': 'BTC', 'input_amount': 100.0, 'output_amount': 1.0, 'rate': 0.0, 'fee': 0.1, 'notes': '', **changes}
+
+def _ledger_state():
+    with db.db_connection() as conn:
+        return [conn.execute(sql).fetchall() for sql in ("SELECT * FROM transactions ORDER BY id", "SELECT * FROM balances ORDER BY 1, 2",
+                                                         "SELECT * FROM ledger_summary ORDER BY 1, 2, 3, 4, 5", "SELECT name FROM sqlite_master ORDER BY name")]
+
+# --- SNAPSHOTS ---
+def test_update_leaves_the_previous_snapshot_unchanged():
+    ledger = get_ledger_store()
+    ledger.add(_row()); old = ledger.add(_row())
+    kept = old.transactions.copy(deep=True)
+    new = ledger.update(old.transactions['id'].iat[0], {'output_amount': 5.0, 'person_name': 'abbas', 'transaction_date': '2024-02-01 10:00:00', 'notes': 'edited'})
+    pd.testing.assert_frame_equal(old.transactions, kept)
+    assert new.transactions['output_amount'].tolist() == [5.0, 1.0] and new.transactions['person_name'].tolist() == ['abbas', 'hassan']
+    assert new.transactions['notes'].tolist() == ['edited', '']
+
+@pytest.mark.parametrize('from_file', [False, True])
+def test_writes_leave_earlier_snapshots_unchanged(from_file):
+    ledger = get_ledger_store()
+    for n in range(5): ledger.add(_row(transaction_date=f"2024-01-0{n + 1} 10:00:00", person_name=['hassan', 'abbas'][n % 2]))
+    if from_file:
+        # A second store starts from the snapshot file the first one wrote, whose columns pyarrow owns
+        ledger.wait_for_snapshot_file(); ledger = LedgerStore()
+    snapshots = [ledger.snapshot]
+    ids = snapshots[0].transactions['id'].tolist()
+    for write in (lambda: ledger.add(_row(person_name='shahla', input_currency='ETH', output_currency='SOL')),
+                  lambda: ledger.update(ids[1], {'input_amount': 1.5, 'output_currency': 'DOGE', 'transaction_date': '2023-12-31 09:00:00'}),
+                  lambda: ledger.delete(ids[2])):
+        snapshots.append(write())
+    kept = [(s.transactions.copy(deep=True), dict(s.balances)) for s in snapshots]
+    ledger.update(ids[0], {'output_amount': 9.0, 'person_name': 'mohsen', 'notes': 'late edit'}); ledger.delete(ids[3])
+    for snapshot, (transactions, balances) in zip(snapshots, kept):
+        pd.testing.assert_frame_equal(snapshot.transactions, transactions)
+        assert snapshot.balances == balances
+    assert [len(s.transactions) for s in snapshots] == [5, 6, 6, 5]
+
+# --- CSV IMPORT ---
+IMPORT_HEADER = "transaction_type,person_name,transaction_date,input_currency,output_currency,input_amount,output_amount,fee\n"
+
+def test_import_with_invalid_rows_writes_nothing():
+    ledger = get_ledger_store()
+    ledger.add(_row())
+    before = _ledger_state()
+    result = ledger.bulk_import(io.StringIO(IMPORT_HEADER + "buy,abbas,2024-02-01,IRR,USDT,6000000,10,0\n"
+                                                          "teleport,abbas,2024-02-02,USDT,BTC,5,0.0001,0\n"
+                                                          "sell,abbas,not a date,BTC,USDT,1,5,0\n"
+                                                          "transfer,abbas,2024-02-03,USDT,BTC,1,1,0\n"
+                                                          "sell,,2024-02-04,BTC,USDT,1,5,0\n"
+                                                          "sell,abbas,2024-02-05,BTC,USDT,-1,5,0\n"))
+    assert result['imported'] == 0 and result['error_count'] == 5
+    assert result['errors'] == [(3, 'unknown transaction type'), (4, 'unreadable date'), (5, 'transfer between different currencies'),
+                                (6, 'missing person'), (7, 'negative amount')]
+    assert _ledger_state() == before and len(ledger.snapshot.transactions) == 1
+
+def test_import_rejects_overdrawn_balances_in_date_order():
+    # The sell is listed first but dated after the buy that funds it; the second sell overdraws
+    result = import_transactions_csv(io.StringIO(IMPORT_HEADER + "sell,abbas,2024-03-02,BTC,USDT,0.5,20000,0\n"
+                                                               "buy,abbas,2024-03-01,USDT,BTC,30000,1,0\n"
+                                                               "sell,abbas,2024-03-03,BTC,USDT,0.25,10000,0\n"))
+    assert result == {'imported': 3, 'errors': [], 'error_count': 0}
+    before = _ledger_state()
+    result = import_transactions_csv(io.StringIO(IMPORT_HEADER + "sell,abbas,2024-04-01,BTC,USDT,0.25,10000,0\n"
+                                                               "sell,abbas,2024-04-02,BTC,USDT,0.25,10000,0\n"))
+    assert result['imported'] == 0 and result['errors'] == [(3, 'insufficient BTC balance for abbas')]
+    assert _ledger_state() == before
+
+def test_large_import_rolls_back_its_index_and_summary_rebuild():
+    # Chunks of two rows count as large, so the import drops the indexes and the summary triggers before it fails
+    build_synthetic_database(50)
+    before = _ledger_state()
+    rows = ''.join(f"buy,abbas,2024-05-{day:02d},USDT,ETH,300,0.1,0\n" for day in range(1, 9)) + "sell,abbas,2024-05-20,ETH,USDT,5,15000,0\n"
+    result = import_transactions_csv(io.StringIO(IMPORT_HEADER + rows), chunk_size=2)
+    assert result['imported'] == 0 and result['errors'] == [(10, 'insufficient ETH balance for abbas')]
+    assert _ledger_state() == before
+    assert import_transactions_csv(io.StringIO(IMPORT_HEADER + rows.replace(',5,15000', ',0.5,1500')), chunk_size=2)['imported'] == 9
+
+# --- PAGINATION ---
+def test_keyset_pages_cover_the_ledger_once_across_tied_dates():
+    ledger = get_ledger_store()
+    for n in range(23): ledger.add(_row(transaction_date=f"2024-01-{1 + n // 5:02d} 10:00:00", person_name=['hassan', 'abbas'][n % 2]))
+    for page_size, filters in ((5, {}), (4, {}), (1, {}), (23, {}), (3, {'person': 'abbas'})):
+        pages, cursor = [], None
+        while True:
+            page, cursor = get_transactions_page(cursor, page_size, **filters)
+            pages.append(page['id'].tolist())
+            if cursor is None: break
+        expected = query_transactions(**filters)['id'].tolist()
+        assert sum(pages, []) == expected and all(len(page) == page_size for page in pages[:-1]) and 0 < len(pages[-1]) <= page_size
+
+def test_keyset_pages_stay_stable_under_concurrent_inserts():
+    ledger = get_ledger_store()
+    for n in range(10): ledger.add(_row(transaction_date=f"2024-01-{n + 1:02d} 10:00:00"))
+    first, cursor = get_transactions_page(None, 4)
+    expected = query_transactions()['id'].tolist()[4:8]
+    # Newer rows, and one at the cursor's own date with a higher id, land before the cursor; OFFSET paging would repeat rows
+    for day in ('2024-02-01', '2024-03-01', cursor[0][:10]): ledger.add(_row(transaction_date=f"{day} 10:00:00"))
+    second, _ = get_transactions_page(cursor, 4)
+    assert second['id'].tolist() == expected and not set(first['id']) & set(second['id'])
+    ledger.add(_row(transaction_date='2023-06-01 10:00:00'))  # an older row shows up on a later page
+    pages = []
+    while cursor is not None:
+        page, cursor = get_transactions_page(cursor, 4); pages += page['id'].tolist()
+    assert pages[-1] == ledger.snapshot.transactions['id'].iat[-1]
+
+# --- SYNC BETWEEN PROCESSES ---
+def test_second_store_catches_up_through_the_change_log():
+    # Two stores on one file stand in for two server processes
+    build_synthetic_database(300)
+    writer, reader = get_ledger_store(), LedgerStore()
+    ids = writer.snapshot.transactions['id'].tolist()
+    writer.add(_row(transaction_date='2025-02-01 10:00:00', person_name='shahla', notes='new'))
+    writer.update(ids[5], {'output_amount': 2.5, 'notes': 'edited'})
+    writer.delete(ids[6])
+    assert reader.snapshot.version == writer.snapshot.version - 3
+    snapshot = reader.sync()
+    assert [change[0] for change in snapshot.changes] == [writer.snapshot.version - 2, writer.snapshot.version - 1, writer.snapshot.version]
+    pd.testing.assert_frame_equal(snapshot.transactions, writer.snapshot.transactions)
+    assert snapshot.balances == writer.snapshot.balances and reader.sync() is snapshot
+    # A bulk import logs no rows, so the reader reloads and its change trail restarts
+    writer.bulk_import(io.StringIO(IMPORT_HEADER + "buy,abbas,2025-03-01,IRR,USDT,6000000,10,0\n"))
+    snapshot = reader.sync()
+    assert snapshot.changes == () and snapshot.version == writer.snapshot.version
+    pd.testing.assert_frame_equal(snapshot.transactions.reset_index(drop=True), writer.snapshot.transactions.reset_index(drop=True), check_categorical=False)